@@ -0,0 +1,66 @@
+"""
+Compare the read paths of KlineBinance.get on a temporary database of synthetic klines.
+
+    python benchmarks/bench_read.py --symbols=400 --days=32
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from dbmaster.catalog import KlineBinance
+
+
+def make_kline(symbols: int, days: int, freq: str = "5m") -> pd.DataFrame:
+    td = pd.Timedelta(freq)
+    opentime = pd.date_range("2024-01-01", periods=int(pd.Timedelta(f"{days}d") / td), freq=td)
+    rng = np.random.default_rng(0)
+    dfs = []
+    for i in range(symbols):
+        price = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(opentime))))
+        df = pd.DataFrame({"Symbol": f"S{i:03d}USDT", "OpenTime": opentime, "CloseTime": opentime + td})
+        df[["Open", "High", "Low", "Close"]] = np.repeat(price[:, None], 4, axis=1)
+        df[["BaseVolume", "QuoteVolume"]] = rng.random((len(opentime), 2))
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--symbols", type=int, default=100)
+    parser.add_argument("--days", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sa.create_engine(f"sqlite:///{Path(tmp) / 'kline.db'}")
+        KlineBinance.engine = engine
+        next(table for table in KlineBinance.table if table.name == "kline_binance_5m").create(engine)
+        df = make_kline(args.symbols, args.days)
+        KlineBinance.set(df, symbol=None, freq="5m")
+        symbol = df["Symbol"].unique().tolist()
+        print(f"{df.shape[0]} rows of {args.symbols} symbols over {args.days} days")
+
+        cases = {"all columns": {}, "pmom columns": {"column": ["Symbol", "OpenTime", "Open"]}}
+        for case, kwargs in cases.items():
+            timing, result = {}, {}
+            for reader in ("pandas", "fast"):
+                elapsed = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    result[reader] = KlineBinance.get(symbol, "5m", reader=reader, **kwargs)
+                    elapsed.append(time.perf_counter() - start)
+                timing[reader] = min(elapsed)
+            pd.testing.assert_frame_equal(result["pandas"], result["fast"])
+            speedup = timing["pandas"] / timing["fast"]
+            print(f"{case:>14}: pandas {timing['pandas']:.3f}s, fast {timing['fast']:.3f}s, {speedup:.1f}x")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
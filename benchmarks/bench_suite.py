@@ -0,0 +1,230 @@
+"""
+Benchmark the hot paths offline, on temporary databases fed by a synthetic vendor.
+
+    python benchmarks/bench_suite.py --output=bench.json
+    python benchmarks/bench_suite.py --baseline=bench.json  # compare, exit 1 on a regression above --threshold
+
+Measures:
+    update_kline_{mode}: Update.kline rows/s, fetching from the synthetic vendor in thread and async mode
+    get_{range}: KlineBinance.get seconds of all symbols over a range of 1d, 7d and the whole history
+    set_{if_row_exists}: KlineBinance.set rows/s written, of a frame half of whose rows exist
+        ("raise" and "ignore", which write nothing if any row exists: none exist)
+    compute_pmom: Compute.pmom asofs/s
+    compute_pmom_xrate: Compute.pmom asofs/s, reading the cross rates stored by Compute.xrate beforehand
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from dbmaster import config
+from dbmaster.catalog import KlineBinance
+from dbmaster.catalog.kline import COLUMNS
+from dbmaster.command import Compute, Update
+from dbmaster.derived import PmomBinance, XrateBinance
+from dbmaster.util import IfRowExistsType, create_engine
+from dbmaster.vendor import KlineVendorBase, VendorFactory
+
+START = pd.Timestamp("2024-01-01")
+SYMBOLS = 20
+DAYS = 30
+
+
+class SyntheticVendor(KlineVendorBase):
+    """Deterministic random walk klines of `SYMBOLS` symbols from `START`, optionally with `latency` seconds
+    per request of 1000 klines to emulate the network.
+    """
+
+    latency = 0.0
+
+    @classmethod
+    @property
+    def universe(cls) -> list[str]:
+        return ["BTCUSDT", *[f"S{i:03d}USDT" for i in range(1, SYMBOLS)]]
+
+    @classmethod
+    def get_kline(
+        cls,
+        symbol: str,
+        freq: str,
+        datefrom: pd.Timestamp | None = None,
+        dateto: pd.Timestamp | None = None,
+        closed_only: bool = True,
+        **kwargs,
+    ) -> pd.DataFrame:
+        td = pd.Timedelta(freq)
+        end = min(
+            pd.Timestamp(dateto) if dateto else START + pd.Timedelta(f"{DAYS}d"), START + pd.Timedelta(f"{DAYS}d")
+        )
+        opentime = pd.date_range(START, end - td, freq=td)  # all klines from START, so prices do not depend on range
+        rng = np.random.default_rng(zlib.crc32(f"{symbol}{freq}".encode()))
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, len(opentime))))
+        spread = np.abs(rng.normal(0, 0.001, (len(opentime), 2)))
+        volume = rng.random(len(opentime)) * 1000
+        df = pd.DataFrame(
+            {
+                "Symbol": symbol,
+                "OpenTime": opentime,
+                "CloseTime": opentime + td - pd.Timedelta("1s"),
+                "Open": np.r_[100, close[:-1]],
+                "High": close * (1 + spread[:, 0]),
+                "Low": close * (1 - spread[:, 1]),
+                "Close": close,
+                "BaseVolume": volume,
+                "QuoteVolume": volume * close,
+            }
+        )[COLUMNS]
+        df = df.loc[df["OpenTime"] >= pd.Timestamp(datefrom)] if datefrom else df.iloc[-1000:]
+        time.sleep(cls.latency * np.ceil(len(df) / 1000))
+        return df.reset_index(drop=True)
+
+
+def use_database(dataset_cls, path: Path) -> None:
+    """Point dataset_cls to an empty database, its tables are created on first use."""
+    dataset_cls.engine = create_engine(config.catalog.kline.model_copy(update={"path": str(path), "compact": False}))
+
+
+def timeit(func, repeat: int) -> tuple[float, object]:
+    """Best of repeat runs in seconds, and the result of the last run."""
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed), result
+
+
+def run(tmp: Path, repeat: int) -> dict[str, dict]:
+    results = {}
+    symbol = SyntheticVendor.universe
+    datefrom, dateto = START, START + pd.Timedelta(f"{DAYS}d")
+
+    for mode in ("thread", "async"):
+
+        def update(mode=mode):
+            use_database(KlineBinance, tmp / f"update_{mode}_{time.perf_counter_ns()}.db")
+            Update().kline("binance", symbol=symbol, freq="5m", datefrom=datefrom, dateto=dateto, mode=mode)
+            return KlineBinance.get(symbol, "5m").shape[0]
+
+        elapsed, rows = timeit(update, repeat)
+        results[f"update_kline_{mode}"] = {"value": rows / elapsed, "unit": "rows/s", "higher_is_better": True}
+
+    for name, days in {"1d": 1, "7d": 7, "all": DAYS}.items():
+        start = dateto - pd.Timedelta(f"{days}d")
+        elapsed, _ = timeit(lambda start=start: KlineBinance.get(symbol, "5m", datefrom=start), repeat)
+        results[f"get_{name}"] = {"value": elapsed, "unit": "s", "higher_is_better": False}
+
+    kline = KlineBinance.get(symbol, "5m")
+    existing, new = kline.iloc[: len(kline) * 3 // 4], kline.iloc[len(kline) // 2 :]
+    for if_row_exists in IfRowExistsType:
+
+        def write(if_row_exists=if_row_exists):
+            use_database(KlineBinance, tmp / f"set_{if_row_exists.value}_{time.perf_counter_ns()}.db")
+            if if_row_exists in (IfRowExistsType.RAISE, IfRowExistsType.IGNORE):  # the plain append
+                df = kline
+            else:
+                KlineBinance.set(existing, symbol=None, freq="5m")
+                df = new
+            start = time.perf_counter()
+            rows = KlineBinance.set(df, symbol=None, freq="5m", if_row_exists=if_row_exists)
+            return rows / (time.perf_counter() - start)
+
+        rate = max(write() for _ in range(repeat))
+        results[f"set_{if_row_exists.value}"] = {"value": rate, "unit": "rows/s", "higher_is_better": True}
+
+    use_database(KlineBinance, tmp / "pmom_kline.db")
+    KlineBinance.set(kline, symbol=None, freq="5m")
+    period = ["-1d", "-4h", "-1h", "+1h"]
+
+    def compute():
+        use_database(PmomBinance, tmp / f"pmom_{time.perf_counter_ns()}.db")
+        Compute().pmom("binance", symbol=symbol, period=period, step="5m", datefrom=datefrom + pd.Timedelta("1d"))
+        return PmomBinance.get(period=period[0])["Timestamp"].nunique()
+
+    elapsed, n_asof = timeit(compute, repeat)
+    results["compute_pmom"] = {"value": n_asof / elapsed, "unit": "asofs/s", "higher_is_better": True}
+
+    use_database(XrateBinance, tmp / "xrate.db")
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compute().xrate("binance", symbol=symbol, freq="5m")
+
+    def compute_xrate():
+        use_database(PmomBinance, tmp / f"pmom_xrate_{time.perf_counter_ns()}.db")
+        Compute().pmom(
+            "binance", symbol=symbol, period=period, step="5m", datefrom=datefrom + pd.Timedelta("1d"), source="xrate"
+        )
+        return PmomBinance.get(period=period[0])["Timestamp"].nunique()
+
+    elapsed, n_asof = timeit(compute_xrate, repeat)
+    results["compute_pmom_xrate"] = {"value": n_asof / elapsed, "unit": "asofs/s", "higher_is_better": True}
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> bool:
+    """Print results against baseline, True if any got worse by more than threshold."""
+    regressed = False
+    print(f"{'benchmark':<20} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<20} {'-':>12} {result['value']:>12.4g} {'new':>8}")
+            continue
+        base = baseline[name]["value"]
+        change = result["value"] / base - 1
+        worse = -change if result["higher_is_better"] else change
+        flag = " REGRESSION" if worse > threshold else ""
+        regressed |= worse > threshold
+        print(f"{name:<20} {base:>12.4g} {result['value']:>12.4g} {change:>+8.1%}{flag}")
+    return regressed
+
+
+def main():
+    global SYMBOLS, DAYS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--symbols", type=int, default=SYMBOLS)
+    parser.add_argument("--days", type=int, default=DAYS)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per vendor request of 1000 klines")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="save the results as json")
+    parser.add_argument("--baseline", type=Path, help="results saved by --output to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+    SYMBOLS, DAYS, SyntheticVendor.latency = args.symbols, args.days, args.latency
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp, mock.patch.object(VendorFactory, "get", lambda name: SyntheticVendor):
+        results = run(Path(tmp), args.repeat)
+        KlineBinance.engine.dispose()
+        PmomBinance.engine.dispose()
+        XrateBinance.engine.dispose()
+
+    report = {
+        "params": {"symbols": args.symbols, "days": args.days, "latency": args.latency, "repeat": args.repeat},
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": config.MAX_WORKERS},
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4))
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline["params"] != report["params"]:
+            print(f"warning: baseline was run with {baseline['params']}")
+        sys.exit(compare(results, baseline["results"], args.threshold))
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,34 @@
-from collections import defaultdict
+import argparse
+import atexit
+import functools
+import signal
+from typing import Literal
 import json
 import fire
 
-from dbmaster.command import Update, Compute
+from dbmaster.registry import CATALOG, DERIVED, resolve
+
+
+class LazyGroup:
+    """Command group imported on first use, so that `list` and `--help` start without importing pandas,
+    SQLAlchemy or the vendor SDKs.
+    """
+
+    def __init__(self, path: str, doc: str):
+        self._path = path
+        self.__doc__ = doc
+
+    @functools.cached_property
+    def _group(self):
+        return resolve(self._path)()
+
+    def __getattr__(self, name: str):
+        if name.startswith("__"):  # probed by inspect, e.g. __wrapped__
+            raise AttributeError(name)
+        return getattr(self._group, name)
+
+    def __dir__(self) -> list[str]:
+        return dir(self._group)
 
 
 class Main:
@@ -11,40 +37,102 @@ class Main:
     Environment Variables:
         - DBMASTER_CONFIG_PATH: Path to config file
         - DBMASTER_MAX_WORKERS: Max number of workers, default is number of cpu cores
-            set lower if you experience too frequent bans from vendor API or database locking.
+            set lower if you experience database locking. Vendor API requests are limited by their weight instead,
+            see `weight_limit` of the vendor in config.
+        - DBMASTER_WRITE_BATCH_ROWS: Rows to accumulate before a write transaction, default is 500000
+        - DBMASTER_WRITE_BATCH_SECONDS: Max seconds to accumulate rows before a write transaction, default is 10
+
+    Flags:
+        - --profile=PATH: save a cProfile of the run to PATH and print its top functions,
+            e.g. `python -m dbmaster update kline ... --profile=run.prof`
     """
 
     def __init__(self):
-        self.update = Update()
-        self.compute = Compute()
+        self.update = LazyGroup("dbmaster.command:Update", "Update data catalog from vendor.")
+        self.repair = LazyGroup("dbmaster.command:Repair", "Fill the gaps of data catalog from vendor.")
+        self.compute = LazyGroup("dbmaster.command:Compute", "Compute derived data from catalog.")
 
     def list(self) -> None:
         """List all available catalogs and vendors."""
-        from dbmaster.catalog import CatalogBase
-        from dbmaster.derived import DerivedBase
-        from dbmaster.vendor import VendorBase
-        from dbmaster.util import get_subclasses
-
-        vendor_clses = list(get_subclasses(VendorBase))
-
-        catelog_clses = list(get_subclasses(CatalogBase))
-        catalog_holder = defaultdict(list)
-        for catelog_cls in catelog_clses:
-            for vendor_cls in vendor_clses:
-                if catelog_cls.name in vendor_cls.has:
-                    catalog_holder[catelog_cls.name].append(vendor_cls.name)
         print("Available catalog datasets:")
-        print(json.dumps(catalog_holder, sort_keys=True, indent=4))
-
-        derived_clses = list(get_subclasses(DerivedBase))
-        derived_holder = defaultdict(list)
-        for derived_cls in derived_clses:
-            for vendor_cls in vendor_clses:
-                if derived_cls.vendor in vendor_cls.name:
-                    derived_holder[derived_cls.name].append(vendor_cls.name)
+        print(json.dumps({name: list(vendors) for name, vendors in CATALOG.items()}, sort_keys=True, indent=4))
         print("Available derived datasets:")
-        print(json.dumps(derived_holder, sort_keys=True, indent=4))
+        print(json.dumps({name: list(vendors) for name, vendors in DERIVED.items()}, sort_keys=True, indent=4))
+
+    def migrate(
+        self,
+        dataset: str,
+        vendor: str = "binance",
+        to: Literal["compact", "default"] = "compact",
+        batch_rows: int = 500_000,
+        vacuum: bool = True,
+    ) -> None:
+        """Convert the tables of a dataset in place to the compact schema, or back to the default one.
+
+        Set `compact` of the dataset in config accordingly afterwards.
+        vacuum: shrink the database file once converted, which needs free disk space of its size.
+        """
+        from dbmaster.util import DatasetFactory
+
+        dataset_cls = DatasetFactory.get(dataset, vendor)
+        res = dataset_cls.migrate(compact=to == "compact", batch_rows=batch_rows)
+        if vacuum:
+            dataset_cls.vacuum()
+        print(f"Done. Migrated {res} rows of {dataset} to {to} schema, set compact={to == 'compact'} in config.")
+
+    def index(self, dataset: str, vendor: str = "binance") -> None:
+        """Create the indexes of a dataset missing from its existing tables, e.g. created by an older version.
+
+        An index is built from the whole table in one transaction, writes to the database wait until it is done.
+        e.g. the covering index of pmom takes about half the size of the table, and halves its write throughput.
+        """
+        from dbmaster.util import DatasetFactory
+
+        dataset_cls = DatasetFactory.get(dataset, vendor)
+        res = dataset_cls.create_indexes()
+        print(f"Done. Created indexes {res} of {dataset}.")
+
+    def explain(self, dataset: str, vendor: str = "binance", method: str = "get", **kwargs) -> None:
+        """Show the sqlite query plans of a call to a dataset, e.g. to check that a query uses an index.
+
+        e.g. `python -m dbmaster explain pmom --symbol=ETH/BTC --period=-1d --datefrom=2024-04-01`
+        kwargs: arguments of the method of the dataset.
+        """
+        from dbmaster.util import DatasetFactory
+
+        dataset_cls = DatasetFactory.get(dataset, vendor)
+        for statement, plan in dataset_cls.explain(method, **kwargs):
+            depth = {0: -1}
+            print(statement)
+            for row in plan.itertuples():
+                depth[row.id] = depth.get(row.parent, -1) + 1
+                print(f"{'   ' * depth[row.id]}|--{row.detail}")
+            print()
+
+    def serve(self, run_now: bool = False) -> None:
+        """Run the jobs of `serve` in config on their schedules in this process, until interrupted.
+
+        run_now: run every job once at start, without waiting for its schedule.
+        """
+        from dbmaster import config
+        from dbmaster.scheduler import Scheduler
+
+        scheduler = Scheduler(config.serve.jobs, config.serve.max_concurrent_jobs)
+        signal.signal(signal.SIGTERM, lambda *args: scheduler.stop())
+        try:
+            scheduler.run(run_now=run_now)
+        except KeyboardInterrupt:
+            scheduler.stop()  # running jobs are waited for
 
 
 if __name__ == "__main__":
-    fire.Fire(Main())
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--profile")
+    args, argv = parser.parse_known_args()
+    if args.profile:
+        from dbmaster.metrics import Profiler
+
+        profiler = Profiler(args.profile)
+        profiler.start()
+        atexit.register(profiler.stop)
+    fire.Fire(Main(), command=argv)
@@ -1,3 +1,4 @@
+from dbmaster.registry import CATALOG
 from dbmaster.util import DatasetBase, DatasetFactory
 
 
@@ -6,4 +7,4 @@ class CatalogBase(DatasetBase):
 
 
 class CatalogFactory(DatasetFactory):
-    pass
+    registry = CATALOG
@@ -2,18 +2,24 @@
 Kline catalog implementation
 """
 
+import contextlib
 import logging
+import math
 import time
-from typing import Sequence
+from typing import Iterator, Literal, Sequence
 
 import pandas as pd
 from retry import retry
 import sqlalchemy as sa
-from sqlalchemy import Column, DateTime, Float, String
+from sqlalchemy import Column, DateTime, Float, Integer, String
 
 from dbmaster import config
 from dbmaster.catalog.base import CatalogBase
 from dbmaster.util import (
+    create_engine,
+    dictionary_table,
+    from_epoch_ms,
+    to_epoch_ms,
     validate,
     to_list,
     DateTimeType,
@@ -25,32 +31,206 @@ from dbmaster.util import (
 
 logger = logging.getLogger(__name__)
 
-engine = sa.create_engine(f"sqlite:///{config.catalog.kline.path}")
+engine = create_engine(config.catalog.kline)
 metadata = sa.MetaData()
+compact = config.catalog.kline.compact
 
+COLUMNS = ["Symbol", "OpenTime", "CloseTime", "Open", "High", "Low", "Close", "BaseVolume", "QuoteVolume"]
 
-class KlineBinance(CatalogBase):
-    table = [
-        sa.Table(
-            f"kline_binance_{freq}",
+if config.catalog.kline.backend == "parquet":
+    from dbmaster.parquet import ParquetStore
+
+    store = ParquetStore(config.catalog.kline.path)
+else:
+    store = None
+
+
+def kline_table(freq: str, metadata: sa.MetaData, compact: bool = False) -> sa.Table:
+    """Table of klines of freq.
+    In compact schema, Symbol is replaced by the Id of `kline_binance_symbol`, OpenTime is in epoch milliseconds,
+    and CloseTime is not stored but derived from OpenTime, see `close_time`.
+    """
+    if compact:
+        return sa.Table(
+            f"kline_binance_{freq}_compact",
             metadata,
-            Column("Symbol", String, primary_key=True),
-            Column("OpenTime", DateTime, primary_key=True),
-            Column("CloseTime", DateTime),
-            Column("Open", Float),
-            Column("High", Float),
-            Column("Low", Float),
-            Column("Close", Float),
-            Column("BaseVolume", Float),
-            Column("QuoteVolume", Float),
+            Column("SymbolId", Integer, primary_key=True),
+            Column("OpenTime", Integer, primary_key=True),
+            *[Column(col, Float) for col in COLUMNS[3:]],
+            sqlite_with_rowid=False,
         )
-        for freq in BINANCE_KLINE_FREQ
-    ]
+    return sa.Table(
+        f"kline_binance_{freq}",
+        metadata,
+        Column("Symbol", String, primary_key=True),
+        Column("OpenTime", DateTime, primary_key=True),
+        Column("CloseTime", DateTime),
+        *[Column(col, Float) for col in COLUMNS[3:]],
+    )
+
+
+def coverage_table(metadata: sa.MetaData) -> sa.Table:
+    """Contiguous intervals of stored klines per symbol and freq, Start and End are the OpenTime of the first and
+    last kline of an interval. Maintained by `KlineBinance.set`.
+    """
+    return sa.Table(
+        "kline_binance_coverage",
+        metadata,
+        Column("Symbol", String, primary_key=True),
+        Column("Freq", String, primary_key=True),
+        Column("Start", DateTime, primary_key=True),
+        Column("End", DateTime),
+    )
+
+
+def kline_length(freq: str) -> pd.Timedelta | pd.DateOffset:
+    return pd.DateOffset(months=1) if freq == "1M" else pd.Timedelta(freq)
+
+
+def align(time: pd.Timestamp, freq: str, up: bool = False) -> pd.Timestamp:
+    """OpenTime of the kline of freq at or before time, or at or after if up.
+    Klines open on the grid of freq from the epoch, weeks from a Monday and months on their first day.
+    """
+    if freq == "1M":
+        month = time.normalize().replace(day=1)
+        return month + pd.DateOffset(months=1) if up and month < time else month
+    origin, length = pd.Timestamp("1970-01-05" if freq == "1w" else "1970-01-01"), pd.Timedelta(freq)
+    n = (time - origin) / length
+    return origin + length * (math.ceil(n) if up else math.floor(n))
+
+
+def close_time(open_time: pd.Series, freq: str) -> pd.Series:
+    """CloseTime of klines of freq, the last second before the next kline opens."""
+    return open_time + kline_length(freq) - pd.Timedelta("1s")
+
+
+def merge_intervals(intervals: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """Union of intervals of klines of freq, those overlapping or adjacent merged.
+    Args:
+        intervals (pd.DataFrame): columns of Symbol, Start, End, the OpenTime of the first and last kline.
+    Returns:
+        pd.DataFrame: the same columns, sorted by Symbol and Start.
+    """
+    df = intervals[["Symbol", "Start", "End"]].sort_values(["Symbol", "Start"], ignore_index=True)
+    if df.empty:
+        return df
+    reach = (df["End"] + kline_length(freq)).groupby(df["Symbol"]).cummax()  # OpenTime of the next kline
+    first = (df["Symbol"] != df["Symbol"].shift()) | (df["Start"] > reach.shift())
+    df = df.groupby(first.cumsum()).agg(Symbol=("Symbol", "first"), Start=("Start", "min"), End=("End", "max"))
+    return df.reset_index(drop=True)
+
+
+def subtract_intervals(intervals: pd.DataFrame, other: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """Klines of intervals not in other, as intervals of klines of freq.
+    Args:
+        intervals, other (pd.DataFrame): columns of Symbol, Start, End, the OpenTime of the first and last kline.
+    Returns:
+        pd.DataFrame: the same columns, sorted by Symbol and Start.
+    """
+    length = kline_length(freq)
+    other = merge_intervals(other, freq).groupby("Symbol")
+    rows = []
+    for sym, start, end in merge_intervals(intervals, freq).itertuples(index=False):
+        if sym in other.groups:
+            for other_start, other_end in other.get_group(sym)[["Start", "End"]].itertuples(index=False):
+                if other_end < start or other_start > end:
+                    continue
+                if other_start > start:
+                    rows.append((sym, start, other_start - length))
+                start = other_end + length
+        if start <= end:
+            rows.append((sym, start, end))
+    return pd.DataFrame(rows, columns=["Symbol", "Start", "End"]).astype(
+        {"Start": "datetime64[ns]", "End": "datetime64[ns]"}
+    )
+
+
+@validate
+def resample(df: pd.DataFrame, freq: BinanceFreqType, source_freq: BinanceFreqType = "1m") -> pd.DataFrame:
+    """Aggregate klines of source_freq into klines of freq, the same as the vendor would have.
+    Buckets are aligned to the epoch (i.e. 00:00 UTC), those without every kline of source_freq are dropped: the
+    ones not closed yet, and with a warning the ones with missing klines, e.g. to be filled by `repair kline`.
+    Args:
+        df (pd.DataFrame): klines of source_freq, e.g. from `KlineBinance.get`.
+        freq (str): the freq to aggregate to, up to 1d.
+        source_freq (str): the freq of df. Default is "1m".
+    Returns:
+        pd.DataFrame: klines of freq, with the same columns as df.
+    """
+    assert freq not in {"3d", "1w", "1M"}, f"resample to {freq=} not supported"
+    td, source_td = pd.Timedelta(freq), pd.Timedelta(source_freq)
+    assert td > source_td and td % source_td == pd.Timedelta(0), f"can't resample {source_freq=} to {freq=}"
+    if df.empty:
+        return df
+
+    df = df.sort_values(["Symbol", "OpenTime"], ignore_index=True)
+    bucket = df["OpenTime"].dt.floor(td)
+    kline = df.groupby(["Symbol", bucket], sort=False).agg(
+        Open=("Open", "first"),
+        High=("High", "max"),
+        Low=("Low", "min"),
+        Close=("Close", "last"),
+        BaseVolume=("BaseVolume", "sum"),
+        QuoteVolume=("QuoteVolume", "sum"),
+        Count=("OpenTime", "size"),
+    )
+    kline = kline.reset_index()
+    kline.insert(2, "CloseTime", kline["OpenTime"] + td - pd.Timedelta("1s"))
+
+    complete = kline["Count"] == td // source_td
+    closed_to = kline["Symbol"].map(df.groupby("Symbol")["OpenTime"].max()) + source_td
+    if (incomplete := ~complete & (kline["OpenTime"] + td <= closed_to)).any():
+        logger.warning(f"Skipped {incomplete.sum()} {freq} klines missing {source_freq} klines, e.g.\n{kline.loc[incomplete].head()}")  # fmt: skip
+    kline = kline.loc[complete].reset_index(drop=True)
+    return kline[df.columns]
+
+
+class KlineBinance(CatalogBase):
+    table = [kline_table(freq, metadata, compact) for freq in BINANCE_KLINE_FREQ]
+    table += [coverage_table(metadata)]
+    table += [dictionary_table("kline_binance_symbol", metadata, "Symbol")] if compact else []
 
     @classmethod
-    def __initialize__(cls, engine=engine, metadata=metadata) -> None:
+    def __initialize__(cls, engine=engine, metadata=metadata, store=store, compact=compact) -> None:
         cls.engine = engine
         cls.metadata = metadata
+        cls.store = store  # ParquetStore if backend is parquet, otherwise tables in engine
+        cls.compact = compact  # tables in compact schema, see kline_table
+
+    @classmethod
+    def get_kline_table(cls, freq: str) -> sa.Table:
+        return cls.get_table(f"kline_binance_{freq}_compact" if cls.compact else f"kline_binance_{freq}")
+
+    @classmethod
+    def encode(cls, df: pd.DataFrame, symbol_table: sa.Table | None = None) -> pd.DataFrame:
+        """Kline of the default schema to compact schema."""
+        symbol_table = symbol_table if symbol_table is not None else cls.get_table("kline_binance_symbol")
+        codes = cls.get_codes(symbol_table, df["Symbol"].unique().tolist(), create=True)
+        df = df.assign(Symbol=df["Symbol"].map(codes), OpenTime=to_epoch_ms(df["OpenTime"]))
+        df = df.drop(columns="CloseTime", errors="ignore").rename(columns={"Symbol": "SymbolId"})
+        return df
+
+    @classmethod
+    def decode(
+        cls, df: pd.DataFrame, freq: str, column: list[str], symbol_table: sa.Table | None = None
+    ) -> pd.DataFrame:
+        """Kline of compact schema back to column of the default schema, sorted by Symbol and OpenTime."""
+        if df.empty:
+            return pd.DataFrame(columns=column)
+        symbol_table = symbol_table if symbol_table is not None else cls.get_table("kline_binance_symbol")
+        data = {}
+        for col in column:
+            if col == "Symbol":
+                data[col] = cls.decode_codes(symbol_table, df["SymbolId"])
+            elif col == "OpenTime":
+                data[col] = from_epoch_ms(df["OpenTime"])
+            elif col == "CloseTime":
+                data[col] = close_time(from_epoch_ms(df["OpenTime"]), freq)
+            else:
+                data[col] = df[col]
+        df = pd.DataFrame(data)
+        # rows are in the order of SymbolId and OpenTime
+        return df.sort_values("Symbol", kind="stable", ignore_index=True) if "Symbol" in column else df
 
     @classmethod
     @validate
@@ -61,67 +241,302 @@ class KlineBinance(CatalogBase):
         datefrom: DateTimeType | None = None,
         dateto: DateTimeType | None = None,
         column: str | list[str] | None = None,
+        reader: Literal["fast", "pandas"] = "fast",
     ) -> pd.DataFrame:
-        table = cls.get_table(f"kline_binance_{freq}")
+        """Get klines of freq.
+        Args:
+            reader (str): "fast" reads the cursor straight into typed arrays, "pandas" uses pd.read_sql.
+                Both return the same DataFrame.
+        """
+        column = to_list(column) or COLUMNS
+        if cls.store is not None:
+            table_name = f"kline_binance_{freq}"
+            return cls.store.read(table_name, column, symbol=to_list(symbol), datefrom=datefrom, dateto=dateto)
+
+        table = cls.get_kline_table(freq)
+        sql = cls.query(table, column, symbol=symbol, datefrom=datefrom, dateto=dateto)
+        df = cls.read_sql(sql) if reader == "fast" else pd.read_sql(sql, con=cls.engine)
+        return cls.decode(df, freq, column) if cls.compact else df
+
+    @classmethod
+    def query(
+        cls,
+        table: sa.Table,
+        column: list[str],
+        symbol: str | Sequence[str] | None = None,
+        datefrom: pd.Timestamp | None = None,
+        dateto: pd.Timestamp | None = None,
+    ) -> sa.Select:
+        """Select column of table with the filters of `get`, what `decode` needs for column in compact schema."""
+        if cls.compact:
+            stored = {"Symbol": "SymbolId", "CloseTime": "OpenTime"}
+            sql = sa.select(*[table.c[col] for col in dict.fromkeys(stored.get(col, col) for col in column)])
+            sql = sql.where(table.c.SymbolId.in_(cls.symbol_ids(symbol))) if symbol else sql
+            sql = sql.where(table.c.OpenTime >= datefrom.value // 10**6) if datefrom else sql
+            sql = sql.where(table.c.OpenTime <= dateto.value // 10**6) if dateto else sql
+            return sql
 
-        column = to_list(column) or [col.name for col in table.columns]
         sql = sa.select(*[table.c[col] for col in column])
         sql = sql.where(table.c.Symbol.in_(to_list(symbol))) if symbol else sql
         sql = sql.where(table.c.OpenTime >= datefrom.to_pydatetime()) if datefrom else sql
         sql = sql.where(table.c.OpenTime <= dateto.to_pydatetime()) if dateto else sql
-        df = pd.read_sql(sql, con=engine)
+        return sql
+
+    @classmethod
+    def symbol_ids(cls, symbol: str | Sequence[str]) -> list[int]:
+        """Ids of the stored symbols in compact schema."""
+        symbol = to_list(symbol)
+        codes = cls.get_codes(cls.get_table("kline_binance_symbol"), symbol)
+        return codes.reindex(symbol).dropna().astype(int).tolist()
+
+    @classmethod
+    @validate
+    def iter_get(
+        cls,
+        symbol: BinanceSymbolType | Sequence[BinanceSymbolType] | None,
+        freq: BinanceFreqType,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        column: str | list[str] | None = None,
+        chunk_rows: int = 1_000_000,
+        by: Literal["time", "symbol"] = "time",
+    ) -> Iterator[pd.DataFrame]:
+        """Same as `get`, yielding DataFrames of about chunk_rows rows instead of one.
+        Args:
+            by (str): "time" yields consecutive time windows with all symbols, sorted by OpenTime and Symbol.
+                "symbol" yields groups of whole symbols, sorted by Symbol and OpenTime.
+        """
+        column = to_list(column) or COLUMNS
+        keys = ["OpenTime", "Symbol"] if by == "time" else ["Symbol", "OpenTime"]
+        fetch_column = list(dict.fromkeys([*keys, *column]))
+
+        symbol = to_list(symbol) or cls.get_watermark(freq)["Symbol"].tolist()
+        first, last = cls.get_time_range(freq, symbol)
+        if first is None:
+            return
+        datefrom, dateto = max(datefrom or first, first), min(dateto or last, last)
+        td = pd.Timedelta("31d") if freq == "1M" else pd.Timedelta(freq)
+        n_time = max((dateto - datefrom) // td + 1, 1)
+
+        if by == "time":
+            chunks = []
+            window = td * max(chunk_rows // len(symbol), 1)
+            for start in pd.date_range(datefrom, dateto, freq=window):
+                end = min(start + window - pd.Timedelta("1s"), dateto)
+                chunks.append((symbol, start, end))
+        else:
+            n_symbol = max(chunk_rows // n_time, 1)
+            chunks = [(symbol[i : i + n_symbol], datefrom, dateto) for i in range(0, len(symbol), n_symbol)]
+
+        for sym, start, end in chunks:
+            df = cls.get(symbol=sym, freq=freq, datefrom=start, dateto=end, column=fetch_column)
+            if not df.empty:
+                yield df.sort_values(keys, ignore_index=True)[column]
+
+    @classmethod
+    @validate
+    def get_time_range(
+        cls, freq: BinanceFreqType, symbol: BinanceSymbolType | Sequence[BinanceSymbolType] | None = None
+    ) -> tuple[pd.Timestamp | None, pd.Timestamp | None]:
+        """Get the earliest and latest stored OpenTime across symbols, (None, None) if nothing is stored."""
+        if cls.store is not None:
+            return cls.store.get_time_range(f"kline_binance_{freq}", symbol=to_list(symbol))
+
+        table = cls.get_kline_table(freq)
+        key, symbols = cls.symbol_key(table, symbol)
+        first = sa.select(sa.func.min(table.c.OpenTime)).where(key == symbols.c[key.name]).scalar_subquery()
+        last = sa.select(sa.func.max(table.c.OpenTime)).where(key == symbols.c[key.name]).scalar_subquery()
+        ranges = sa.select(first.label("first"), last.label("last")).select_from(symbols).subquery()
+        sql = sa.select(sa.func.min(ranges.c.first), sa.func.max(ranges.c.last))
+        with cls.engine.connect() as conn:
+            first, last = conn.execute(sql).one()
+        if first is None:
+            return None, None
+        unit = "ms" if cls.compact else None
+        return pd.Timestamp(first, unit=unit), pd.Timestamp(last, unit=unit)
+
+    @classmethod
+    @validate
+    def get_watermark(
+        cls, freq: BinanceFreqType, symbol: BinanceSymbolType | Sequence[BinanceSymbolType] | None = None
+    ) -> pd.DataFrame:
+        """Get the latest stored OpenTime per Symbol.
+        Returns:
+            pd.DataFrame: columns of Symbol, OpenTime.
+        """
+        if cls.store is not None:
+            return cls.store.get_watermark(f"kline_binance_{freq}", symbol=to_list(symbol))
+
+        table = cls.get_kline_table(freq)
+        key, symbols = cls.symbol_key(table, symbol)
+        last = sa.select(sa.func.max(table.c.OpenTime)).where(key == symbols.c[key.name]).scalar_subquery()
+        sql = sa.select(symbols.c[key.name], last.label("OpenTime")).where(last.is_not(None))
+        sql = sql.order_by(symbols.c[key.name])
+        if cls.compact:
+            return cls.decode(cls.read_sql(sql), freq, ["Symbol", "OpenTime"])
+        df = pd.read_sql(sql, con=cls.engine)
         return df
 
+    @classmethod
+    def symbol_key(cls, table: sa.Table, symbol: str | Sequence[str] | None) -> tuple[sa.Column, sa.Subquery]:
+        """The symbol column of table, and the symbols to look up per symbol along the primary key, see
+        `DatasetBase.distinct`: the given ones, otherwise the stored ones.
+        """
+        if cls.compact:
+            return table.c.SymbolId, cls.distinct(table.c.SymbolId, cls.symbol_ids(symbol) if symbol else None)
+        return table.c.Symbol, cls.distinct(table.c.Symbol, to_list(symbol) or None)
+
     @classmethod
     @validate
     @retry(sa.exc.OperationalError, tries=3, logger=logger)
     def set(
         cls,
         df: pd.DataFrame,
-        symbol: BinanceSymbolType,
+        symbol: BinanceSymbolType | None,
         freq: BinanceFreqType,
         if_row_exists: IfRowExistsType = IfRowExistsType.INSERT,
         **kwargs,
-    ) -> None:
+    ) -> int:
         logger.debug(f"{cls.__name__}.set({symbol=}, {freq=}, {df.shape=}, {if_row_exists=})")
         table_name = f"kline_binance_{freq}"
         if df.empty:
-            return
+            return 0
+        opentime = pd.to_datetime(df["OpenTime"])
+        intervals = df.assign(Start=opentime, End=opentime)
         try:
-            res = df.to_sql(table_name, con=engine, if_exists="append", index=False)
-        except sa.exc.IntegrityError as e:
-            logger.debug(f"{type(e)}({e})"[:80] + "...")
-            if if_row_exists is IfRowExistsType.RAISE:
-                raise
-            elif if_row_exists is IfRowExistsType.IGNORE:
-                return
-            elif if_row_exists is IfRowExistsType.INSERT:
-                table = cls.get_table(table_name)
-                sql = (
-                    sa.select(table.c["OpenTime"])
-                    .where(table.c["Symbol"] == symbol)
-                    .where(table.c["OpenTime"] >= df["OpenTime"].min())
-                )
-                existed = pd.read_sql(sql, con=engine)
-
-                df = df[~df["OpenTime"].isin(existed["OpenTime"])]
-                res = df.to_sql(table_name, con=engine, if_exists="append", index=False)
-                logger.info(f"Inserted {res} rows to {table_name}.")
-            elif if_row_exists is IfRowExistsType.DROP:
-                table = cls.get_table(table_name)
-                sql = table.delete().where(table.c["Symbol"] == symbol).where(table.c["OpenTime"].in_(df["OpenTime"]))
-                with cls.engine.connect() as conn:
-                    res_del = conn.execute(sql)
-                    conn.commit()
-                res_inc = df.to_sql(table_name, con=engine, if_exists="append", index=False)
-                logger.info(f"Dropped {res_del.rowcount} rows from {table_name}, before inserting {res_inc} rows.")
+            if cls.store is not None:
+                res = cls.store.write(table_name, df, if_row_exists)
+                if res or if_row_exists is not IfRowExistsType.IGNORE:  # else all rows existed, covered already
+                    cls.add_coverage(intervals, freq)
             else:
-                raise ValueError(f"Invalid {if_row_exists=}.")
+                table = cls.get_kline_table(freq) if cls.compact else cls.get_table(table_name)
+                df = cls.encode(df) if cls.compact else df
+                with cls.engine.begin() as conn:  # the klines are never stored without their coverage
+                    res = cls.upsert(table, df, if_row_exists, conn=conn)
+                    cls.add_coverage(intervals, freq, conn=conn)
+        except sa.exc.IntegrityError:
+            if if_row_exists is IfRowExistsType.IGNORE:
+                return 0
+            raise
         except sa.exc.OperationalError as e:
             time.sleep(5)
             raise Exception(str(e)[:80] + " ...") from e
-        else:
-            logger.info(f"Inserted {res} rows to {table_name}.")
+        logger.info(f"Inserted {res} rows to {table_name}.")
+        return res
+
+    @classmethod
+    def add_coverage(cls, intervals: pd.DataFrame, freq: str, conn: sa.Connection | None = None) -> None:
+        """Merge intervals into the coverage index, e.g. of stored klines, or of those the vendor has none of.
+        Args:
+            intervals (pd.DataFrame): columns of Symbol, Start, End, the OpenTime of the first and last kline.
+            conn (sa.Connection): merge in the transaction of conn, e.g. the one writing the klines, else in a new one.
+        """
+        table = cls.get_table("kline_binance_coverage")
+        new = intervals[["Symbol", "Start", "End"]]
+        symbol = new["Symbol"].unique().tolist()
+        where = sa.and_(table.c.Freq == freq, table.c.Symbol.in_(symbol))
+        with contextlib.nullcontext(conn) if conn is not None else cls.engine.begin() as conn:
+            old = pd.read_sql(sa.select(table.c.Symbol, table.c.Start, table.c.End).where(where), con=conn)
+            old = old.astype({"Start": "datetime64[ns]", "End": "datetime64[ns]"})
+            intervals = merge_intervals(pd.concat([old, new], ignore_index=True), freq)
+            conn.execute(table.delete().where(where))
+            conn.execute(table.insert(), intervals.assign(Freq=freq).to_dict("records"))
+
+    @classmethod
+    @validate
+    def rebuild_coverage(
+        cls, freq: BinanceFreqType, symbol: BinanceSymbolType | Sequence[BinanceSymbolType] | None = None
+    ) -> pd.DataFrame:
+        """Recompute the coverage index from the stored klines, e.g. of those stored before it was maintained."""
+        symbol = to_list(symbol) or cls.get_watermark(freq)["Symbol"].tolist()
+        table = cls.get_table("kline_binance_coverage")
+        with cls.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.Freq == freq, table.c.Symbol.in_(symbol)))
+        for df in cls.iter_get(symbol, freq, column=["Symbol", "OpenTime"], by="symbol"):
+            cls.add_coverage(df.assign(Start=df["OpenTime"], End=df["OpenTime"]), freq)
+        return cls.get_coverage(freq, symbol)
+
+    @classmethod
+    @validate
+    def get_coverage(
+        cls, freq: BinanceFreqType, symbol: BinanceSymbolType | Sequence[BinanceSymbolType] | None = None
+    ) -> pd.DataFrame:
+        """Get the contiguous intervals of stored klines.
+        Returns:
+            pd.DataFrame: columns of Symbol, Start, End, the OpenTime of the first and last kline of each interval.
+        """
+        table = cls.get_table("kline_binance_coverage")
+        sql = sa.select(table.c.Symbol, table.c.Start, table.c.End).where(table.c.Freq == freq)
+        sql = sql.where(table.c.Symbol.in_(to_list(symbol))) if symbol else sql
+        df = pd.read_sql(sql.order_by(table.c.Symbol, table.c.Start), con=cls.engine)
+        return df.astype({"Start": "datetime64[ns]", "End": "datetime64[ns]"})
+
+    @classmethod
+    @validate
+    def get_gaps(
+        cls,
+        freq: BinanceFreqType,
+        symbol: BinanceSymbolType | Sequence[BinanceSymbolType] | None = None,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        edges: bool = True,
+    ) -> pd.DataFrame:
+        """Get the missing klines between datefrom and dateto according to the coverage index.
+        Args:
+            edges (bool): also the klines missing before the first and after the last stored one of a symbol,
+                until datefrom and dateto if given. A symbol not stored at all misses the whole range.
+                If False, only the holes between stored klines.
+        Returns:
+            pd.DataFrame: columns of Symbol, Start, End, the OpenTime of the first and last missing kline of each gap.
+        """
+        length = kline_length(freq)
+        first = align(datefrom, freq, up=True) if datefrom is not None else pd.NaT
+        last = align(dateto, freq) if dateto is not None else pd.NaT
+        coverage = cls.get_coverage(freq, symbol)
+        gaps = pd.DataFrame(
+            {"Symbol": coverage["Symbol"], "Start": coverage["End"].shift() + length, "End": coverage["Start"] - length}
+        )
+        gaps = gaps.loc[coverage["Symbol"] == coverage["Symbol"].shift()]  # between intervals of the same symbol
+        if edges:
+            stored = coverage.groupby("Symbol").agg(Start=("Start", "min"), End=("End", "max"))
+            stored = stored.reindex(to_list(symbol) or stored.index).reset_index()
+            head = pd.DataFrame({"Symbol": stored["Symbol"], "Start": first, "End": stored["Start"] - length})
+            tail = pd.DataFrame({"Symbol": stored["Symbol"], "Start": stored["End"] + length, "End": last})
+            missing = stored["Start"].isna()  # nothing stored, the whole range
+            whole = pd.DataFrame({"Symbol": stored["Symbol"].loc[missing], "Start": first, "End": last})
+            gaps = pd.concat([gaps, head.loc[~missing], tail.loc[~missing], whole], ignore_index=True)
+            gaps = gaps.dropna(subset=["Start", "End"])
+        if datefrom is not None:
+            gaps["Start"] = gaps["Start"].clip(lower=first)
+        if dateto is not None:
+            gaps["End"] = gaps["End"].clip(upper=last)
+        gaps = gaps.loc[gaps["Start"] <= gaps["End"]]
+        return gaps.sort_values(["Symbol", "Start"], ignore_index=True)
+
+    @classmethod
+    def migrate(cls, compact: bool = True, batch_rows: int = 500_000) -> int:
+        """Convert the kline tables in the database to compact schema (or back), in batches of batch_rows rows.
+        A table is dropped once converted, an interrupted migration continues where it stopped.
+        Returns:
+            int: number of rows converted.
+        """
+        metadata = sa.MetaData()
+        symbol_table = dictionary_table("kline_binance_symbol", metadata, "Symbol")
+        symbol_table.create(cls.engine, checkfirst=True)
+        existing = set(sa.inspect(cls.engine).get_table_names())
+
+        res = 0
+        for freq in BINANCE_KLINE_FREQ:
+            source, target = kline_table(freq, metadata, not compact), kline_table(freq, metadata, compact)
+            if source.name not in existing:
+                continue
+            target.create(cls.engine, checkfirst=True)
+            for df in cls.iter_table(source, batch_rows):
+                df = cls.encode(df, symbol_table) if compact else cls.decode(df, freq, COLUMNS, symbol_table)
+                res += cls.upsert(target, df, IfRowExistsType.INSERT)
+                logger.info(f"Migrated {res} rows, {source.name} to {target.name} until {df['OpenTime'].iloc[-1]}.")
+            source.drop(cls.engine)
+        return res
 
 
 class Kline:
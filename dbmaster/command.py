@@ -1,58 +1,255 @@
-import threading
-from typing import Sequence
+from typing import Callable, Literal, Sequence
 from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import itertools
 import logging
 
+import numpy as np
 import pandas as pd
+import sqlalchemy as sa
 
 from dbmaster import config
 from dbmaster.catalog import CatalogFactory
+from dbmaster.catalog.kline import align, resample, subtract_intervals
 from dbmaster.derived import DerivedFactory
-from dbmaster.util import validate, DateTimeType, to_list
+from dbmaster.derived.pmom import normalize_symbol
+from dbmaster.metrics import instrument, metrics
+from dbmaster.util import validate, DateTimeType, IfRowExistsType, to_list, to_binance_symbol
 from dbmaster.vendor.base import VendorFactory
+from dbmaster.writer import BatchWriter
 
 
 logger = logging.getLogger(__name__)
 
 
+def set_by(set_func: Callable[..., int], by: str, **kwargs) -> Callable[[pd.DataFrame], int]:
+    """Write function of a BatchWriter, setting the rows of many values of column `by`, e.g. symbols, at once.
+    With if_row_exists "ignore" or "raise", existing rows skip or abort only the rows of their own value, the same
+    as if each value was set on its own, so such a batch is set value by value, raising the first error at the end.
+    """
+    if_row_exists = IfRowExistsType(kwargs.get("if_row_exists", IfRowExistsType.INSERT))
+
+    def write(df: pd.DataFrame) -> int:
+        if if_row_exists not in (IfRowExistsType.IGNORE, IfRowExistsType.RAISE):
+            return set_func(df, **kwargs)
+        res, error = 0, None
+        for _, group in df.groupby(by, sort=False):
+            try:
+                res += set_func(group, **kwargs)
+            except sa.exc.IntegrityError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return res
+
+    return write
+
+
 class Update:
     """Update data catalog from vendor.
 
     Available Data Catalog:
         - kline: candlestick data (i.e. OHLCV)
+        - universe: symbols of the vendor, cached on disk for `vendor.binance.metadata_ttl` seconds
     """
 
+    def universe(self, vendor: str) -> None:
+        """Refresh the cached universe of vendor, used when `symbol` is not given."""
+        logger.info(f"Updating universe from {vendor=}")
+        universe = VendorFactory.get(vendor).get_universe(refresh=True)
+        print(f"Done. Returned: {len(universe)} symbols")
+
+    @instrument("update_kline")
     @validate
     def kline(
         self,
         vendor: str,
         *,
-        symbol: str | Sequence[str] | None,
         freq: str,
+        symbol: str | Sequence[str] | None = None,
         datefrom: DateTimeType | None = None,
         dateto: DateTimeType | None = None,
+        incremental: bool = False,
+        source: Literal["vendor", "resample", "archive"] = "vendor",
+        source_freq: str = "1m",
+        path: str | None = None,
+        mode: Literal["thread", "async"] = "thread",
         **kwargs,
     ):
-        """Update kline from vendor."""
-        logger.info(f"Updating Kline for {symbol=}, from {vendor=}, with: {freq=}, {datefrom=}, {dateto=}, {kwargs=}")
+        """Update kline from vendor.
+
+        incremental: each symbol starts from its latest stored OpenTime,
+            symbols without history start from `catalog.kline.start_date` in config, or `datefrom` if not configured.
+        source: "vendor" fetches from the vendor API,
+            "resample" aggregates the stored klines of `source_freq` instead, for the symbols stored if not given,
+            "archive" imports the zipped csv files of the vendor's bulk data dump mirrored under `path`,
+            for the symbols found there if not given. Files are read in `DBMASTER_MAX_WORKERS` threads.
+        mode: "thread" fetches symbols in `DBMASTER_MAX_WORKERS` threads,
+            "async" fetches all symbols concurrently on an event loop, within the request limits of the vendor.
+        """
+        assert mode == "thread" or source == "vendor", "async mode only fetches from vendor"
+        assert (source == "archive") == (path is not None), "path is required by, and only by, source archive"
+        logger.info(
+            f"Updating Kline for {symbol=}, from {vendor=}, with: {freq=}, {datefrom=}, {dateto=}, {incremental=}, {source=}, {mode=}, {kwargs=}"
+        )
         catalog_cls = CatalogFactory.get("kline", vendor)
         vendor_cls = VendorFactory.get(vendor)
-        symbol = to_list(symbol or vendor_cls.universe)
+        if source == "resample":
+            symbol = to_list(symbol) or catalog_cls.get_watermark(freq=source_freq)["Symbol"].tolist()
+        elif source == "archive":
+            files = vendor_cls.list_archive(path, freq=freq, symbol=to_list(symbol))
+            symbol = [to_binance_symbol(sym) for sym in to_list(symbol)] or sorted({file.symbol for file in files})
+        else:
+            symbol = to_list(symbol or vendor_cls.universe)
 
-        lock = threading.Lock()
+        symbol_datefrom = dict.fromkeys(symbol, datefrom)
+        if incremental:
+            watermark = catalog_cls.get_watermark(freq=freq, symbol=symbol).set_index("Symbol")["OpenTime"]
+            start_date = config.catalog.kline.start_date
+            for sym in symbol:
+                if to_binance_symbol(sym) in watermark:
+                    symbol_datefrom[sym] = watermark[to_binance_symbol(sym)] + pd.Timedelta("1s")
+                elif start_date is not None:
+                    symbol_datefrom[sym] = pd.to_datetime(start_date)
+            logger.debug(f"Updating Kline from {symbol_datefrom=}")
 
-        def task(symbol, freq=freq, datefrom=datefrom, dateto=dateto, kwargs=kwargs):
-            data = vendor_cls.get_kline(symbol=symbol, freq=freq, datefrom=datefrom, dateto=dateto, **kwargs)
-            with lock:
-                return catalog_cls.set(data, symbol=symbol, freq=freq, **kwargs)
+        def task(symbol, freq=freq, dateto=dateto, kwargs=kwargs):
+            datefrom = symbol_datefrom[symbol]
+            if source == "resample":  # buckets starting from datefrom
+                datefrom = datefrom and datefrom.ceil(pd.Timedelta(freq))
+                with metrics.span("read", symbol=symbol) as span:
+                    data = catalog_cls.get(symbol=symbol, freq=source_freq, datefrom=datefrom, dateto=dateto)
+                    span.rows = data.shape[0]
+                with metrics.span("transform", symbol=symbol) as span:
+                    data = resample(data, freq=freq, source_freq=source_freq)
+                    span.rows = data.shape[0]
+            else:
+                data = vendor_cls.get_kline(symbol=symbol, freq=freq, datefrom=datefrom, dateto=dateto, **kwargs)
+            with metrics.span("lock_wait", symbol=symbol):
+                writer.put(data)
+            return data.shape[0]
 
-        with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
-            futures = []
-            for sym in symbol:
-                future = executor.submit(task, symbol=sym)
-                futures.append(future)
+        def archive_task(file, freq=freq, dateto=dateto):
+            datefrom = symbol_datefrom[file.symbol]
+            with metrics.span("read", symbol=file.symbol) as span:
+                data = vendor_cls.read_archive(file, freq=freq)
+                span.rows = data.shape[0]
+            if datefrom is not None:
+                data = data.loc[data["OpenTime"] >= datefrom]
+            if dateto is not None:
+                data = data.loc[data["OpenTime"] <= dateto]
+            with metrics.span("lock_wait", symbol=file.symbol):
+                writer.put(data)
+            return data.shape[0]
+
+        async def atask(symbol, session, freq=freq, dateto=dateto, kwargs=kwargs):
+            datefrom = symbol_datefrom[symbol]
+            data = await vendor_cls.aget_kline(
+                symbol=symbol, freq=freq, datefrom=datefrom, dateto=dateto, session=session, **kwargs
+            )
+            with metrics.span("lock_wait", symbol=symbol):
+                await asyncio.to_thread(writer.put, data)  # blocks while the writer falls behind
+            return data.shape[0]
+
+        async def arun():
+            async with vendor_cls.async_session() as session:
+                return await asyncio.gather(*(atask(sym, session) for sym in symbol))
 
-            res = [future.result() for future in futures]
+        with BatchWriter(set_by(catalog_cls.set, "Symbol", symbol=None, freq=freq, **kwargs)) as writer:
+            if mode == "async":
+                res = asyncio.run(arun())
+            else:
+                with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+                    futures = []
+                    if source == "archive":
+                        for file in files:  # skip the files out of range
+                            datefrom = symbol_datefrom[file.symbol]
+                            if (datefrom is None or file.end > datefrom) and (dateto is None or file.start <= dateto):
+                                futures.append(executor.submit(archive_task, file=file))
+                    else:
+                        for sym in symbol:
+                            future = executor.submit(task, symbol=sym)
+                            futures.append(future)
+
+                    res = [future.result() for future in futures]
+        print(f"Done. Returned: {res}")
+
+
+class Repair:
+    """Fill the gaps of data catalog from vendor.
+
+    Available Data Catalog:
+        - kline: the klines missing according to the coverage index of the catalog
+    """
+
+    @instrument("repair_kline")
+    @validate
+    def kline(
+        self,
+        vendor: str,
+        *,
+        freq: str,
+        symbol: str | Sequence[str] | None = None,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        rebuild: bool = False,
+        **kwargs,
+    ):
+        """Fetch only the missing klines from vendor.
+
+        The holes between stored klines of the symbols are fetched, and if `datefrom`/`dateto` are given, the klines
+        missing from datefrom to the first stored one and from the last stored one to dateto.
+        Holes the vendor has no kline for, e.g. while trading was halted, are marked as covered, so that they are
+        neither fetched again nor stop `compute pmom`.
+        rebuild: recompute the coverage index from the stored klines first, e.g. for klines stored before it was
+            maintained.
+        """
+        logger.info(
+            f"Repairing Kline for {symbol=}, from {vendor=}, with: {freq=}, {datefrom=}, {dateto=}, {rebuild=}, {kwargs=}"
+        )
+        catalog_cls = CatalogFactory.get("kline", vendor)
+        vendor_cls = VendorFactory.get(vendor)
+        symbol = to_list(symbol) or None
+        if rebuild:
+            coverage = catalog_cls.rebuild_coverage(freq=freq, symbol=symbol)
+            logger.info(f"Rebuilt coverage of {coverage.shape[0]} intervals")
+
+        gaps = catalog_cls.get_gaps(freq=freq, symbol=symbol, datefrom=datefrom, dateto=dateto)
+        logger.info(f"Found {gaps.shape[0]} gaps:\n{gaps}")
+
+        open_time = align(pd.Timestamp.now("UTC").tz_localize(None), freq)  # of the kline not closed yet
+
+        def task(gap, freq=freq, kwargs=kwargs):
+            # the last kline of a gap is closed already unless it is the current one, which is left to the next repair
+            data = vendor_cls.get_kline(
+                symbol=gap.Symbol,
+                freq=freq,
+                datefrom=gap.Start,
+                dateto=gap.End,
+                closed_only=gap.End >= open_time,
+                **kwargs,
+            )
+            data = data.loc[(data["OpenTime"] >= gap.Start) & (data["OpenTime"] <= gap.End)]
+            with metrics.span("lock_wait", symbol=gap.Symbol):
+                writer.put(data)
+            return data.shape[0]
+
+        with BatchWriter(set_by(catalog_cls.set, "Symbol", symbol=None, freq=freq, **kwargs)) as writer:
+            with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+                futures = [executor.submit(task, gap=gap) for gap in gaps.itertuples(index=False)]
+                res = [future.result() for future in futures]
+
+        if gaps.empty:
+            print(f"Done. Returned: {res}")
+            return
+        symbol = gaps["Symbol"].unique().tolist()
+        holes = catalog_cls.get_gaps(freq=freq, symbol=symbol, datefrom=datefrom, dateto=dateto, edges=False)
+        if not holes.empty:
+            logger.warning(f"Vendor has no kline for {holes.shape[0]} holes, marked as covered:\n{holes}")
+            catalog_cls.add_coverage(holes, freq)
+        remaining = catalog_cls.get_gaps(freq=freq, symbol=symbol, datefrom=datefrom, dateto=dateto)
+        if not remaining.empty:  # e.g. before the listing
+            logger.warning(f"Vendor has no kline for {remaining.shape[0]} gaps:\n{remaining}")
         print(f"Done. Returned: {res}")
 
 
@@ -61,27 +258,50 @@ class Compute:
 
     Available Derived data:
         - pmom: price momentum, price percentage change for BTCUSDT and the rest relative to BTC.
+        - xrate: cross rates, the klines of the rest relative to BTC, stored for pmom to read.
     """
 
+    @instrument("compute_pmom")
     @validate
     def pmom(
         self,
         vendor: str,
         *,
-        symbol: Sequence[str] | None,
         period: Sequence[str],
         step: str,
+        symbol: Sequence[str] | None = None,
         datefrom: DateTimeType | None = None,
         dateto: DateTimeType | None = None,
+        method: Literal["range", "asof"] = "range",
+        incremental: bool = False,
+        mode: Literal["thread", "process"] = "thread",
+        chunk_rows: int | None = None,
+        source: Literal["kline", "xrate"] = "kline",
         **kwargs,
     ):
-        """Compute price momentum from catalog."""
+        """Compute price momentum from catalog.
+
+        method: "range" pivots the kline once and computes every asof at once,
+            "asof" computes each asof in its own thread. Both write the same rows.
+        mode: "process" splits the asofs of method "range" into `DBMASTER_MAX_WORKERS` contiguous shards,
+            computed in a pool of processes.
+        incremental: only compute asofs after the latest computed Timestamp of each (Symbol, Period),
+            `datefrom` is used for those not computed yet. An asof is pending until its period window has closed.
+        chunk_rows: read the kline in chunks of about chunk_rows rows, keeping only the window of the periods in
+            memory instead of the whole range. Only supported by method "range" without incremental.
+        source: "kline" normalizes the klines by BTCUSDT in every run,
+            "xrate" reads them normalized already, see `xrate`, which has to be computed up to dateto.
+        """
         logger.info(
-            f"Computing Price Momentum for {symbol=}, from {vendor=}, with: {period=}, {step=}, {datefrom=}, {dateto=}, {kwargs=}"
+            f"Computing Price Momentum for {symbol=}, from {vendor=}, with: {period=}, {step=}, {datefrom=}, {dateto=}, {method=}, {incremental=}, {mode=}, {chunk_rows=}, {source=}, {kwargs=}"
         )
+        assert mode == "thread" or method == "range", f"{mode=} is not supported by {method=}"
         catalog_cls = CatalogFactory.get("kline", vendor)
         derived_cls = DerivedFactory.get("pmom", vendor)
+        xrate_cls = DerivedFactory.get("xrate", vendor)
         symbol = symbol or VendorFactory.get(vendor).universe
+        names = [normalize_symbol(to_binance_symbol(sym).replace("USDT", "/USDT")) for sym in symbol]
+        to_symbol = "BTC/USDT" if source == "kline" else None  # xrate is normalized already
 
         period = to_list(period)
         period_td = [pd.Timedelta(prd) for prd in period]
@@ -89,27 +309,206 @@ class Compute:
         fetch_datefrom = datefrom + period_min
         step_td = pd.Timedelta(step)
 
-        df = catalog_cls.get(symbol=symbol, freq=step, datefrom=fetch_datefrom, dateto=dateto)
-        df["Symbol"] = df["Symbol"].str.replace("USDT", "/USDT")
-        asof_start = df["OpenTime"].min() - pd.Timedelta(period_min)
-        asof_end = df["OpenTime"].max() - pd.Timedelta(period_max)
-        assert asof_start <= asof_end, f"{asof_start=} > {asof_end=}"
-        asofs = pd.date_range(asof_start, asof_end, freq=step_td)
-
-        lock = threading.Lock()
-
-        def task(asof, df=df):
-            logger.debug(f"Computing pmom {asof=} for {symbol=}, across {period=}")
-            window = df.loc[(df["OpenTime"] >= asof + period_min) & (df["OpenTime"] <= asof + period_max)]
-            df = derived_cls.compute(window, period=period, asof=asof)
-            with lock:
-                return derived_cls.set(df, **kwargs)
-
-        with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
-            futures = []
-            for asof in asofs:
-                future = executor.submit(task, asof=asof)
-                futures.append(future)
-
-            res = [future.result() for future in futures]
-        print(f"Done. Returned: {res}")
+        if incremental:
+            assert method == "range", f"incremental is not supported by {method=}"
+            watermark = derived_cls.get_watermark(symbol=names).set_index(["Symbol", "Period"])["Timestamp"]
+            done = {(name, prd): watermark.get((name, prd), datefrom - step_td) for name in names for prd in period}
+            pending_from = min(done.values()) + step_td
+            fetch_datefrom = pending_from + period_min
+            logger.info(f"Pending pmom from {pending_from}")
+
+        gaps = catalog_cls.get_gaps(freq=step, symbol=symbol, datefrom=fetch_datefrom, dateto=dateto, edges=False)
+        if not gaps.empty:  # rather than failing on the first asof without data
+            raise ValueError(
+                f"{gaps.shape[0]} gaps of {step} kline from {fetch_datefrom} to {dateto}, e.g.\n{gaps.head()}\n"
+                f"fill them with `python -m dbmaster repair kline --vendor={vendor} --freq={step}`"
+            )
+
+        def shards(df, period, asofs):
+            if mode == "process":
+                yield from derived_cls.iter_compute_range(
+                    df, period=period, asofs=asofs, max_workers=config.MAX_WORKERS, to_symbol=to_symbol
+                )
+            else:
+                yield derived_cls.compute_range(df, period=period, asofs=asofs, to_symbol=to_symbol)
+
+        def compute_range(df, period, asofs):
+            yield from metrics.iter("compute", shards(df, period, asofs), asof_start=asofs[0], asof_end=asofs[-1])
+
+        def put(pmom):
+            # whole asofs of about batch_rows rows per put, a range of asofs would be written at once otherwise
+            timestamps, codes = np.unique(pmom["Timestamp"].to_numpy(), return_inverse=True)
+            n_asof = max(writer.batch_rows * len(timestamps) // max(pmom.shape[0], 1), 1)
+            for _, part in pmom.groupby(codes // n_asof, sort=True):
+                with metrics.span("lock_wait"):
+                    writer.put(part)
+
+        if chunk_rows is not None:
+            assert method == "range" and not incremental, f"chunk_rows is not supported by {method=}, {incremental=}"
+            if source == "xrate":
+                chunks = xrate_cls.iter_get(names, step, datefrom=fetch_datefrom, dateto=dateto, chunk_rows=chunk_rows)
+            else:
+                chunks = catalog_cls.iter_get(
+                    symbol=symbol,
+                    freq=step,
+                    datefrom=fetch_datefrom,
+                    dateto=dateto,
+                    column=["Symbol", "OpenTime", "Open"],
+                    chunk_rows=chunk_rows,
+                )
+            window, asof_start, n_asof = None, None, 0
+            with BatchWriter(set_by(derived_cls.set, "Timestamp", **kwargs)) as writer:
+                for chunk in itertools.chain(metrics.iter("read", chunks), [None]):  # None after the last chunk
+                    if chunk is not None:
+                        if source == "kline":
+                            chunk["Symbol"] = chunk["Symbol"].str.replace("USDT", "/USDT")
+                        window = pd.concat([window, chunk], ignore_index=True)
+                        asof_start = window["OpenTime"].min() - period_min if asof_start is None else asof_start
+                    if window is None:
+                        break
+                    # the frame of an asof is complete once later data arrived, the forward periods have to be closed
+                    asof_end = window["OpenTime"].max() - (period_max if chunk is None else max(period_max, pd.Timedelta(0)))  # fmt: skip
+                    asofs = pd.date_range(asof_start, asof_end, freq=step_td)
+                    logger.debug(f"Computing pmom for {len(asofs)} asofs from {asof_start} to {asof_end}, {period=}")
+                    if not asofs.empty:
+                        for pmom in compute_range(window, period=period, asofs=asofs):
+                            put(pmom)
+                        asof_start, n_asof = asofs[-1] + step_td, n_asof + len(asofs)
+                    window = window.loc[window["OpenTime"] >= asof_start + min(period_min, pd.Timedelta(0))]
+            assert n_asof, f"no asof to compute for {period=} from {fetch_datefrom} to {dateto}"
+            print(f"Done. Returned: {writer.results}")
+            return
+
+        with metrics.span("read") as span:
+            if source == "xrate":
+                df = xrate_cls.get(symbol=names, freq=step, datefrom=fetch_datefrom, dateto=dateto)
+            else:
+                df = catalog_cls.get(
+                    symbol=symbol,
+                    freq=step,
+                    datefrom=fetch_datefrom,
+                    dateto=dateto,
+                    column=["Symbol", "OpenTime", "Open"],
+                )
+                df["Symbol"] = df["Symbol"].str.replace("USDT", "/USDT")
+            span.rows = df.shape[0]
+
+        if incremental and df.empty:
+            print("Done. Returned: []")
+            return
+
+        with BatchWriter(set_by(derived_cls.set, "Timestamp", **kwargs)) as writer:
+            if incremental:
+                # the asofs of a full run, of all periods at once, keeping the rows not computed yet
+                asof_start = max(pending_from, df["OpenTime"].min() - period_min)
+                asof_end = df["OpenTime"].max() - period_max  # forward window has to be closed
+                asofs = pd.date_range(asof_start, asof_end, freq=step_td)
+                logger.debug(f"Computing pmom for {len(asofs)} asofs from {asof_start} to {asof_end}, {period=}")
+                if not asofs.empty:
+                    for pmom in compute_range(df, period=period, asofs=asofs):
+                        keys = pd.MultiIndex.from_frame(pmom[["Symbol", "Period"]])
+                        after = pd.Series(done).reindex(keys).fillna(datefrom - step_td).to_numpy()
+                        put(pmom.loc[pmom["Timestamp"].to_numpy() > after])
+            else:
+                asof_start = df["OpenTime"].min() - pd.Timedelta(period_min)
+                asof_end = df["OpenTime"].max() - pd.Timedelta(period_max)
+                assert asof_start <= asof_end, f"{asof_start=} > {asof_end=}"
+                asofs = pd.date_range(asof_start, asof_end, freq=step_td)
+                logger.debug(f"Computing pmom for {len(asofs)} asofs from {asof_start} to {asof_end}, {period=}")
+
+                if method == "range":
+                    for pmom in compute_range(df, period=period, asofs=asofs):
+                        put(pmom)
+                else:
+
+                    def task(asof, df=df):
+                        logger.debug(f"Computing pmom {asof=} for {symbol=}, across {period=}")
+                        window = df.loc[(df["OpenTime"] >= asof + period_min) & (df["OpenTime"] <= asof + period_max)]
+                        with metrics.span("compute", asof=asof) as span:
+                            df = derived_cls.compute(window, period=period, asof=asof, to_symbol=to_symbol)
+                            span.rows = df.shape[0]
+                        put(df)
+
+                    with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+                        futures = []
+                        for asof in asofs:
+                            future = executor.submit(task, asof=asof)
+                            futures.append(future)
+
+                        [future.result() for future in futures]
+        print(f"Done. Returned: {writer.results}")
+
+    @instrument("compute_xrate")
+    @validate
+    def xrate(
+        self,
+        vendor: str,
+        *,
+        freq: str,
+        symbol: Sequence[str] | None = None,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        incremental: bool = False,
+        chunk_rows: int = 1_000_000,
+        **kwargs,
+    ):
+        """Compute cross rates from catalog, the klines normalized by BTCUSDT once per bar.
+
+        incremental: only compute the klines stored since the last run, according to the coverage index of the
+            klines: new bars, and holes filled later e.g. by `repair kline`, those of BTCUSDT for every symbol.
+            `datefrom` bounds them. Klines stored before the coverage index was maintained need `repair kline
+            --rebuild` first.
+        chunk_rows: read the kline in chunks of about chunk_rows rows.
+        Bars without a BTCUSDT kline, e.g. after the latest stored one, are left to the run after it is stored,
+        instead of being stored without a rate.
+        """
+        logger.info(
+            f"Computing Cross Rate for {symbol=}, from {vendor=}, with: {freq=}, {datefrom=}, {dateto=}, {incremental=}, {chunk_rows=}, {kwargs=}"
+        )
+        catalog_cls = CatalogFactory.get("kline", vendor)
+        derived_cls = DerivedFactory.get("xrate", vendor)
+        symbol = [to_binance_symbol(sym) for sym in to_list(symbol or VendorFactory.get(vendor).universe)]
+        symbol = list(dict.fromkeys(["BTCUSDT", *symbol]))
+
+        base_last = catalog_cls.get_watermark(freq=freq, symbol="BTCUSDT")["OpenTime"]
+        assert not base_last.empty, f"no BTCUSDT kline of {freq} to compute cross rates by"
+        dateto = min(dateto, base_last.iloc[0]) if dateto is not None else base_last.iloc[0]
+
+        # intervals of stored klines within datefrom and dateto
+        coverage = catalog_cls.get_coverage(freq=freq, symbol=symbol)
+        first = align(datefrom, freq, up=True) if datefrom is not None else coverage["Start"].min()
+        coverage = coverage.assign(Start=coverage["Start"].clip(lower=first), End=coverage["End"].clip(upper=dateto))
+        coverage = coverage.loc[coverage["Start"] <= coverage["End"]]
+
+        tasks = [(symbol, datefrom, dateto)]  # symbols of the cross rates to compute, from datefrom to dateto
+        if incremental:
+            pending = subtract_intervals(coverage, derived_cls.get_coverage(freq=freq, symbol=symbol), freq)
+            base = pending.loc[pending["Symbol"] == "BTCUSDT"]
+            tasks = [(symbol, start, end) for start, end in zip(base["Start"], base["End"])]
+            other = pending.loc[pending["Symbol"] != "BTCUSDT"]
+            other = subtract_intervals(other, other[["Symbol"]].merge(base[["Start", "End"]], how="cross"), freq)
+            for (start, end), group in other.groupby(["Start", "End"]):  # symbols of the same interval at once
+                tasks.append((group["Symbol"].tolist(), start, end))
+            logger.info(f"Pending xrate of {pending.shape[0]} intervals:\n{pending}")
+
+        with BatchWriter(set_by(derived_cls.set, "Symbol", freq=freq, **kwargs)) as writer:
+            for task_symbol, task_datefrom, task_dateto in tasks:
+                names = [normalize_symbol(sym.replace("USDT", "/USDT")) for sym in task_symbol]
+                chunks = catalog_cls.iter_get(
+                    symbol=list(dict.fromkeys(["BTCUSDT", *task_symbol])),
+                    freq=freq,
+                    datefrom=task_datefrom,
+                    dateto=task_dateto,
+                    column=["Symbol", "OpenTime", "Open"],
+                    chunk_rows=chunk_rows,
+                )
+                for chunk in metrics.iter("read", chunks):
+                    chunk["Symbol"] = chunk["Symbol"].str.replace("USDT", "/USDT")
+                    with metrics.span("compute") as span:
+                        xrate = derived_cls.compute(chunk)
+                        xrate = xrate.loc[xrate["Symbol"].isin(names)]
+                        span.rows = xrate.shape[0]
+                    with metrics.span("lock_wait"):
+                        writer.put(xrate)
+        derived_cls.add_coverage(coverage, freq)  # once written, else they are computed again by the next run
+        print(f"Done. Returned: {writer.results}")
@@ -1,5 +1,5 @@
 import os
-from typing import Sequence, Tuple, Type
+from typing import Any, Literal, Sequence, Tuple, Type
 from pathlib import Path
 
 from pydantic import BaseModel, AfterValidator
@@ -12,8 +12,23 @@ def _check_path(path: str) -> str:
     return path
 
 
+class SqliteConfig(BaseModel):
+    """PRAGMAs applied on every new connection, None to keep SQLite's default. See https://sqlite.org/pragma.html"""
+
+    journal_mode: Literal["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"] | None = None
+    synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] | None = None
+    mmap_size: int | None = None  # bytes
+    cache_size: int | None = None  # pages if positive, KiB if negative
+    busy_timeout: int | None = None  # milliseconds
+    temp_store: Literal["DEFAULT", "FILE", "MEMORY"] | None = None
+
+
 class DatasetConfig(BaseModel):
-    path: str = AfterValidator(_check_path)
+    path: str = AfterValidator(_check_path)  # sqlite file, or root directory if backend is parquet
+    backend: Literal["sqlite", "parquet"] = "sqlite"
+    start_date: str | None = None  # where to start from if there is no history, e.g. in incremental update
+    compact: bool = False  # integer keyed tables, convert existing ones by `migrate`. sqlite backend only
+    sqlite: SqliteConfig = SqliteConfig()
 
 
 class CatalogConfig(BaseModel):
@@ -22,6 +37,7 @@ class CatalogConfig(BaseModel):
 
 class DerivedConfig(BaseModel):
     pmom: DatasetConfig
+    xrate: DatasetConfig | None = None  # in the database of pmom if None
 
 
 class BinanceConfig(BaseModel):
@@ -29,12 +45,35 @@ class BinanceConfig(BaseModel):
     api_secret: str
     http_proxy: str | None = None
     https_proxy: str | None = None
+    max_concurrent_requests: int = 8  # shared by all threads of the process
+    max_async_requests: int = 256  # connections of the session in async mode
+    weight_limit: int = 5000  # request weight per minute, below the 6000 of binance to leave a margin
+    metadata_path: str | None = None  # json cache of exchange metadata, next to the kline catalog if None
+    metadata_ttl: int = 86400  # seconds before the cached universe is fetched again
 
 
 class VendorConfig(BaseModel):
     binance: BinanceConfig | None
 
 
+class JobConfig(BaseModel):
+    name: str
+    schedule: str  # cron expression of local time: minute hour day month weekday, e.g. "5 * * * *"
+    command: Literal["update", "compute", "repair"]
+    dataset: str  # e.g. kline for `dbmaster update kline`
+    kwargs: dict[str, Any] = {}  # arguments of the command, datefrom/dateto like "-1d" are relative to the run
+
+
+class ServeConfig(BaseModel):
+    max_concurrent_jobs: int = 2  # jobs running at once, a job never overlaps with its own previous run
+    jobs: list[JobConfig] = []
+
+
+class MetricsConfig(BaseModel):
+    json_path: str | None = None  # a json line with the spans of each command run is appended to it
+    prometheus_path: str | None = None  # *.prom file of node_exporter's textfile collector, rewritten after each run
+
+
 class LoggingConfig(BaseModel):
     version: int = 1
     disable_existing_loggers: bool = False
@@ -49,9 +88,13 @@ class Config(BaseSettings):
     catalog: CatalogConfig
     derived: DerivedConfig
     vendor: VendorConfig
+    serve: ServeConfig = ServeConfig()
+    metrics: MetricsConfig = MetricsConfig()
     logging: LoggingConfig
 
     MAX_WORKERS: int = max(int(os.environ.get("DBMASTER_MAX_WORKERS", os.cpu_count())), 1)
+    WRITE_BATCH_ROWS: int = max(int(os.environ.get("DBMASTER_WRITE_BATCH_ROWS", 500_000)), 1)
+    WRITE_BATCH_SECONDS: float = max(float(os.environ.get("DBMASTER_WRITE_BATCH_SECONDS", 10)), 0)
 
     model_config = SettingsConfigDict(
         toml_file=Path(os.environ.get("DBMASTER_CONFIG_PATH", Path(__file__).parent / "config.toml")),
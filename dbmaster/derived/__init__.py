@@ -1,2 +1,3 @@
 from .base import *
 from .pmom import *
+from .xrate import *
@@ -2,6 +2,7 @@ import abc
 
 import pandas as pd
 
+from dbmaster.registry import DERIVED
 from dbmaster.util import DatasetBase, DatasetFactory
 
 
@@ -13,4 +14,4 @@ class DerivedBase(DatasetBase):
 
 
 class DerivedFactory(DatasetFactory):
-    pass
+    registry = DERIVED
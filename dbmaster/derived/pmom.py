@@ -3,23 +3,68 @@ Price Momentum Implementation
 """
 
 import logging
+import multiprocessing
+import tempfile
 import time
-from typing import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, Literal, NamedTuple, Sequence
 
+import numpy as np
 import pandas as pd
 from retry import retry
 import sqlalchemy as sa
-from sqlalchemy import Column, DateTime, Float, String
+from sqlalchemy import Column, DateTime, Float, Integer, String
 
 from dbmaster import config
 from dbmaster.derived.base import DerivedBase
-from dbmaster.util import BinanceCurrencyType, PeriodType, validate, DateTimeType, IfRowExistsType, to_list
+from dbmaster.util import (
+    BinanceCurrencyType,
+    PeriodType,
+    create_engine,
+    dictionary_table,
+    from_epoch_ms,
+    to_epoch_ms,
+    validate,
+    DateTimeType,
+    IfRowExistsType,
+    to_list,
+)
 
 
 logger = logging.getLogger(__name__)
 
-engine = sa.create_engine(f"sqlite:///{config.derived.pmom.path}")
+engine = create_engine(config.derived.pmom)
 metadata = sa.MetaData()
+compact = config.derived.pmom.compact
+
+
+def pmom_table(metadata: sa.MetaData, compact: bool = False) -> sa.Table:
+    """Table of pmom.
+    In compact schema, Symbol and Period are replaced by the Ids of `pmom_binance_symbol` and `pmom_binance_period`,
+    and Timestamp is in epoch milliseconds.
+    The primary key serves the reads of all symbols by time, the covering index those of a few symbols' history.
+    """
+    if compact:
+        return sa.Table(
+            "pmom_binance_compact",
+            metadata,
+            Column("Timestamp", Integer, primary_key=True),
+            Column("SymbolId", Integer, primary_key=True),
+            Column("PeriodId", Integer, primary_key=True),
+            Column("Pmom", Float),
+            sa.Index("ix_pmom_binance_compact_symbol", "SymbolId", "PeriodId", "Timestamp", "Pmom"),
+            sqlite_with_rowid=False,
+        )
+    return sa.Table(
+        "pmom_binance",
+        metadata,
+        Column("Timestamp", DateTime, primary_key=True),
+        Column("Symbol", String, primary_key=True),
+        Column("Period", String, primary_key=True),
+        Column("Pmom", Float),
+        sa.Index("ix_pmom_binance_symbol", "Symbol", "Period", "Timestamp", "Pmom"),
+    )
 
 
 @validate
@@ -49,6 +94,13 @@ def normalize(
     return df
 
 
+def normalize_symbol(symbol: str, to_symbol: str = "BTC/USDT") -> str:
+    """The symbol `normalize` labels a normalized value with. e.g. ETH/USDT -> ETH/BTC"""
+    if symbol == to_symbol:
+        return symbol
+    return symbol.split("/")[0] + "/" + to_symbol.split("/")[0]
+
+
 @validate
 def pct_change(
     df: pd.DataFrame, value_col: str = "Open", date_col: str = "OpenTime", symbol_col: str = "Symbol"
@@ -105,20 +157,224 @@ def momentum(
     return momentum
 
 
+class PriceArray(NamedTuple):
+    """Prices pivoted into a time x symbol array.
+    Attributes:
+        times (np.ndarray): sorted unique datetime64[ns] of the rows.
+        symbols (pd.Index): symbol of each column.
+        value (np.ndarray): float64 array of shape (times, symbols), NaN where missing.
+        present (np.ndarray): bool array of shape (times, symbols), True where a row exists (value may be NaN).
+    """
+
+    times: np.ndarray
+    symbols: pd.Index
+    value: np.ndarray
+    present: np.ndarray
+
+
+class PmomArray(NamedTuple):
+    """Pmom as a dense timestamp x symbol x period array, see `PmomBinance.get_array`.
+    Attributes:
+        timestamps (np.ndarray): sorted unique datetime64[ns] of the first axis.
+        symbols (pd.Index): symbol of each index of the second axis.
+        periods (pd.Index): period of each index of the third axis.
+        value (np.ndarray): array of shape (timestamps, symbols, periods), NaN where not computed.
+    """
+
+    timestamps: np.ndarray
+    symbols: pd.Index
+    periods: pd.Index
+    value: np.ndarray
+
+
+def pivot(
+    df: pd.DataFrame,
+    value_col: str = "Open",
+    date_col: str = "OpenTime",
+    symbol_col: str = "Symbol",
+    to_symbol: str | None = "BTC/USDT",
+) -> PriceArray:
+    """Pivot a long DataFrame into a PriceArray, optionally normalized the same way as `normalize`.
+    Args:
+        value_col (str): the column to pivot. Default is "Open".
+        date_col (str): date column to align. Default is "OpenTime".
+        symbol_col (str): symbol column. Default is "Symbol".
+        to_symbol (str | None): the symbol to normalize to, None to skip normalization. Default is "BTC/USDT".
+    Returns:
+        PriceArray: the pivoted (and normalized) prices.
+    """
+    times, time_idx = np.unique(pd.to_datetime(df[date_col]).to_numpy(dtype="datetime64[ns]"), return_inverse=True)
+    symbols, symbol_idx = np.unique(df[symbol_col].to_numpy(dtype=str), return_inverse=True)
+    value = np.full((len(times), len(symbols)), np.nan)
+    value[time_idx, symbol_idx] = df[value_col].to_numpy(dtype="float64")
+    present = np.zeros(value.shape, dtype=bool)
+    present[time_idx, symbol_idx] = True
+    symbols = pd.Index(symbols)
+
+    if to_symbol is not None:
+        others = symbols != to_symbol
+        if to_symbol in symbols:
+            value[:, others] = value[:, others] / value[:, [symbols.get_loc(to_symbol)]]
+        else:
+            value[:, others] = np.nan
+        renamed = symbols.str.split("/").str[0] + "/" + to_symbol.split("/")[0]
+        symbols = pd.Index(np.where(others, renamed, symbols))
+    return PriceArray(times, symbols, value, present)
+
+
+def momentum_range(
+    prices: PriceArray, period: str | list[str], asofs: pd.DatetimeIndex | Sequence[pd.Timestamp]
+) -> pd.DataFrame:
+    """Compute momentum for every asof at once, with the same result as `momentum` applied to each asof window.
+
+    The window of an asof spans from asof + min(period) to asof + max(period) (always including asof itself),
+    every period is then computed from the first and last valid value of each symbol within [asof, asof + period].
+    Args:
+        prices (PriceArray): the prices to compute momentum on, see `pivot`.
+        period (str | list[str]): period(s) to compute e.g. "-1d", "+1h".
+        asofs (pd.DatetimeIndex | Sequence[pd.Timestamp]): the timestamps to compute momentum at.
+    Returns:
+        pd.DataFrame: columns of Symbol, Period, Pmom, Timestamp.
+    """
+    periods = to_list(period)
+    tds = np.array([pd.Timedelta(p).value for p in periods], dtype="int64")
+    asofs = pd.DatetimeIndex(asofs).as_unit("ns").asi8
+    times = prices.times.astype("int64")
+    n_time = len(times)
+    cols = np.arange(len(prices.symbols))
+
+    # index of the first valid value at or after t, and the last valid value at or before t
+    valid = ~np.isnan(prices.value)
+    rows = np.arange(n_time, dtype="int64")[:, None]
+    next_valid = np.where(valid, rows, n_time)
+    next_valid = np.minimum.accumulate(np.vstack([next_valid, np.full((1, len(cols)), n_time)])[::-1], axis=0)[::-1]
+    prev_valid = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    prev_valid = np.vstack([prev_valid, np.full((1, len(cols)), -1)])  # row -1 for empty windows
+    # cumulated number of rows per symbol, to tell whether a symbol has any data within a window
+    n_rows = np.vstack([np.zeros((1, len(cols)), dtype="int64"), np.cumsum(prices.present, axis=0)])
+
+    frame_from = np.searchsorted(times, asofs + min(tds.min(), 0), side="left")
+    frame_to = np.searchsorted(times, asofs + max(tds.max(), 0), side="right")
+    in_frame = n_rows[frame_to] - n_rows[frame_from] > 0
+    n_symbol = in_frame.sum(axis=1)
+
+    for cutoff in (asofs + tds.min(), asofs + tds.max()):
+        loc = np.searchsorted(times, cutoff).clip(max=n_time - 1)
+        bounded = times[loc] == cutoff
+        assert bounded.all(), f"cutoff must be bounded by the data range, asof={pd.Timestamp(asofs[~bounded][0])}"
+
+    asof_idx, symbol_idx = np.nonzero(in_frame)
+    timestamp = pd.to_datetime(asofs[asof_idx])
+    symbol = prices.symbols[symbol_idx]
+    momentums = []
+    for prd, td in zip(periods, tds):
+        start = np.searchsorted(times, np.minimum(asofs, asofs + td), side="left")
+        end = np.searchsorted(times, np.maximum(asofs, asofs + td), side="right")
+        n_window = n_rows[end].sum(axis=1) - n_rows[start].sum(axis=1)
+        if (no_data := n_window <= n_symbol).any():
+            raise ValueError(f"no data found for {prd} asof={pd.Timestamp(asofs[no_data][0])} to calculate momentum")
+
+        first = next_valid[start[:, None], cols]
+        last = prev_valid[end[:, None] - 1, cols]
+        found = first < end[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value_first = prices.value[first.clip(max=n_time - 1), cols]
+            value_last = prices.value[last, cols]
+            pmom = np.where(found, value_last / value_first - 1, np.nan)
+
+        momentum = pd.DataFrame({"Symbol": symbol, "Period": prd, "Pmom": pmom[asof_idx, symbol_idx]})
+        momentum["Timestamp"] = timestamp
+        momentums.append(momentum)
+    momentum = pd.concat(momentums, ignore_index=True)
+    return momentum
+
+
+def _momentum_shard(path: str, symbols: list[str], period: list[str], asofs: pd.DatetimeIndex) -> pd.DataFrame:
+    """`momentum_range` of the shard of asofs, on the rows they need of the PriceArray saved under path."""
+    times = np.load(Path(path) / "times.npy")
+    tds = [pd.Timedelta(p).value for p in period]
+    lo = np.searchsorted(times, (asofs[0] + pd.Timedelta(min(min(tds), 0))).to_datetime64(), side="left")
+    hi = np.searchsorted(times, (asofs[-1] + pd.Timedelta(max(max(tds), 0))).to_datetime64(), side="right")
+    value = np.load(Path(path) / "value.npy", mmap_mode="r")[lo:hi]
+    present = np.load(Path(path) / "present.npy", mmap_mode="r")[lo:hi]
+    prices = PriceArray(times[lo:hi], pd.Index(symbols), np.asarray(value), np.asarray(present))
+    return momentum_range(prices, period, asofs)
+
+
+def iter_momentum_range(
+    prices: PriceArray, period: str | list[str], asofs: pd.DatetimeIndex, max_workers: int
+) -> Iterator[pd.DataFrame]:
+    """`momentum_range` in a pool of processes, each computing a contiguous shard of asofs.
+
+    The arrays are shared through memory-mapped files, so a worker only reads the rows of its shard.
+    Yields:
+        pd.DataFrame: momentum of each shard, in the order of asofs.
+    """
+    periods = to_list(period)
+    shards = [shard for shard in np.array_split(pd.DatetimeIndex(asofs), max_workers) if len(shard)]
+    with tempfile.TemporaryDirectory(prefix="dbmaster_") as path:
+        for name in ("times", "value", "present"):
+            np.save(Path(path) / f"{name}.npy", getattr(prices, name))
+        # spawn as on Windows, forking a process running the writer thread may deadlock
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(shards) or 1), mp_context=context) as executor:
+            futures = [
+                executor.submit(_momentum_shard, path, prices.symbols.tolist(), periods, shard) for shard in shards
+            ]
+            for future in futures:
+                yield future.result()
+
+
 class PmomBinance(DerivedBase):
-    table = sa.Table(
-        "pmom_binance",
-        metadata,
-        Column("Timestamp", DateTime, primary_key=True),
-        Column("Symbol", String, primary_key=True),
-        Column("Period", String, primary_key=True),
-        Column("Pmom", Float),
-    )
+    table = [pmom_table(metadata, compact)]
+    if compact:
+        table += [
+            dictionary_table("pmom_binance_symbol", metadata, "Symbol"),
+            dictionary_table("pmom_binance_period", metadata, "Period"),
+        ]
 
     @classmethod
-    def __initialize__(cls, engine=engine, metadata=metadata) -> None:
+    def __initialize__(cls, engine=engine, metadata=metadata, compact=compact) -> None:
         cls.engine = engine
         cls.metadata = metadata
+        cls.compact = compact  # tables in compact schema, see pmom_table
+
+    @classmethod
+    def get_pmom_table(cls) -> sa.Table:
+        return cls.get_table("pmom_binance_compact" if cls.compact else "pmom_binance")
+
+    @classmethod
+    def encode(
+        cls, df: pd.DataFrame, symbol_table: sa.Table | None = None, period_table: sa.Table | None = None
+    ) -> pd.DataFrame:
+        """Pmom of the default schema to compact schema."""
+        symbol_table = symbol_table if symbol_table is not None else cls.get_table("pmom_binance_symbol")
+        period_table = period_table if period_table is not None else cls.get_table("pmom_binance_period")
+        symbol_codes = cls.get_codes(symbol_table, df["Symbol"].unique().tolist(), create=True)
+        period_codes = cls.get_codes(period_table, df["Period"].unique().tolist(), create=True)
+        df = df.assign(
+            Timestamp=to_epoch_ms(df["Timestamp"]),
+            Symbol=df["Symbol"].map(symbol_codes),
+            Period=df["Period"].map(period_codes),
+        )
+        return df.rename(columns={"Symbol": "SymbolId", "Period": "PeriodId"})
+
+    @classmethod
+    def decode(
+        cls, df: pd.DataFrame, symbol_table: sa.Table | None = None, period_table: sa.Table | None = None
+    ) -> pd.DataFrame:
+        """Pmom of compact schema back to the columns of the default schema, in the same row order."""
+        df = df.rename(columns={"SymbolId": "Symbol", "PeriodId": "Period"})
+        if df.empty:
+            return pd.DataFrame(columns=df.columns)
+        symbol_table = symbol_table if symbol_table is not None else cls.get_table("pmom_binance_symbol")
+        period_table = period_table if period_table is not None else cls.get_table("pmom_binance_period")
+        df = df.assign(
+            Timestamp=from_epoch_ms(df["Timestamp"]),
+            Symbol=cls.decode_codes(symbol_table, df["Symbol"]),
+            Period=cls.decode_codes(period_table, df["Period"]),
+        )
+        return df
 
     @classmethod
     @validate
@@ -128,78 +384,273 @@ class PmomBinance(DerivedBase):
         period: PeriodType | Sequence[PeriodType] | None = None,
         datefrom: DateTimeType | None = None,
         dateto: DateTimeType | None = None,
+        reader: Literal["fast", "pandas"] = "fast",
     ) -> pd.DataFrame:
-        table = cls.get_table("pmom_binance")
+        """Get pmom.
+        Args:
+            reader (str): "fast" reads the cursor straight into typed arrays, "pandas" uses pd.read_sql.
+                Both return the same DataFrame.
+        """
+        sql = cls.query(symbol=symbol, period=period, datefrom=datefrom, dateto=dateto)
+        df = cls.read_sql(sql) if reader == "fast" else pd.read_sql(sql, con=cls.engine)
+        if cls.compact:  # rows are in the order of the Ids
+            df = cls.decode(df).sort_values(["Timestamp", "Symbol", "Period"], kind="stable", ignore_index=True)
+        return df
+
+    @classmethod
+    def query(
+        cls,
+        symbol: str | Sequence[str] | None = None,
+        period: str | Sequence[str] | None = None,
+        datefrom: pd.Timestamp | None = None,
+        dateto: pd.Timestamp | None = None,
+    ) -> sa.Select:
+        """Select all columns with the filters of `get`, Ids and epoch milliseconds in compact schema."""
+        table = cls.get_pmom_table()
+        if cls.compact:
+            sql = sa.select(*table.columns)
+            sql = sql.where(table.c.SymbolId.in_(cls.code_ids("pmom_binance_symbol", symbol))) if symbol else sql
+            sql = sql.where(table.c.Timestamp >= datefrom.value // 10**6) if datefrom else sql
+            sql = sql.where(table.c.Timestamp <= dateto.value // 10**6) if dateto else sql
+            sql = sql.where(table.c.PeriodId.in_(cls.code_ids("pmom_binance_period", period))) if period else sql
+            return sql
 
         sql = sa.select(*table.columns)
         sql = sql.where(table.c.Symbol.in_(to_list(symbol))) if symbol else sql
         sql = sql.where(table.c.Timestamp >= datefrom.to_pydatetime()) if datefrom else sql
         sql = sql.where(table.c.Timestamp <= dateto.to_pydatetime()) if dateto else sql
         sql = sql.where(table.c.Period.in_(to_list(period))) if period else sql
-        df = pd.read_sql(sql, con=engine)
+        return sql
+
+    @classmethod
+    def code_ids(cls, table_name: str, values: str | Sequence[str]) -> list[int]:
+        """Ids of the stored values of a dictionary table in compact schema."""
+        values = to_list(values)
+        codes = cls.get_codes(cls.get_table(table_name), values)
+        return codes.reindex(values).dropna().astype(int).tolist()
+
+    @classmethod
+    @validate
+    def iter_get(
+        cls,
+        symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None = None,
+        period: PeriodType | Sequence[PeriodType] | None = None,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        chunk_rows: int = 1_000_000,
+        by: Literal["time", "symbol"] = "time",
+    ) -> Iterator[pd.DataFrame]:
+        """Same as `get`, streaming DataFrames of about chunk_rows rows instead of one.
+        Args:
+            by (str): "time" yields whole Timestamps in time order, the order of the primary key.
+                "symbol" yields whole symbols sorted by Symbol and Timestamp, which sqlite has to sort first.
+                In compact schema, chunks follow the order of the symbol Ids instead.
+        """
+        table = cls.get_pmom_table()
+        symbol_col = table.c.SymbolId if cls.compact else table.c.Symbol
+        period_col = table.c.PeriodId if cls.compact else table.c.Period
+
+        sql = cls.query(symbol=symbol, period=period, datefrom=datefrom, dateto=dateto)
+        if by == "time":
+            sql = sql.order_by(table.c.Timestamp, symbol_col, period_col)
+        else:
+            sql = sql.order_by(symbol_col, table.c.Timestamp, period_col)
+        chunks = cls.iter_sql(sql, by="Timestamp" if by == "time" else symbol_col.name, chunk_rows=chunk_rows)
+        if not cls.compact:
+            yield from chunks
+            return
+        keys = ["Timestamp", "Symbol", "Period"] if by == "time" else ["Symbol", "Timestamp", "Period"]
+        for df in chunks:
+            yield cls.decode(df.reset_index(drop=True)).sort_values(keys, kind="stable", ignore_index=True)
+
+    @classmethod
+    @validate
+    def get_array(
+        cls,
+        symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None = None,
+        period: PeriodType | Sequence[PeriodType] | None = None,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        dtype: Literal["float64", "float32"] = "float64",
+        batch_rows: int = 100_000,
+    ) -> PmomArray:
+        """Get pmom as a dense array, filled from the rows in Timestamp order batch by batch, without the long
+        DataFrame of `get` and its pivot.
+        Args:
+            symbol, period: the labels of the axis in this order, those not stored are all NaN.
+                If None, the stored ones sorted.
+            dtype (str): of the values, float32 halves the memory of the array.
+            batch_rows (int): rows fetched at once, only a batch of rows is held as python objects.
+        """
+        table = cls.get_pmom_table()
+        sql = cls.query(symbol=symbol, period=period, datefrom=datefrom, dateto=dateto).order_by(table.c.Timestamp)
+        labels = {"Symbol": {}, "Period": {}}  # stored label (Id in compact schema) -> index in order of appearance
+        timestamps, symbol_idx, period_idx, values = [], [], [], []
+        for timestamp, sym, prd, value in cls.iter_batches(sql, batch_rows):
+            if cls.compact:
+                timestamps.append(np.array(timestamp, dtype="int64") * 10**6)
+            else:
+                timestamps.append(np.array(timestamp, dtype="datetime64[ns]").view("int64"))
+            for name, column, idx in (("Symbol", sym, symbol_idx), ("Period", prd, period_idx)):
+                codes, uniques = pd.factorize(np.array(column, dtype=object))
+                index = np.array([labels[name].setdefault(label, len(labels[name])) for label in uniques])
+                idx.append(index[codes].astype("int32"))
+            values.append(np.array(value, dtype=dtype))
+
+        if cls.compact:  # Ids to values
+            names = {"Symbol": "pmom_binance_symbol", "Period": "pmom_binance_period"}
+            for name, table_name in names.items():
+                decoded = cls.decode_codes(cls.get_table(table_name), pd.Series(list(labels[name]), dtype="int64"))
+                labels[name] = dict(zip(decoded, labels[name].values()))
+        axis = {"Symbol": pd.Index(to_list(symbol) or sorted(labels["Symbol"]), name="Symbol")}
+        axis["Period"] = pd.Index(to_list(period) or sorted(labels["Period"]), name="Period")
+
+        timestamp = np.concatenate(timestamps) if timestamps else np.array([], dtype="int64")
+        new = np.flatnonzero(np.diff(timestamp, prepend=np.int64(-1)) != 0)  # first row of each Timestamp
+        value = np.full((len(new), len(axis["Symbol"]), len(axis["Period"])), np.nan, dtype=dtype)
+        if timestamps:
+            time_idx = np.repeat(np.arange(len(new)), np.diff(np.append(new, len(timestamp))))
+            to_axis = {name: np.array([axis[name].get_loc(label) for label in labels[name]]) for name in axis}
+            symbol_idx = to_axis["Symbol"][np.concatenate(symbol_idx)]
+            period_idx = to_axis["Period"][np.concatenate(period_idx)]
+            value[time_idx, symbol_idx, period_idx] = np.concatenate(values)
+        return PmomArray(timestamp[new].view("datetime64[ns]"), axis["Symbol"], axis["Period"], value)
+
+    @classmethod
+    @validate
+    def get_wide(
+        cls,
+        symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None = None,
+        period: PeriodType | Sequence[PeriodType] | None = None,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        dtype: Literal["float64", "float32"] = "float64",
+    ) -> pd.DataFrame:
+        """Get pmom as a wide DataFrame, a view of `get_array`.
+        Returns:
+            pd.DataFrame: indexed by Timestamp, with columns of (Symbol, Period).
+        """
+        array = cls.get_array(symbol=symbol, period=period, datefrom=datefrom, dateto=dateto, dtype=dtype)
+        return pd.DataFrame(
+            array.value.reshape(len(array.timestamps), -1),
+            index=pd.DatetimeIndex(array.timestamps, name="Timestamp"),
+            columns=pd.MultiIndex.from_product([array.symbols, array.periods]),
+            copy=False,
+        )
+
+    @classmethod
+    @validate
+    def get_watermark(
+        cls,
+        symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None = None,
+        period: PeriodType | Sequence[PeriodType] | None = None,
+    ) -> pd.DataFrame:
+        """Get the latest computed Timestamp per (Symbol, Period).
+        Returns:
+            pd.DataFrame: columns of Symbol, Period, Timestamp.
+        """
+        table = cls.get_pmom_table()
+        if cls.compact:
+            sql = sa.select(table.c.SymbolId, table.c.PeriodId, sa.func.max(table.c.Timestamp).label("Timestamp"))
+            sql = sql.where(table.c.SymbolId.in_(cls.code_ids("pmom_binance_symbol", symbol))) if symbol else sql
+            sql = sql.where(table.c.PeriodId.in_(cls.code_ids("pmom_binance_period", period))) if period else sql
+            sql = sql.group_by(table.c.SymbolId, table.c.PeriodId)
+            df = cls.decode(cls.read_sql(sql)).sort_values(["Symbol", "Period"], ignore_index=True)
+            return df[["Symbol", "Period", "Timestamp"]]
+
+        sql = sa.select(table.c.Symbol, table.c.Period, sa.func.max(table.c.Timestamp).label("Timestamp"))
+        sql = sql.where(table.c.Symbol.in_(to_list(symbol))) if symbol else sql
+        sql = sql.where(table.c.Period.in_(to_list(period))) if period else sql
+        sql = sql.group_by(table.c.Symbol, table.c.Period)
+        df = pd.read_sql(sql, con=cls.engine)
         return df
 
     @classmethod
     @validate
     @retry(sa.exc.OperationalError, tries=3, logger=logger)
-    def set(cls, df: pd.DataFrame, if_row_exists: IfRowExistsType = IfRowExistsType.INSERT, **kwargs) -> None:
+    def set(cls, df: pd.DataFrame, if_row_exists: IfRowExistsType = IfRowExistsType.INSERT, **kwargs) -> int:
         logger.debug(f"{cls.__name__}.set({df.shape=}, {if_row_exists=})")
         table_name = "pmom_binance"
         if df.empty:
-            return
+            return 0
         try:
-            res = df.to_sql(table_name, con=engine, if_exists="append", index=False)
-        except sa.exc.IntegrityError as e:
-            logger.debug(f"{type(e)}({e})"[:80] + "...")
-            if if_row_exists is IfRowExistsType.RAISE:
-                raise
-            elif if_row_exists is IfRowExistsType.IGNORE:
-                return
-            elif if_row_exists is IfRowExistsType.INSERT:
-                table = cls.get_table(table_name)
-                sql = sa.select(table.c["Timestamp"], table.c["Symbol"], table.c["Period"]).where(
-                    table.c["Timestamp"] == df["Timestamp"].iloc[0]
-                )
-                existed = pd.read_sql(sql, con=engine)
-                existed["existed"] = True
-
-                insert = df.merge(existed, how="left", on=["Timestamp", "Symbol", "Period"])
-                insert = insert[insert["existed"].isna()].drop(columns="existed")
-                res = insert.to_sql(table_name, con=engine, if_exists="append", index=False)
-                logger.info(f"Inserted {res} rows to {table_name}. Timestamp={df["Timestamp"].iloc[0]}")
-            elif if_row_exists is IfRowExistsType.DROP:
-                table = cls.get_table(table_name)
-                sql = (
-                    table.delete()
-                    .where(table.c["Timestamp"] == df["Timestamp"].iloc[0])
-                    .where(table.c["Period"].in_(df["Period"].unique()))
-                    .where(table.c["Symbol"].in_(df["Symbol"].unique()))
-                )
-                with cls.engine.connect() as conn:
-                    res_del = conn.execute(sql)
-                    conn.commit()
-                res_inc = df.to_sql(table_name, con=engine, if_exists="append", index=False)
-                logger.info(
-                    f"Dropped {res_del.rowcount} rows from {table_name}, before inserting {res_inc} rows. Timestamp={df["Timestamp"].iloc[0]}"
-                )
+            if cls.compact:
+                res = cls.upsert(cls.get_pmom_table(), cls.encode(df), if_row_exists)
             else:
-                raise ValueError(f"Invalid {if_row_exists=}.")
+                res = cls.upsert(cls.get_table(table_name), df, if_row_exists)
         except sa.exc.OperationalError as e:
             time.sleep(5)
             raise Exception(str(e)[:80] + " ...") from e
         else:
-            logger.info(f"Inserted {res} rows to {table_name}. Timestamp={df["Timestamp"].iloc[0]}")
+            logger.info(
+                f"Inserted {res} rows to {table_name}. Timestamp={df["Timestamp"].min()} - {df["Timestamp"].max()}"
+            )
+            return res
+
+    @classmethod
+    def migrate(cls, compact: bool = True, batch_rows: int = 500_000) -> int:
+        """Convert the pmom table in the database to compact schema (or back), in batches of batch_rows rows.
+        The table is dropped once converted, an interrupted migration continues where it stopped.
+        Returns:
+            int: number of rows converted.
+        """
+        metadata = sa.MetaData()
+        symbol_table = dictionary_table("pmom_binance_symbol", metadata, "Symbol")
+        period_table = dictionary_table("pmom_binance_period", metadata, "Period")
+        metadata.create_all(cls.engine, checkfirst=True)
+        source, target = pmom_table(metadata, not compact), pmom_table(metadata, compact)
+        if source.name not in sa.inspect(cls.engine).get_table_names():
+            return 0
+
+        res = 0
+        target.create(cls.engine, checkfirst=True)
+        for df in cls.iter_table(source, batch_rows):
+            if compact:
+                df = cls.encode(df, symbol_table, period_table)
+            else:
+                df = cls.decode(df, symbol_table, period_table)
+            res += cls.upsert(target, df, IfRowExistsType.INSERT)
+            logger.info(f"Migrated {res} rows, {source.name} to {target.name} until {df['Timestamp'].iloc[-1]}.")
+        source.drop(cls.engine)
+        return res
 
     @classmethod
     @validate
-    def compute(cls, df: pd.DataFrame, period: list[str], asof: DateTimeType) -> pd.DataFrame:
-        norm = normalize(df)
+    def compute(
+        cls, df: pd.DataFrame, period: list[str], asof: DateTimeType, to_symbol: str | None = "BTC/USDT"
+    ) -> pd.DataFrame:
+        """Pmom of the klines df, to_symbol None if df is normalized already, e.g. read from `XrateBinance`."""
+        norm = normalize(df, to_symbol=to_symbol) if to_symbol is not None else df
         pmom = momentum(norm, period, asof=asof)
         pmom = pmom.melt(ignore_index=False, var_name="Period", value_name="Pmom")
         pmom["Timestamp"] = asof
         pmom = pmom.reset_index()
         return pmom
 
+    @classmethod
+    @validate
+    def compute_range(
+        cls, df: pd.DataFrame, period: list[str], asofs: pd.DatetimeIndex, to_symbol: str | None = "BTC/USDT"
+    ) -> pd.DataFrame:
+        """Same as `compute` for every asof in `asofs`, pivoting `df` only once."""
+        prices = pivot(df, to_symbol=to_symbol)
+        pmom = momentum_range(prices, period, asofs)
+        return pmom
+
+    @classmethod
+    @validate
+    def iter_compute_range(
+        cls,
+        df: pd.DataFrame,
+        period: list[str],
+        asofs: pd.DatetimeIndex,
+        max_workers: int,
+        to_symbol: str | None = "BTC/USDT",
+    ) -> Iterator[pd.DataFrame]:
+        """Same as `compute_range`, computed in `max_workers` processes and yielded shard by shard."""
+        prices = pivot(df, to_symbol=to_symbol)
+        yield from iter_momentum_range(prices, period, asofs, max_workers)
+
 
 class Pmom:
     @classmethod
@@ -220,4 +671,4 @@ class Pmom:
         return df
 
 
-__all__ = ["Pmom", "PmomBinance"]
+__all__ = ["Pmom", "PmomArray", "PmomBinance"]
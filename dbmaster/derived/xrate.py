@@ -0,0 +1,208 @@
+"""
+Cross rate Implementation, prices of the symbols in BTC instead of USDT
+"""
+
+import logging
+import time
+from typing import Iterator, Literal, Sequence
+
+import pandas as pd
+from retry import retry
+import sqlalchemy as sa
+from sqlalchemy import Column, DateTime, Float, String
+
+from dbmaster import config
+from dbmaster.derived.base import DerivedBase
+from dbmaster.derived.pmom import normalize
+from dbmaster.util import (
+    BINANCE_KLINE_FREQ,
+    BinanceCurrencyType,
+    BinanceFreqType,
+    create_engine,
+    validate,
+    DateTimeType,
+    IfRowExistsType,
+    to_list,
+)
+
+
+logger = logging.getLogger(__name__)
+
+engine = create_engine(config.derived.xrate or config.derived.pmom)
+metadata = sa.MetaData()
+
+COLUMNS = ["Symbol", "OpenTime", "Open"]
+
+
+def xrate_table(freq: str, metadata: sa.MetaData) -> sa.Table:
+    """Table of cross rates of klines of freq, e.g. the Open of ETH/BTC, and of BTC/USDT itself."""
+    return sa.Table(
+        f"xrate_binance_{freq}",
+        metadata,
+        Column("Symbol", String, primary_key=True),
+        Column("OpenTime", DateTime, primary_key=True),
+        Column("Open", Float),
+    )
+
+
+def coverage_table(metadata: sa.MetaData) -> sa.Table:
+    """Intervals of klines the cross rates were computed from, per kline symbol (e.g. BTCUSDT) and freq, Start and
+    End are the OpenTime of the first and last kline of an interval. Compared with the coverage index of the klines
+    by `dbmaster compute xrate --incremental` to find the klines stored since.
+    """
+    return sa.Table(
+        "xrate_binance_coverage",
+        metadata,
+        Column("Symbol", String, primary_key=True),
+        Column("Freq", String, primary_key=True),
+        Column("Start", DateTime, primary_key=True),
+        Column("End", DateTime),
+    )
+
+
+class XrateBinance(DerivedBase):
+    """Klines normalized by BTC/USDT once per bar, so that pmom and other cross rate datasets read them instead of
+    joining every symbol against BTC/USDT in each run. Kept up to date by `dbmaster compute xrate`.
+    """
+
+    table = [xrate_table(freq, metadata) for freq in BINANCE_KLINE_FREQ] + [coverage_table(metadata)]
+
+    @classmethod
+    def __initialize__(cls, engine=engine, metadata=metadata) -> None:
+        cls.engine = engine
+        cls.metadata = metadata
+
+    @classmethod
+    @validate
+    def get(
+        cls,
+        symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None,
+        freq: BinanceFreqType,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        reader: Literal["fast", "pandas"] = "fast",
+    ) -> pd.DataFrame:
+        """Get cross rates of freq.
+        Returns:
+            pd.DataFrame: columns of Symbol, OpenTime, Open.
+        """
+        sql = cls.query(freq, symbol=symbol, datefrom=datefrom, dateto=dateto)
+        return cls.read_sql(sql) if reader == "fast" else pd.read_sql(sql, con=cls.engine)
+
+    @classmethod
+    def query(
+        cls,
+        freq: str,
+        symbol: str | Sequence[str] | None = None,
+        datefrom: pd.Timestamp | None = None,
+        dateto: pd.Timestamp | None = None,
+    ) -> sa.Select:
+        """Select all columns with the filters of `get`."""
+        table = cls.get_table(f"xrate_binance_{freq}")
+        sql = sa.select(*table.columns)
+        sql = sql.where(table.c.Symbol.in_(to_list(symbol))) if symbol else sql
+        sql = sql.where(table.c.OpenTime >= datefrom.to_pydatetime()) if datefrom else sql
+        sql = sql.where(table.c.OpenTime <= dateto.to_pydatetime()) if dateto else sql
+        return sql
+
+    @classmethod
+    @validate
+    def iter_get(
+        cls,
+        symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None,
+        freq: BinanceFreqType,
+        datefrom: DateTimeType | None = None,
+        dateto: DateTimeType | None = None,
+        chunk_rows: int = 1_000_000,
+    ) -> Iterator[pd.DataFrame]:
+        """Same as `get`, yielding consecutive time windows with all symbols of about chunk_rows rows, sorted by
+        OpenTime and Symbol.
+        """
+        table = cls.get_table(f"xrate_binance_{freq}")
+        sql = cls.query(freq, symbol=symbol, datefrom=datefrom, dateto=dateto)
+        yield from cls.iter_sql(sql.order_by(table.c.OpenTime, table.c.Symbol), by="OpenTime", chunk_rows=chunk_rows)
+
+    @classmethod
+    @validate
+    def get_watermark(
+        cls, freq: BinanceFreqType, symbol: BinanceCurrencyType | Sequence[BinanceCurrencyType] | None = None
+    ) -> pd.DataFrame:
+        """Get the latest computed OpenTime per Symbol.
+        Returns:
+            pd.DataFrame: columns of Symbol, OpenTime.
+        """
+        table = cls.get_table(f"xrate_binance_{freq}")
+        symbols = cls.distinct(table.c.Symbol, to_list(symbol) or None)  # a seek per symbol along the primary key
+        last = sa.select(sa.func.max(table.c.OpenTime)).where(table.c.Symbol == symbols.c.Symbol).scalar_subquery()
+        sql = sa.select(symbols.c.Symbol, last.label("OpenTime")).where(last.is_not(None)).order_by(symbols.c.Symbol)
+        return cls.read_sql(sql)
+
+    @classmethod
+    @validate
+    def get_coverage(cls, freq: BinanceFreqType, symbol: str | Sequence[str] | None = None) -> pd.DataFrame:
+        """Get the intervals of klines the cross rates were computed from.
+        Args:
+            symbol (str | list[str]): kline symbols, e.g. BTCUSDT.
+        Returns:
+            pd.DataFrame: columns of Symbol, Start, End, the OpenTime of the first and last kline of each interval.
+        """
+        table = cls.get_table("xrate_binance_coverage")
+        sql = sa.select(table.c.Symbol, table.c.Start, table.c.End).where(table.c.Freq == freq)
+        sql = sql.where(table.c.Symbol.in_(to_list(symbol))) if symbol else sql
+        df = pd.read_sql(sql.order_by(table.c.Symbol, table.c.Start), con=cls.engine)
+        return df.astype({"Start": "datetime64[ns]", "End": "datetime64[ns]"})
+
+    @classmethod
+    def add_coverage(cls, intervals: pd.DataFrame, freq: str) -> None:
+        """Merge intervals of klines the cross rates were computed from, see `get_coverage`."""
+        from dbmaster.catalog.kline import merge_intervals
+
+        if intervals.empty:
+            return
+        table = cls.get_table("xrate_binance_coverage")
+        new = intervals[["Symbol", "Start", "End"]]
+        where = sa.and_(table.c.Freq == freq, table.c.Symbol.in_(new["Symbol"].unique().tolist()))
+        with cls.engine.begin() as conn:
+            old = pd.read_sql(sa.select(table.c.Symbol, table.c.Start, table.c.End).where(where), con=conn)
+            old = old.astype({"Start": "datetime64[ns]", "End": "datetime64[ns]"})
+            intervals = merge_intervals(pd.concat([old, new], ignore_index=True), freq)
+            conn.execute(table.delete().where(where))
+            conn.execute(table.insert(), intervals.assign(Freq=freq).to_dict("records"))
+
+    @classmethod
+    @validate
+    @retry(sa.exc.OperationalError, tries=3, logger=logger)
+    def set(
+        cls, df: pd.DataFrame, freq: BinanceFreqType, if_row_exists: IfRowExistsType = IfRowExistsType.INSERT, **kwargs
+    ) -> int:
+        logger.debug(f"{cls.__name__}.set({freq=}, {df.shape=}, {if_row_exists=})")
+        table_name = f"xrate_binance_{freq}"
+        if df.empty:
+            return 0
+        try:
+            res = cls.upsert(cls.get_table(table_name), df[COLUMNS], if_row_exists)
+        except sa.exc.OperationalError as e:
+            time.sleep(5)
+            raise Exception(str(e)[:80] + " ...") from e
+        else:
+            logger.info(
+                f"Inserted {res} rows to {table_name}. OpenTime={df["OpenTime"].min()} - {df["OpenTime"].max()}"
+            )
+            return res
+
+    @classmethod
+    @validate
+    def compute(cls, df: pd.DataFrame, to_symbol: str = "BTC/USDT") -> pd.DataFrame:
+        """Cross rates of klines, see `normalize`.
+        Args:
+            df (pd.DataFrame): columns of Symbol e.g. ETH/USDT, OpenTime, Open, with every OpenTime of to_symbol.
+        Returns:
+            pd.DataFrame: columns of Symbol e.g. ETH/BTC, OpenTime, Open. No row where to_symbol has no kline, those
+                are computed once it is stored, e.g. by `repair kline`.
+        """
+        base = df.loc[df["Symbol"] == to_symbol, "OpenTime"]
+        xrate = normalize(df.loc[df["OpenTime"].isin(base), COLUMNS], to_symbol=to_symbol)[COLUMNS]
+        return xrate.sort_values(["OpenTime", "Symbol"], ignore_index=True)
+
+
+__all__ = ["XrateBinance"]
@@ -0,0 +1,241 @@
+"""
+Timing and throughput of the stages of a command
+
+Stages:
+    - read: klines read from the catalog
+    - fetch: requests to the vendor of a symbol, including the waits of the request weight limit
+    - throttle: waits for the request weight limit of the vendor
+    - transform: raw vendor data or stored klines turned into the DataFrame to write
+    - lock_wait: producers blocked while the single writer falls behind
+    - write: write transactions to the database
+    - compute: computation of derived data
+"""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+from dbmaster import config
+
+logger = logging.getLogger(__name__)
+
+STAGE_HELP = {
+    "seconds": "Seconds spent in the stage",
+    "rows": "Rows processed by the stage",
+    "spans": "Spans of the stage",
+}
+COMMAND_HELP = {"duration_seconds": "Seconds of the last run", "last_run_timestamp_seconds": "Start of the last run"}
+
+
+def _total() -> dict[str, float]:
+    return {"spans": 0, "seconds": 0.0, "rows": 0}
+
+
+@dataclass
+class Span:
+    stage: str
+    labels: dict[str, str]
+    start: float  # epoch seconds
+    seconds: float = 0.0
+    rows: int = 0
+
+
+@dataclass
+class Recording:
+    """Spans recorded while a command ran."""
+
+    command: str
+    start: float = field(default_factory=time.time)
+    seconds: float = 0.0
+    spans: list[Span] = field(default_factory=list)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Totals by stage, seconds are summed over the threads running the stage at once."""
+        summary = defaultdict(_total)
+        for span in self.spans:
+            total = summary[span.stage]
+            total["spans"] += 1
+            total["seconds"] += span.seconds
+            total["rows"] += span.rows
+        for total in summary.values():
+            total["rows_per_second"] = total["rows"] / total["seconds"] if total["seconds"] else 0.0
+        return dict(summary)
+
+    def format(self) -> str:
+        lines = [f"{self.command} took {self.seconds:.3f}s"]
+        lines.append(f"{'stage':<10} {'spans':>8} {'seconds':>10} {'rows':>12} {'rows/s':>12}")
+        for stage, total in self.summary().items():
+            lines.append(
+                f"{stage:<10} {total['spans']:>8} {total['seconds']:>10.3f} {total['rows']:>12} {total['rows_per_second']:>12.0f}"
+            )
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "command": self.command,
+            "start": self.start,
+            "seconds": self.seconds,
+            "summary": self.summary(),
+            "spans": [asdict(span) for span in self.spans],
+        }
+
+
+class Metrics:
+    """Spans of the process, kept by every recording running when they end.
+
+    Spans carry no reference to the command they belong to, so commands running at once, e.g. jobs of
+    `dbmaster serve`, share their spans while they overlap.
+
+    Usage:
+        with metrics.span("fetch", symbol="BTCUSDT") as span:
+            df = fetch()
+            span.rows = df.shape[0]
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recordings: list[Recording] = []
+        self.totals: dict[tuple[str, str], dict[str, float]] = defaultdict(_total)  # by command and stage
+        self.last_run: dict[str, Recording] = {}
+
+    def add(self, span: Span) -> None:
+        with self.lock:
+            for recording in self.recordings:
+                recording.spans.append(span)
+
+    @contextmanager
+    def span(self, stage: str, **labels: Any) -> Iterator[Span]:
+        """Time the block as a span of stage, rows is set by the block."""
+        span = Span(stage, {key: str(value) for key, value in labels.items()}, time.time())
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.add(span)
+
+    def record(self, stage: str, seconds: float, rows: int = 0, **labels: Any) -> None:
+        """Add a span of stage that ended now."""
+        labels = {key: str(value) for key, value in labels.items()}
+        self.add(Span(stage, labels, time.time() - seconds, seconds, rows))
+
+    def iter(self, stage: str, iterable: Iterable, **labels: Any) -> Iterator:
+        """Yield from iterable, the production of each item recorded as a span of stage with its len as rows."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(stage, time.perf_counter() - start, len(item), **labels)
+            yield item
+
+    @contextmanager
+    def collect(self, command: str) -> Iterator[Recording]:
+        """Record the spans ending in the block."""
+        recording = Recording(command)
+        start = time.perf_counter()
+        with self.lock:
+            self.recordings.append(recording)
+        try:
+            yield recording
+        finally:
+            recording.seconds = time.perf_counter() - start
+            with self.lock:
+                self.recordings.remove(recording)
+                for stage, total in recording.summary().items():
+                    for key in ("spans", "seconds", "rows"):
+                        self.totals[command, stage][key] += total[key]
+                self.last_run[command] = recording
+
+    def to_prometheus(self) -> str:
+        """Totals by command and stage since the process started, in Prometheus text format."""
+        with self.lock:
+            totals, last_run = dict(self.totals), dict(self.last_run)
+        lines = []
+        for key, doc in STAGE_HELP.items():
+            lines += [f"# HELP dbmaster_stage_{key}_total {doc}.", f"# TYPE dbmaster_stage_{key}_total counter"]
+            for (command, stage), total in sorted(totals.items()):
+                lines.append(f'dbmaster_stage_{key}_total{{command="{command}",stage="{stage}"}} {total[key]}')
+        for key, doc in COMMAND_HELP.items():
+            lines += [f"# HELP dbmaster_command_{key} {doc}.", f"# TYPE dbmaster_command_{key} gauge"]
+            for command, recording in sorted(last_run.items()):
+                value = recording.seconds if key == "duration_seconds" else recording.start
+                lines.append(f'dbmaster_command_{key}{{command="{command}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def export(recording: Recording) -> None:
+    """Append recording to `metrics.json_path`, and write the totals to `metrics.prometheus_path` in config."""
+    if config.metrics.json_path:
+        with open(config.metrics.json_path, "a") as f:
+            f.write(json.dumps(recording.to_dict()) + "\n")
+    if config.metrics.prometheus_path:
+        path = Path(config.metrics.prometheus_path)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(metrics.to_prometheus())
+        os.replace(tmp, path)  # the textfile collector never reads a partial file
+
+
+def instrument(command: str) -> Callable:
+    """Decorator recording the spans of a command, logging their summary and exporting them when it ends."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                with metrics.collect(command) as recording:
+                    return func(*args, **kwargs)
+            finally:
+                logger.info(f"Metrics of {recording.format()}")
+                export(recording)
+
+        return wrapper
+
+    return decorator
+
+
+class Profiler:
+    """cProfile of a run, saved as a pstats file. Worker threads are profiled too, cProfile is process wide
+    since Python 3.12.
+
+    Usage:
+        profiler = Profiler("run.prof")
+        profiler.start()
+        ...
+        profiler.stop()  # view with `python -m pstats run.prof` or snakeviz
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.profile = cProfile.Profile()
+
+    def start(self) -> None:
+        self.profile.enable()
+
+    def stop(self, top: int = 20) -> None:
+        """Save the profile to path and print the top functions by cumulative time."""
+        self.profile.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.dump_stats(self.path)
+        stats.sort_stats("cumulative").print_stats(top)
+        print(f"Profile saved to {self.path}\n{stream.getvalue()}")
+
+
+__all__ = ["Metrics", "Profiler", "Recording", "Span", "instrument", "metrics"]
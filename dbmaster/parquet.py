@@ -0,0 +1,137 @@
+"""
+Parquet storage partitioned by symbol and month
+
+requires `pip install dbmaster[parquet]`
+"""
+
+import logging
+import os
+from pathlib import Path
+from typing import Iterator, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from dbmaster.util import IfRowExistsType
+
+logger = logging.getLogger(__name__)
+
+
+class ParquetStore:
+    """Tables of parquet files under a root directory, one file per symbol and month:
+        {root}/{table}/Symbol={symbol}/Month={YYYY-MM}/part-0.parquet
+
+    Writing a month only rewrites the file of that month, reading only opens the files of the requested symbols
+    and months, and only the requested columns.
+    """
+
+    partitioning = ds.partitioning(pa.schema([("Symbol", pa.string()), ("Month", pa.string())]), flavor="hive")
+
+    def __init__(self, root: str | Path, symbol_col: str = "Symbol", time_col: str = "OpenTime"):
+        self.root = Path(root)
+        self.symbol_col = symbol_col
+        self.time_col = time_col
+
+    def _file(self, table: str, symbol: str, month: str) -> Path:
+        return self.root / table / f"{self.symbol_col}={symbol}" / f"Month={month}" / "part-0.parquet"
+
+    def read(
+        self,
+        table: str,
+        columns: Sequence[str],
+        symbol: Sequence[str] | None = None,
+        datefrom: pd.Timestamp | None = None,
+        dateto: pd.Timestamp | None = None,
+    ) -> pd.DataFrame:
+        """Read columns of table, sorted by symbol and time, the same as the primary key order in sqlite."""
+        keys = [self.symbol_col, self.time_col]
+        path = self.root / table
+        if not path.exists():
+            return pd.DataFrame(columns=columns)
+
+        dataset = ds.dataset(path, format="parquet", partitioning=self.partitioning)
+        expr = ds.scalar(True)
+        expr = expr & ds.field(self.symbol_col).isin(list(symbol)) if symbol else expr
+        if datefrom is not None:
+            expr = expr & (ds.field("Month") >= datefrom.strftime("%Y-%m"))
+            expr = expr & (ds.field(self.time_col) >= pa.scalar(datefrom.to_datetime64(), pa.timestamp("ns")))
+        if dateto is not None:
+            expr = expr & (ds.field("Month") <= dateto.strftime("%Y-%m"))
+            expr = expr & (ds.field(self.time_col) <= pa.scalar(dateto.to_datetime64(), pa.timestamp("ns")))
+
+        data = dataset.to_table(columns=list(dict.fromkeys([*keys, *columns])), filter=expr)
+        df = data.sort_by([(col, "ascending") for col in keys]).to_pandas()
+        return df[list(columns)]
+
+    def write(self, table: str, df: pd.DataFrame, if_row_exists: IfRowExistsType) -> int:
+        """Write df to the files of its symbols and months, rows already existed are resolved by `if_row_exists`.
+        With RAISE, raises IntegrityError as the sqlite backend does, nothing is written.
+        Returns:
+            int: number of rows written.
+        """
+        months = df[self.time_col].dt.strftime("%Y-%m")
+        parts, n_existed = [], 0
+        for (symbol, month), new in df.groupby([self.symbol_col, months], sort=False):
+            file = self._file(table, symbol, month)
+            old = pd.read_parquet(file) if file.exists() else None
+            existed = new[self.time_col].isin(old[self.time_col]) if old is not None else new[self.time_col].isna()
+            n_existed += existed.sum()
+            parts.append((file, old, new.drop(columns=self.symbol_col), existed))
+
+        if n_existed and if_row_exists is IfRowExistsType.RAISE:
+            raise sa.exc.IntegrityError(
+                f"write {table}", None, ValueError(f"{n_existed} rows already exist in {table}.")
+            )
+        if n_existed and if_row_exists is IfRowExistsType.IGNORE:
+            return 0
+
+        res = 0
+        for file, old, new, existed in parts:
+            if if_row_exists is IfRowExistsType.DROP and old is not None:
+                old = old.loc[~old[self.time_col].isin(new[self.time_col])]
+            elif if_row_exists is not IfRowExistsType.DROP:
+                new = new.loc[~existed]
+            if new.empty:
+                continue
+            data = pd.concat([old, new]) if old is not None else new
+            data = data.sort_values(self.time_col, ignore_index=True)
+
+            file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = file.with_suffix(".tmp")
+            pq.write_table(pa.Table.from_pandas(data, preserve_index=False), tmp, compression="zstd")
+            os.replace(tmp, file)
+            res += new.shape[0]
+        return res
+
+    def _months(self, table: str, symbol: Sequence[str] | None = None) -> Iterator[tuple[str, list[Path]]]:
+        """Sorted files of each symbol"""
+        for path in sorted((self.root / table).glob(f"{self.symbol_col}=*")):
+            sym = path.name.split("=", maxsplit=1)[1]
+            months = sorted(path.glob("Month=*/part-0.parquet"))
+            if (symbol and sym not in symbol) or not months:
+                continue
+            yield sym, months
+
+    def get_watermark(self, table: str, symbol: Sequence[str] | None = None) -> pd.DataFrame:
+        """Get the latest time per symbol, from the last month of each symbol."""
+        watermark = []
+        for sym, months in self._months(table, symbol):
+            time = pq.read_table(months[-1], columns=[self.time_col])[self.time_col]
+            watermark.append({self.symbol_col: sym, self.time_col: pd.Timestamp(time.to_pandas().max())})
+        return pd.DataFrame(watermark, columns=[self.symbol_col, self.time_col])
+
+    def get_time_range(
+        self, table: str, symbol: Sequence[str] | None = None
+    ) -> tuple[pd.Timestamp | None, pd.Timestamp | None]:
+        """Get the earliest and latest time across symbols, from the first and last month of each symbol."""
+        first, last = [], []
+        for _, months in self._months(table, symbol):
+            first.append(pq.read_table(months[0], columns=[self.time_col])[self.time_col].to_pandas().min())
+            last.append(pq.read_table(months[-1], columns=[self.time_col])[self.time_col].to_pandas().max())
+        return (pd.Timestamp(min(first)), pd.Timestamp(max(last))) if first else (None, None)
+
+
+__all__ = ["ParquetStore"]
@@ -0,0 +1,24 @@
+"""
+Declarative registry of datasets and vendors
+
+Classes are referenced by import path and only imported when resolved, so commands like `list` start
+without importing pandas, SQLAlchemy or the vendor SDKs.
+"""
+
+import importlib
+
+CATALOG = {"kline": {"binance": "dbmaster.catalog.kline:KlineBinance"}}
+DERIVED = {
+    "pmom": {"binance": "dbmaster.derived.pmom:PmomBinance"},
+    "xrate": {"binance": "dbmaster.derived.xrate:XrateBinance"},
+}
+VENDOR = {"binance": "dbmaster.vendor.binance:Binance"}
+
+
+def resolve(path: str) -> type:
+    """Import the class of a registry entry, e.g. "dbmaster.vendor.binance:Binance"."""
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+__all__ = ["CATALOG", "DERIVED", "VENDOR", "resolve"]
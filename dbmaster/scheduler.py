@@ -0,0 +1,166 @@
+"""
+In-process job scheduler of `dbmaster serve`
+"""
+
+import datetime as dt
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+
+import pandas as pd
+
+from dbmaster.config import JobConfig
+
+logger = logging.getLogger(__name__)
+
+
+class Cron:
+    """Cron expression of 5 fields: minute hour day month weekday (0 or 7 is Sunday).
+    A field is `*`, a value, a range `a-b`, a step `*/n` or `a-b/n`, or a list of them separated by commas.
+    As in cron, a time matches either the day or the weekday when both are restricted.
+    """
+
+    fields = [("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7)]
+
+    def __init__(self, expr: str):
+        parts = expr.split()
+        if len(parts) != len(self.fields):
+            raise ValueError(f"Invalid cron {expr=}, expected 5 fields")
+        self.expr = expr
+        self.minute, self.hour, self.day, self.month, weekday = [
+            self._parse(part, *field) for part, field in zip(parts, self.fields)
+        ]
+        self.weekday = {value % 7 for value in weekday}
+        self.any_day, self.any_weekday = parts[2] == "*", parts[4] == "*"
+
+    @staticmethod
+    def _parse(part: str, name: str, low: int, high: int) -> set[int]:
+        values = set()
+        for item in part.split(","):
+            value, _, step = item.partition("/")
+            if value == "*":
+                start, end = low, high
+            elif "-" in value:
+                start, end = map(int, value.split("-"))
+            else:
+                start = end = int(value)
+                end = high if step else end
+            if not low <= start <= end <= high or (step and int(step) < 1):
+                raise ValueError(f"Invalid cron {name}={item!r}, expected values in [{low}, {high}]")
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def _match_day(self, time: dt.datetime) -> bool:
+        day, weekday = time.day in self.day, time.isoweekday() % 7 in self.weekday
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after: dt.datetime) -> dt.datetime:
+        """The first matching minute after `after`."""
+        time = after.replace(second=0, microsecond=0) + dt.timedelta(minutes=1)
+        while time.year <= after.year + 8:  # Feb 29 on a Sunday may take years
+            if time.month not in self.month:
+                time = (time.replace(day=1) + dt.timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._match_day(time):
+                time = (time + dt.timedelta(days=1)).replace(hour=0, minute=0)
+            elif time.hour not in self.hour:
+                time = (time + dt.timedelta(hours=1)).replace(minute=0)
+            elif time.minute not in self.minute:
+                time += dt.timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError(f"cron {self.expr!r} never matches")
+
+
+def resolve_kwargs(kwargs: dict[str, Any], now: dt.datetime) -> dict[str, Any]:
+    """Arguments of a run, datefrom/dateto like "-1d" become times relative to now."""
+    kwargs = dict(kwargs)
+    for key in ("datefrom", "dateto"):
+        if isinstance(kwargs.get(key), str) and kwargs[key].startswith("-"):
+            kwargs[key] = (pd.Timestamp(now) + pd.Timedelta(kwargs[key])).strftime("%Y-%m-%d %H:%M:%S")
+    return kwargs
+
+
+class Scheduler:
+    """Run jobs on their cron schedules in a pool of `max_concurrent_jobs` threads of this process,
+    so engines, HTTP sessions and caches stay warm across runs.
+    A run that is due while the previous run of the same job is still going is skipped.
+
+    Usage:
+        Scheduler(config.serve.jobs, config.serve.max_concurrent_jobs).run()
+    """
+
+    def __init__(
+        self,
+        jobs: Sequence[JobConfig],
+        max_concurrent_jobs: int,
+        target: Callable[[JobConfig], Callable] | None = None,
+        clock: Callable[[], dt.datetime] = dt.datetime.now,
+    ):
+        names = [job.name for job in jobs]
+        assert len(set(names)) == len(names), f"job names must be unique, got {names}"
+        self.jobs = list(jobs)
+        self.crons = {job.name: Cron(job.schedule) for job in jobs}
+        self.target = target or self._command
+        self.clock = clock
+        self.executor = ThreadPoolExecutor(max_concurrent_jobs, thread_name_prefix="Job")
+        self.running: dict[str, Future] = {}
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def _command(job: JobConfig) -> Callable:
+        from dbmaster.command import Compute, Repair, Update
+
+        group = {"update": Update, "compute": Compute, "repair": Repair}[job.command]()
+        return getattr(group, job.dataset)
+
+    def _run(self, job: JobConfig, time: dt.datetime) -> None:
+        kwargs = resolve_kwargs(job.kwargs, time)
+        logger.info(f"Running job {job.name} scheduled at {time}, {kwargs=}")
+        start = self.clock()
+        try:
+            self.target(job)(**kwargs)
+        except Exception:
+            logger.exception(f"Job {job.name} scheduled at {time} failed")
+        else:
+            logger.info(f"Job {job.name} scheduled at {time} done in {self.clock() - start}")
+
+    def submit(self, job: JobConfig, time: dt.datetime) -> Future | None:
+        """Run job in the pool, unless its previous run is still going."""
+        previous = self.running.get(job.name)
+        if previous is not None and not previous.done():
+            logger.warning(f"Skipped job {job.name} scheduled at {time}, the previous run is still going")
+            return None
+        self.running[job.name] = future = self.executor.submit(self._run, job, time)
+        return future
+
+    def run(self, run_now: bool = False) -> None:
+        """Run until `stop`, `run_now` runs every job once at start."""
+        now = self.clock()
+        if run_now:
+            for job in self.jobs:
+                self.submit(job, now)
+        due = {job.name: self.crons[job.name].next(now) for job in self.jobs}
+        logger.info(f"Serving {len(self.jobs)} jobs, next runs: {due}")
+        try:
+            while self.jobs and not self.stopped.is_set():
+                time = min(due.values())
+                wait = (time - self.clock()).total_seconds()
+                if wait > 0:
+                    self.stopped.wait(min(wait, 60))  # wake up regularly, in case the clock jumped
+                    continue
+                for job in self.jobs:
+                    if due[job.name] == time:
+                        self.submit(job, time)
+                        # runs missed while the process was suspended are not caught up one by one
+                        due[job.name] = self.crons[job.name].next(max(time, self.clock()))
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+__all__ = ["Cron", "Scheduler"]
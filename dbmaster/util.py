@@ -1,16 +1,27 @@
+import contextlib
 import datetime as dt
 from enum import Enum
 import functools
-from typing import Any, Sequence
+import json
+import logging
+import os
+from typing import Any, Iterator, Sequence
 from typing_extensions import Annotated
 import re
 import abc
+import time
 
 import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
 from pydantic import AfterValidator, validate_call
 
+import numpy as np
 import pandas as pd
 
+from dbmaster.config import DatasetConfig
+from dbmaster.registry import CATALOG, DERIVED, resolve
+
+logger = logging.getLogger(__name__)
 
 BINANCE_KLINE_FREQ = {"1m", "3m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h", "1d", "3d", "1w", "1M"}
 
@@ -31,6 +42,57 @@ def to_snake_str(camel_str: str):
     return re.sub(r"(?<!^)(?=[A-Z])", "_", camel_str).lower()
 
 
+def create_engine(dataset: DatasetConfig) -> sa.engine.Engine:
+    """Create the engine of a dataset, applying its sqlite PRAGMAs on every pooled connection.
+
+    For the parquet backend, the engine is of a `catalog.db` in its root directory, e.g. for metadata.
+    """
+    path = os.path.join(dataset.path, "catalog.db") if dataset.backend == "parquet" else dataset.path
+    if dataset.backend == "parquet":
+        os.makedirs(dataset.path, exist_ok=True)
+    engine = sa.create_engine(f"sqlite:///{path}")
+    pragmas = dataset.sqlite.model_dump(exclude_none=True)
+
+    @sa.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+def dictionary_table(name: str, metadata: sa.MetaData, column: str) -> sa.Table:
+    """Table of the distinct values of a column in compact schema, where rows refer to a value by its Id."""
+    return sa.Table(
+        name,
+        metadata,
+        sa.Column("Id", sa.Integer, primary_key=True),
+        sa.Column(column, sa.String, nullable=False, unique=True),
+    )
+
+
+def to_epoch_ms(time: pd.Series) -> pd.Series:
+    """Datetimes to integer milliseconds since epoch, how compact schema stores them."""
+    return time.astype("datetime64[ms]").astype("int64")
+
+
+def from_epoch_ms(ms: pd.Series) -> pd.Series:
+    """Integer milliseconds since epoch back to datetime64[ns]."""
+    return pd.to_datetime(ms, unit="ms").astype("datetime64[ns]")
+
+
+def to_sql_datetime(time: pd.Series) -> np.ndarray:
+    """Datetimes as the text stored by SQLAlchemy, e.g. "2024-01-01 00:00:00.000000", NaT as None.
+    Each distinct value is formatted once, the klines of many symbols share their times.
+    """
+    codes, uniques = pd.factorize(time, use_na_sentinel=False)
+    text = np.datetime_as_string(uniques.to_numpy().astype("datetime64[us]"), unit="us")
+    text = pd.Series(text).str.replace("T", " ", regex=False).where(pd.notna(uniques), None)
+    return text.to_numpy()[codes]
+
+
 def get_subclasses(cls: type):
     for subclass in cls.__subclasses__():
         yield from get_subclasses(subclass)
@@ -42,11 +104,16 @@ def _check_binance_freq(freq: str):
     return freq
 
 
-def _check_binance_symbol(symbol: str):
+def to_binance_symbol(symbol: str) -> str:
+    """Symbol as named by Binance, e.g. "BTC/USDT" or "btc-usdt" to "BTCUSDT"."""
     symbol = symbol.replace("/", "").replace("-", "")
     return symbol.upper()
 
 
+def _check_binance_symbol(symbol: str):
+    return to_binance_symbol(symbol)
+
+
 def _check_binance_currency(currency: str):
     if currency.endswith("USDT") and "/" not in currency:
         currency = currency.replace("USDT", "/USDT")
@@ -102,6 +169,7 @@ class DatasetBase(abc.ABC):
     table: sa.Table | Sequence[sa.Table] = NotImplemented  # table(s) in the dataset
 
     names = set()
+    _codes = {}  # ids of dictionary tables by (database, table), see get_codes
 
     def __init_subclass__(cls, **kwargs) -> None:
         super().__init_subclass__(**kwargs)
@@ -125,8 +193,7 @@ class DatasetBase(abc.ABC):
         cls.__initialize__()
 
         for table in to_list(cls.table):
-            table.metadata = cls.metadata
-        cls.metadata.create_all(cls.engine, checkfirst=True)
+            table.metadata = cls.metadata  # created on first use, see get_table
 
     @classmethod
     @abc.abstractmethod
@@ -144,19 +211,264 @@ class DatasetBase(abc.ABC):
         pass
 
     @classmethod
-    @functools.cache
+    def upsert(
+        cls, table: sa.Table, df: pd.DataFrame, if_row_exists: IfRowExistsType, conn: sa.Connection | None = None
+    ) -> int:
+        """Write all rows of df to table as a single statement in one transaction.
+        Args:
+            if_row_exists (IfRowExistsType): what to do with rows whose primary key already exists.
+                RAISE: raise IntegrityError, nothing is written.
+                IGNORE: ignore the whole df, nothing is written.
+                INSERT: only insert the rows not existed yet.
+                DROP: replace the existed rows by the new ones.
+            conn (sa.Connection): write in the transaction of conn instead of a new one.
+                IGNORE then raises IntegrityError too, the caller rolls back the rows written before it.
+        Returns:
+            int: number of rows written.
+        """
+        keys = [col.name for col in table.primary_key]
+        values = [col for col in df.columns if col not in keys]
+        sql = sqlite.insert(table)
+        if if_row_exists is IfRowExistsType.INSERT or (if_row_exists is IfRowExistsType.DROP and not values):
+            sql = sql.on_conflict_do_nothing(index_elements=keys)
+        elif if_row_exists is IfRowExistsType.DROP:
+            sql = sql.on_conflict_do_update(index_elements=keys, set_={col: sql.excluded[col] for col in values})
+        elif if_row_exists not in (IfRowExistsType.RAISE, IfRowExistsType.IGNORE):
+            raise ValueError(f"Invalid {if_row_exists=}.")
+
+        # bypass SQLAlchemy's per-value processing, datetimes are stored as text in the same format as it does,
+        # whatever their dtype, e.g. Timestamps of an object column, or they would not match the stored keys
+        sql = sql.compile(dialect=cls.engine.dialect, column_keys=list(df.columns))
+        datetimes = [col for col in df.columns if isinstance(table.c[col].type, sa.DateTime)]
+        df = df.assign(**{col: to_sql_datetime(pd.to_datetime(df[col])) for col in datetimes})
+        params = list(zip(*(df[col].tolist() for col in sql.positiontup)))
+        try:
+            with contextlib.nullcontext(conn) if conn is not None else cls.engine.begin() as transaction:
+                res = transaction.exec_driver_sql(sql.string, params)
+        except sa.exc.IntegrityError:
+            if if_row_exists is IfRowExistsType.IGNORE and conn is None:
+                return 0
+            raise
+        return res.rowcount
+
+    @classmethod
+    def get_codes(
+        cls, table: sa.Table, values: Sequence[str] = (), create: bool = False, refresh: bool = False
+    ) -> pd.Series:
+        """Get Ids of a dictionary table, indexed by value. Ids never change once assigned, so they are cached.
+        Args:
+            values (Sequence[str]): values needed, reloaded from database if any is not cached.
+            create (bool): add the values not in the table yet.
+            refresh (bool): reload from database anyway, e.g. to decode Ids added by another process.
+        """
+        key = (str(cls.engine.url), table.name)
+        column = table.columns[1]
+        codes = cls._codes.get(key)
+        missing = set(values) - set(codes.index) if codes is not None else set(values)
+        if codes is None or missing or refresh:
+            if missing and create:
+                with cls.engine.begin() as conn:
+                    conn.execute(sqlite.insert(table).on_conflict_do_nothing(), [{column.name: v} for v in missing])
+            codes = pd.read_sql(sa.select(table.c.Id, column), con=cls.engine).set_index(column.name)["Id"]
+            cls._codes[key] = codes
+        return codes
+
+    @classmethod
+    def decode_codes(cls, table: sa.Table, ids: pd.Series) -> pd.Series:
+        """Values of the Ids of a dictionary table."""
+        codes = cls.get_codes(table)
+        if not ids.isin(codes.values).all():
+            codes = cls.get_codes(table, refresh=True)
+        return ids.map(pd.Series(codes.index, index=codes.values))
+
+    @classmethod
+    def iter_table(cls, table: sa.Table, batch_rows: int) -> Iterator[pd.DataFrame]:
+        """Read all rows of table in batches of batch_rows, paging along its primary key."""
+        keys = list(table.primary_key)
+        sql = sa.select(*table.columns).order_by(*keys).limit(batch_rows)
+        last = None
+        while True:
+            df = cls.read_sql(sql if last is None else sql.where(sa.tuple_(*keys) > tuple(last)))
+            if df.empty:
+                return
+            yield df
+            last = [
+                value.item() if isinstance(value, np.generic) else value
+                for value in df[[k.name for k in keys]].iloc[-1]
+            ]
+
+    @classmethod
+    def distinct(cls, column: sa.Column, values: list | None = None) -> sa.Subquery:
+        """Distinct values of column as a subquery with one column of its name, values if given (stored or not).
+        Without values, they are found by skipping from one to the next along the index led by column, a seek
+        per value instead of a scan of all rows. Correlated to it, per value min/max subqueries of the next
+        column of the index are seeks too, where a GROUP BY scans every row.
+        """
+        if values is not None:
+            value = sa.func.json_each(json.dumps(values)).table_valued("value").c.value
+            return sa.select(sa.type_coerce(value, column.type).label(column.name)).subquery(f"{column.name}s")
+        found = sa.select(sa.func.min(column).label(column.name)).cte(f"{column.name}s", recursive=True)
+        following = sa.select(sa.func.min(column)).where(column > found.c[column.name]).scalar_subquery()
+        found = found.union_all(sa.select(following).where(found.c[column.name].is_not(None)))
+        return sa.select(found.c[column.name]).where(found.c[column.name].is_not(None)).subquery()
+
+    @classmethod
+    def explain(cls, method: str = "get", **kwargs) -> list[tuple[str, pd.DataFrame]]:
+        """Call a method of the dataset, and get the query plan of each SELECT it ran.
+        Returns:
+            list[tuple[str, pd.DataFrame]]: the statement and its plan of columns id, parent, detail,
+                see https://sqlite.org/eqp.html
+        """
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                statements.append((statement, parameters))
+
+        sa.event.listen(cls.engine, "before_cursor_execute", record)
+        try:
+            res = getattr(cls, method)(**kwargs)
+            if isinstance(res, Iterator):
+                for _ in res:
+                    pass
+        finally:
+            sa.event.remove(cls.engine, "before_cursor_execute", record)
+
+        plans = []
+        with cls.engine.connect() as conn:
+            for statement, parameters in statements:
+                rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+                plan = pd.DataFrame([row[:2] + row[-1:] for row in rows], columns=["id", "parent", "detail"])
+                plans.append((statement, plan))
+        return plans
+
+    @classmethod
+    def vacuum(cls) -> None:
+        """Rebuild the database file, returning the pages of dropped tables to the filesystem."""
+        with cls.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+
+    @classmethod
+    def missing_indexes(cls, engine: sa.Engine | None = None) -> list[sa.Index]:
+        """Indexes declared by the existing tables of the dataset but not in the database, e.g. added after a table
+        was created by an older version.
+        """
+        inspector = sa.inspect(engine or cls.engine)
+        missing = []
+        for table in to_list(cls.table):
+            if table.indexes and inspector.has_table(table.name):
+                existing = {index["name"] for index in inspector.get_indexes(table.name)}
+                missing += [index for index in table.indexes if index.name not in existing]
+        return missing
+
+    @classmethod
+    def create_indexes(cls) -> list[str]:
+        """Create the missing indexes, see `missing_indexes`. Each is built from the whole table in one transaction,
+        during which writes to the database wait.
+        Returns:
+            list[str]: names of the indexes created.
+        """
+        created = []
+        for index in cls.missing_indexes():
+            logger.info(f"Creating index {index.name} on {index.table.name}, writes to the database wait until done.")
+            start = time.perf_counter()
+            index.create(cls.engine)
+            logger.info(f"Created index {index.name} in {time.perf_counter() - start:.1f}s.")
+            created.append(index.name)
+        return created
+
+    @classmethod
+    def iter_batches(cls, sql: sa.Select, batch_rows: int = 100_000) -> Iterator[list[tuple]]:
+        """Fetch the rows of sql in batches from the DBAPI cursor, bypassing SQLAlchemy's per-value processing.
+        Yields:
+            list[tuple]: a tuple of the raw values of each column of the batch, datetimes as stored (text).
+        """
+        dialect = cls.engine.dialect
+        sql_compiled = sql.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+        to_text = sa.DateTime().dialect_impl(dialect).bind_processor(dialect)
+        params = [sql_compiled.params[name] for name in sql_compiled.positiontup]
+        params = tuple(to_text(value) if isinstance(value, dt.datetime) else value for value in params)
+
+        with cls.engine.connect() as conn:
+            cursor = conn.exec_driver_sql(sql_compiled.string, params).cursor
+            while rows := cursor.fetchmany(batch_rows):
+                yield list(zip(*rows))
+
+    @classmethod
+    def read_sql(cls, sql: sa.Select, batch_rows: int = 100_000) -> pd.DataFrame:
+        """Same as `pd.read_sql(sql, con=cls.engine)`, but bypassing SQLAlchemy's per-value processing:
+        each batch fetched from the DBAPI cursor is converted column by column into typed arrays right away,
+        datetimes (stored as text) are parsed by numpy, and the arrays of all batches are concatenated at the end.
+        """
+        columns = list(sql.selected_columns)
+        dtypes = []
+        for col in columns:
+            if isinstance(col.type, sa.DateTime):
+                dtypes.append("datetime64[ns]")
+            elif isinstance(col.type, sa.Float):
+                dtypes.append("float64")
+            elif isinstance(col.type, sa.String):
+                dtypes.append(object)
+            else:
+                dtypes.append(None)
+
+        arrays = [[] for _ in columns]
+        for batch in cls.iter_batches(sql, batch_rows):
+            for i, values in enumerate(batch):
+                arrays[i].append(np.array(values, dtype=dtypes[i]))
+        if not arrays or not arrays[0]:
+            return pd.DataFrame(columns=[col.name for col in columns])
+        return pd.DataFrame({col.name: np.concatenate(arrays[i]) for i, col in enumerate(columns)})
+
+    @classmethod
+    def iter_sql(cls, sql: sa.Select, by: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        """Stream the result of sql, which is ordered by column `by`, as DataFrames of about chunk_rows rows.
+        Rows of the same `by` value are always yielded together.
+        """
+        carry = None
+        with cls.engine.connect() as conn:
+            for df in pd.read_sql(sql, con=conn, chunksize=chunk_rows):
+                df = pd.concat([carry, df], ignore_index=True) if carry is not None else df
+                n_done = (df[by] != df[by].iloc[-1]).sum()  # rows before the last value, which may continue
+                carry = df.iloc[n_done:]
+                if n_done:
+                    yield df.iloc[:n_done]
+        if carry is not None and not carry.empty:
+            yield carry.reset_index(drop=True)
+
+    @classmethod
     def get_table(cls, name: str) -> sa.Table:
-        cls.metadata.reflect(cls.engine)
+        """Table by name, a table of the dataset is created with its indexes on first use if it does not exist yet.
+        Indexes missing from an existing table are only warned about, they are created by `create_indexes`.
+        Tables are checked once per engine, so that pointing the dataset to another database creates them there too.
+        """
+        return cls._get_table(cls.engine, name)
+
+    @classmethod
+    @functools.cache
+    def _get_table(cls, engine: sa.Engine, name: str) -> sa.Table:
+        declared = {table.name: table for table in to_list(cls.table)}
+        if name in declared:
+            declared[name].create(engine, checkfirst=True)
+            missing = [index.name for index in cls.missing_indexes(engine) if index.table.name == name]
+            if missing:
+                logger.warning(
+                    f"{name} misses indexes {missing}, create them by "
+                    f"`python -m dbmaster index {cls.name} --vendor={cls.vendor}`"
+                )
+            return declared[name]
+        cls.metadata.reflect(engine)
         return cls.metadata.tables[name]
 
 
 class DatasetFactory:
+    registry: dict[str, dict[str, str]] = {**CATALOG, **DERIVED}  # name -> vendor -> import path
+
     @classmethod
     def get(cls, name: str, vendor: str) -> DatasetBase:
-        from dbmaster.vendor import VendorFactory
-
-        vendor_name = VendorFactory.get(vendor).name
-        for sub_cls in get_subclasses(DatasetBase):
-            if sub_cls.name == name and sub_cls.vendor == vendor_name:
+        if vendor in cls.registry.get(name, {}):
+            return resolve(cls.registry[name][vendor])
+        for sub_cls in get_subclasses(DatasetBase):  # datasets defined outside the registry
+            if sub_cls.name == name and sub_cls.vendor == vendor:
                 return sub_cls
-        raise ValueError(f"Dataset={name} not implemented for {vendor_name}")
+        raise ValueError(f"Dataset={name} not implemented for {vendor}")
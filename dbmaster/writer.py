@@ -0,0 +1,112 @@
+"""
+Batching writer running in its own thread
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable
+
+import pandas as pd
+
+from dbmaster import config
+from dbmaster.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BatchWriter(threading.Thread):
+    """Single consumer of DataFrames put by many producers, writing them in large batches.
+
+    A batch is written once it reaches `batch_rows` rows, or `batch_seconds` after its first DataFrame arrived.
+    `put` blocks while `maxsize` DataFrames are waiting, so producers slow down when the writer falls behind.
+
+    Usage:
+        with BatchWriter(lambda df: KlineBinance.set(df, symbol=None, freq="1m")) as writer:
+            writer.put(df)
+        writer.results  # returned values of every write
+    """
+
+    def __init__(
+        self,
+        write: Callable[[pd.DataFrame], Any],
+        batch_rows: int | None = None,
+        batch_seconds: float | None = None,
+        maxsize: int | None = None,
+    ):
+        super().__init__(name="BatchWriter", daemon=True)
+        self.write = write
+        self.batch_rows = batch_rows if batch_rows is not None else config.WRITE_BATCH_ROWS
+        self.batch_seconds = batch_seconds if batch_seconds is not None else config.WRITE_BATCH_SECONDS
+        self.queue = queue.Queue(maxsize=maxsize if maxsize is not None else 2 * config.MAX_WORKERS)
+        self.results = []
+        self.error = None
+
+    def __enter__(self) -> "BatchWriter":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def put(self, df: pd.DataFrame | None) -> None:
+        """Queue df to be written, blocking while the queue is full."""
+        if df is None or df.empty:
+            return
+        self._put(df)
+
+    def close(self) -> list:
+        """Write what is left, wait for the writer to finish and raise its error if any."""
+        if self.is_alive():
+            self._put(_STOP)
+            self.join()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def _put(self, item: Any) -> None:
+        while self.error is None:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError(f"{self.name} failed") from self.error
+
+    def _flush(self, batch: list[pd.DataFrame]) -> None:
+        if not batch:
+            return
+        df = pd.concat(batch, ignore_index=True) if len(batch) > 1 else batch[0]
+        with metrics.span("write") as span:
+            self.results.append(self.write(df))
+            span.rows = df.shape[0]
+        logger.debug(f"{self.name} wrote {df.shape[0]} rows in {span.seconds:.3f}s.")
+
+    def run(self) -> None:
+        batch, n_rows, deadline = [], 0, None
+        try:
+            while True:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None  # time budget of the batch is used up
+                if item is _STOP:
+                    self._flush(batch)
+                    return
+                if item is not None:
+                    batch.append(item)
+                    n_rows += item.shape[0]
+                    deadline = deadline or time.monotonic() + self.batch_seconds
+                if n_rows >= self.batch_rows or time.monotonic() >= deadline:
+                    self._flush(batch)
+                    batch, n_rows, deadline = [], 0, None
+        except BaseException as e:
+            logger.exception(f"{self.name} failed")
+            self.error = e
+
+
+__all__ = ["BatchWriter"]
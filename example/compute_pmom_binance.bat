@@ -6,7 +6,7 @@ ECHO                                         DBMaster
 ECHO ****************************************************************************************
 ECHO.
 
-@REM symbol is optional, defaults to Binance.universe
+@REM symbol is optional, defaults to Binance.universe, cached for metadata_ttl in config
 set symbol="['BTCUSDT', 'ETHUSDT', 'BNBUSDT', 'SOLUSDT', 'XRPUSDT', 'DOGEUSDT', 'ADAUSDT', 'SHIBUSDT', 'AVAXUSDT', 'DOTUSDT']"
 set datefrom="2024-04-27 21:00:00" 
 @REM set dateto=2024-04-01
@@ -1,49 +1,74 @@
-# pip install schedule==1.2.1
-import time
-import os
-import datetime as dt
+# Same as declaring the jobs under [serve] in config and running `python -m dbmaster serve`,
+# all jobs run in this process, sharing database engines, HTTP sessions and caches.
+from dbmaster import config
+from dbmaster.config import JobConfig
+from dbmaster.scheduler import Scheduler
 
-from schedule import every, repeat, run_pending
+symbol = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "SOLUSDT", "XRPUSDT", "DOGEUSDT", "ADAUSDT", "SHIBUSDT", "AVAXUSDT", "DOTUSDT"]  # fmt: skip
+freq = ["1d", "12h", "8h", "6h", "4h", "2h", "1h", "30m", "15m", "5m", "3m"]
+period = ["-30d", "-14d", "-7d", "-3d", "-1d", "-12h", "-8h", "-4h", "-1h", "-30m", "-15m", "-5m", "+1d"]
 
+jobs = [
+    # only fetch after the last stored kline of each symbol, symbols without history start from
+    # catalog.kline.start_date in config, or datefrom if not configured
+    JobConfig(
+        name="kline_1m",
+        schedule="0 * * * *",
+        command="update",
+        dataset="kline",
+        kwargs={
+            "vendor": "binance",
+            "symbol": symbol,
+            "freq": "1m",
+            "datefrom": "-1d",
+            "incremental": True,
+            "if_row_exists": "insert",
+        },
+    ),
+    # aggregate the stored 1m klines instead of fetching from vendor
+    *[
+        JobConfig(
+            name=f"kline_{frq}",
+            schedule="10 * * * *",
+            command="update",
+            dataset="kline",
+            kwargs={
+                "vendor": "binance",
+                "symbol": symbol,
+                "freq": frq,
+                "datefrom": "-1d",
+                "incremental": True,
+                "source": "resample",
+                "if_row_exists": "insert",
+            },
+        )
+        for frq in freq
+    ],
+    # cross rates of the new 5m klines, normalized by BTCUSDT once instead of in every pmom run
+    JobConfig(
+        name="xrate",
+        schedule="15 * * * *",
+        command="compute",
+        dataset="xrate",
+        kwargs={"vendor": "binance", "symbol": symbol, "freq": "5m", "datefrom": "-2d", "incremental": True},
+    ),
+    # only asofs after the last computed ones, datefrom is used for symbols/periods not computed yet
+    JobConfig(
+        name="pmom",
+        schedule="20 * * * *",
+        command="compute",
+        dataset="pmom",
+        kwargs={
+            "vendor": "binance",
+            "symbol": symbol,
+            "period": period,
+            "step": "5m",
+            "datefrom": "-2d",
+            "incremental": True,
+            "source": "xrate",
+            "if_row_exists": "insert",
+        },
+    ),
+]
 
-@repeat(every(1).hours.at("00:00"))
-def update_kline():
-    now = dt.datetime.now()
-    print("update_kline called at " + now.strftime("%Y-%m-%d %H:%M:%S"))
-
-    datefrom = dt.datetime.now() - dt.timedelta(days=1)
-    datefrom = datefrom.strftime("%Y-%m-%d")
-    symbol = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "SOLUSDT", "XRPUSDT", "DOGEUSDT", "ADAUSDT", "SHIBUSDT", "AVAXUSDT", "DOTUSDT"]  # fmt: skip
-    freq = ["1d", "12h", "8h", "6h", "4h", "2h", "1h", "30m", "15m", "5m", "3m", "1m"]
-
-    for frq in freq:
-        print(f"Running job for freq={frq}, symbol={symbol}")
-        cmd = f'python -m dbmaster update kline --vendor=binance --freq={frq} --datefrom="{datefrom}" --symbol="{symbol}" --if_row_exists=insert'
-        if frq == "1m":
-            cmd = "$ENV:DBMASTER_MAX_WORKERS=1; " + cmd
-        os.system(cmd)
-
-
-@repeat(every(1).hours.at("00:00"))
-def compute_pmom():
-    now = dt.datetime.now()
-    print("compute_pmom called at " + now.strftime("%Y-%m-%d %H:%M:%S"))
-
-    datefrom = dt.datetime.now() - dt.timedelta(days=2)
-    datefrom = datefrom.strftime("%Y-%m-%d %H:%M:%S")
-    step = "5m"
-    symbol = ['BTCUSDT', 'ETHUSDT', 'BNBUSDT', 'SOLUSDT', 'XRPUSDT', 'DOGEUSDT', 'ADAUSDT', 'SHIBUSDT', 'AVAXUSDT', 'DOTUSDT']  # fmt: skip
-    period = ['-30d', '-14d', '-7d', '-3d', '-1d', '-12h', '-8h', '-4h', '-1h', '-30m', '-15m', '-5m', '+1d']  # fmt: skip
-    print(f"Running job for {period=}, symbol={symbol}")
-
-    cmd = f'python -m dbmaster compute pmom --vendor=binance --period="{period}" --{step=} --datefrom="{datefrom}" --symbol="{symbol}" --if_row_exists=insert'
-    os.system(cmd)
-
-
-# update_kline()
-# compute_pmom()
-
-
-while True:
-    run_pending()
-    time.sleep(1)
+Scheduler(jobs, max_concurrent_jobs=config.serve.max_concurrent_jobs).run(run_now=False)
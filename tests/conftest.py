@@ -0,0 +1,77 @@
+import pytest
+import sqlalchemy as sa
+
+from dbmaster.catalog import KlineBinance
+from dbmaster.catalog.kline import coverage_table, kline_table
+from dbmaster.derived import PmomBinance, XrateBinance
+from dbmaster.derived.pmom import pmom_table
+from dbmaster.util import dictionary_table
+
+
+@pytest.fixture
+def kline_engine(tmp_path, monkeypatch):
+    """KlineBinance on an empty temporary database."""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'kline.db'}")
+    for table in KlineBinance.table:
+        table.create(engine, checkfirst=True)
+    monkeypatch.setattr(KlineBinance, "engine", engine)
+    return engine
+
+
+@pytest.fixture
+def pmom_engine(tmp_path, monkeypatch):
+    """PmomBinance on an empty temporary database."""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'factor.db'}")
+    for table in PmomBinance.table:
+        table.create(engine, checkfirst=True)
+    monkeypatch.setattr(PmomBinance, "engine", engine)
+    return engine
+
+
+@pytest.fixture
+def xrate_engine(tmp_path, monkeypatch):
+    """XrateBinance on an empty temporary database."""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'xrate.db'}")
+    for table in XrateBinance.table:
+        table.create(engine, checkfirst=True)
+    monkeypatch.setattr(XrateBinance, "engine", engine)
+    return engine
+
+
+@pytest.fixture
+def kline_compact(tmp_path, monkeypatch):
+    """KlineBinance in compact schema on an empty temporary database, with the 1h table only."""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'kline_compact.db'}")
+    metadata = sa.MetaData()
+    kline_table("1h", metadata, compact=True)
+    dictionary_table("kline_binance_symbol", metadata, "Symbol")
+    coverage_table(metadata)
+    metadata.create_all(engine)
+    monkeypatch.setattr(KlineBinance, "engine", engine)
+    monkeypatch.setattr(KlineBinance, "compact", True)
+    return engine
+
+
+@pytest.fixture
+def pmom_compact(tmp_path, monkeypatch):
+    """PmomBinance in compact schema on an empty temporary database."""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'factor_compact.db'}")
+    metadata = sa.MetaData()
+    pmom_table(metadata, compact=True)
+    dictionary_table("pmom_binance_symbol", metadata, "Symbol")
+    dictionary_table("pmom_binance_period", metadata, "Period")
+    metadata.create_all(engine)
+    monkeypatch.setattr(PmomBinance, "engine", engine)
+    monkeypatch.setattr(PmomBinance, "compact", True)
+    return engine
+
+
+@pytest.fixture
+def kline_parquet(tmp_path, monkeypatch):
+    """KlineBinance on an empty temporary parquet directory."""
+    pytest.importorskip("pyarrow")
+    from dbmaster.parquet import ParquetStore
+
+    store = ParquetStore(tmp_path / "kline")
+    monkeypatch.setattr(KlineBinance, "store", store)
+    return store
@@ -1,4 +1,29 @@
+import asyncio
+import json
+import multiprocessing
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import pytest
+import requests
+
+from dbmaster import config
 from dbmaster.vendor import Binance
+from dbmaster.vendor.binance import KLINES_URL, MetadataCache, WeightLimitedAdapter, WeightLimiter, request_weight
+from binance.enums import HistoricalKlinesType
+
+
+@pytest.fixture(autouse=True)
+def metadata(tmp_path):
+    """Empty metadata cache for each test"""
+    with mock.patch.object(Binance, "metadata", MetadataCache(tmp_path / "binance_metadata.json", ttl=60)) as cache:
+        yield cache
 
 
 def test_get_kline_datefrom():
@@ -14,3 +39,236 @@ def test_get_kline_dateto():
 def test_get_kline_datefrom_dateto():
     df = Binance.get_kline("BTCUSDT", "1d", datefrom="2024-01-01", dateto="2024-01-10")
     print(df)
+
+
+class _FakeClient:
+    """Serves 1h klines opened from 2024-01-01 until 2024-03-01, the same way as the Binance API."""
+
+    first, last, step = 1704067200000, 1709251200000, 3600000
+
+    def __init__(self):
+        self.requests = 0
+
+    def _klines(self, symbol, interval, limit, startTime, endTime, **kwargs):
+        self.requests += 1
+        start = max(startTime + (-startTime) % self.step, self.first)
+        end = min(endTime, self.last)
+        return [[ts, "1", "2", "0.5", "1.5", "10", ts + self.step - 1, "15", 1, 0, 0, 0] for ts in range(start, end + 1, self.step)][:limit]  # fmt: skip
+
+    def _get_earliest_valid_timestamp(self, symbol, interval, klines_type):
+        return self.first
+
+    def get_historical_klines(self, symbol, interval, start_str, end_str, klines_type):
+        start = pd.Timestamp(start_str).value // 10**6 if start_str else self.first
+        return self._klines(symbol, interval, 10**6, start, pd.Timestamp(end_str).value // 10**6)
+
+    def get_exchange_info(self):
+        self.requests += 1
+        return {"symbols": [{"symbol": "BTCUSDT"}, {"symbol": "ETHBTC"}, {"symbol": "ETHUSDT"}]}
+
+
+@mock.patch.object(Binance, "client", _FakeClient())  # not monkeypatch, which would connect to get the original
+def test_get_kline_chunks():
+    client = Binance.client
+    df = Binance.get_kline("BTCUSDT", "1h", datefrom="2023-12-01", dateto="2024-02-15 12:30")
+    assert client.requests == 2  # 1093 klines in 2 chunks
+    assert df["OpenTime"].is_unique and df["OpenTime"].is_monotonic_increasing
+    assert df["OpenTime"].iloc[0] == pd.Timestamp("2024-01-01")
+    assert df["OpenTime"].iloc[-1] == pd.Timestamp("2024-02-15 11:00")  # 12:00 is not closed
+
+    # the same as paging from one request to the next
+    with mock.patch("dbmaster.vendor.binance.interval_to_milliseconds", return_value=None):
+        expected = Binance.get_kline("BTCUSDT", "1h", datefrom="2024-01-01", dateto="2024-02-15 12:30")
+    pd.testing.assert_frame_equal(df, expected)
+
+
+@mock.patch.object(Binance, "client", _FakeClient())
+def test_universe_cached(metadata):
+    client = Binance.client
+    assert Binance.universe == ["BTCUSDT", "ETHUSDT"]
+    assert Binance.universe == ["BTCUSDT", "ETHUSDT"]
+    assert client.requests == 1
+    assert MetadataCache(metadata.path, ttl=60).get_universe() == ["BTCUSDT", "ETHUSDT"]  # as in another process
+    assert MetadataCache(metadata.path, ttl=0).get_universe() is None  # expired
+
+    Binance.get_universe(refresh=True)
+    assert client.requests == 2
+
+
+def _set_listings(path, market, symbols):
+    cache = MetadataCache(path, ttl=60)
+    for i, symbol in enumerate(symbols):
+        cache.set_listing(market, symbol, i)
+
+
+def test_listing_concurrent(metadata):
+    symbols = [f"SYM{i}USDT" for i in range(20)]
+    with ThreadPoolExecutor(4) as pool:  # threads of a process share the cache
+        list(pool.map(metadata.set_listing, ["SPOT"] * 20, symbols, range(20)))
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(4, mp_context=ctx) as pool:  # processes share the file
+        list(pool.map(_set_listings, [metadata.path] * 4, ["FUTURES"] * 4, [symbols[i::4] for i in range(4)]))
+
+    assert [metadata.get_listing("SPOT", symbol) for symbol in symbols] == list(range(20))
+    assert all(metadata.get_listing("FUTURES", symbol) is not None for symbol in symbols)
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """Local server replying with the (status, headers) queued in `server.replies`, 200 when the queue is empty.
+    Klines requests are served by `server.client` if set.
+    """
+    monkeypatch.setattr(config.vendor.binance, "https_proxy", None)  # requested directly, whatever the config
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.paths.append(self.path)
+            status, headers = self.server.replies.pop(0) if self.server.replies else (200, {})
+            body = b"[]"
+            if self.server.client and self.path.startswith("/api/v3/klines"):
+                params = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+                params.update({k: int(params[k]) for k in ("limit", "startTime", "endTime") if k in params})
+                body = json.dumps(self.server.client._klines(**params)).encode()
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.replies, server.paths, server.client = [], [], None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def _session(limiter):
+    session = requests.Session()
+    session.mount("http://", WeightLimitedAdapter(limiter))
+    return session
+
+
+def test_request_weight():
+    assert request_weight("https://api.binance.com/api/v3/klines?symbol=BTCUSDT&limit=1000") == 2
+    assert request_weight("https://api.binance.com/api/v3/exchangeInfo") == 20
+    assert request_weight("https://fapi.binance.com/fapi/v1/klines?symbol=BTCUSDT&limit=1000") == 5
+    assert request_weight("https://api.binance.com/api/v3/ping") == 1
+
+
+def test_weight_limiter_used_weight(mock_server):
+    limiter = WeightLimiter(600)  # 10 per second
+    mock_server.replies = [(200, {"x-mbx-used-weight-1m": "600"})]
+    url = f"http://127.0.0.1:{mock_server.server_port}/api/v3/klines?limit=1000"
+
+    session = _session(limiter)
+    assert session.get(url).status_code == 200
+    start = time.monotonic()
+    assert session.get(url).status_code == 200  # waits for 2 weight to refill
+    assert time.monotonic() - start >= 0.15
+
+
+def test_weight_limiter_backoff(mock_server):
+    limiter = WeightLimiter(6000)
+    mock_server.replies = [(429, {"Retry-After": "1"}), (200, {})]
+    url = f"http://127.0.0.1:{mock_server.server_port}/api/v3/klines"
+
+    start = time.monotonic()
+    assert _session(limiter).get(url).status_code == 200
+    assert time.monotonic() - start >= 1
+    assert len(mock_server.paths) == 2
+
+    mock_server.replies = [(418, {"Retry-After": "1"})]
+    assert _session(limiter).get(url).status_code == 418  # banned, not retried
+    assert len(mock_server.paths) == 3
+
+
+def test_aget_kline(mock_server):
+    mock_server.client = _FakeClient()
+    url = f"http://127.0.0.1:{mock_server.server_port}/api/v3/klines"
+
+    with mock.patch.dict(KLINES_URL, {HistoricalKlinesType.SPOT: url}):
+        df = asyncio.run(Binance.aget_kline("BTCUSDT", "1h", datefrom="2023-12-01", dateto="2024-02-15 12:30"))
+    assert len(mock_server.paths) == 3  # earliest kline, then 2 chunks
+    with mock.patch.dict(KLINES_URL, {HistoricalKlinesType.SPOT: url}):
+        asyncio.run(Binance.aget_kline("BTCUSDT", "1h", datefrom="2023-12-01", dateto="2024-02-15 12:30", klines_type="spot"))  # fmt: skip
+    assert len(mock_server.paths) == 5  # listing time is cached
+
+    with mock.patch.object(Binance, "client", _FakeClient()):
+        expected = Binance.get_kline("BTCUSDT", "1h", datefrom="2023-12-01", dateto="2024-02-15 12:30")
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def _write_archive(path, symbol, freq, date, klines, header=False):
+    """Zipped csv of klines as published on data.binance.vision."""
+    period = "daily" if len(date) == 10 else "monthly"
+    file = path / "spot" / period / "klines" / symbol / freq / f"{symbol}-{freq}-{date}.zip"
+    file.parent.mkdir(parents=True, exist_ok=True)
+    lines = ["open_time,open,high,low,close,volume,close_time,quote_volume,count,taker_buy_volume,taker_buy_quote_volume,ignore"] if header else []  # fmt: skip
+    lines += [",".join(map(str, kline)) for kline in klines]
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(file.with_suffix(".csv").name, "\n".join(lines) + "\n")
+    return file
+
+
+def test_read_archive(tmp_path):
+    client = _FakeClient()
+    klines = client._klines("BTCUSDT", "1h", 1000, client.first, client.first + 47 * client.step)
+    expected = Binance._to_frame(klines, "BTCUSDT", "1h", closed_only=False)
+
+    _write_archive(tmp_path, "BTCUSDT", "1h", "2024-01", klines)
+    _write_archive(tmp_path, "ETHUSDT", "1h", "2024-01-01", klines, header=True)
+    micro = [[kline[0] * 1000, *kline[1:6], kline[6] * 1000 + 999, *kline[7:]] for kline in klines]
+    _write_archive(tmp_path, "ETHUSDT", "1h", "2025-01", micro)  # spot archives since 2025
+    _write_archive(tmp_path, "BTCUSDT", "1d", "2024-01", klines)
+
+    files = Binance.list_archive(tmp_path, "1h")
+    assert [(file.symbol, file.start, file.end) for file in files] == [
+        ("BTCUSDT", pd.Timestamp("2024-01-01"), pd.Timestamp("2024-02-01")),
+        ("ETHUSDT", pd.Timestamp("2024-01-01"), pd.Timestamp("2024-01-02")),
+        ("ETHUSDT", pd.Timestamp("2025-01-01"), pd.Timestamp("2025-02-01")),
+    ]
+    assert Binance.list_archive(tmp_path, "1h", symbol=["BTC/USDT"]) == files[:1]
+    for file in files:
+        df = Binance.read_archive(file, "1h")
+        pd.testing.assert_frame_equal(df, expected.assign(Symbol=file.symbol))
+
+
+def test_update_kline_archive(tmp_path, kline_engine):
+    from dbmaster.catalog import KlineBinance
+    from dbmaster.command import Update
+
+    client = _FakeClient()
+    klines = client._klines("BTCUSDT", "1h", 10**6, client.first, client.last - 1)  # January and February
+    for month in ["01", "02"]:
+        _write_archive(tmp_path, "BTCUSDT", "1h", f"2024-{month}", [k for k in klines if pd.Timestamp(k[0], unit="ms").month == int(month)])  # fmt: skip
+    _write_archive(tmp_path, "BTCUSDT", "1h", "2024-02-01", klines[744:768])  # overlaps the monthly file
+    _write_archive(tmp_path, "ETHUSDT", "1h", "2024-02", klines[744:1440])
+
+    Update().kline("binance", symbol=None, freq="1h", datefrom="2024-01-15", source="archive", path=str(tmp_path))
+    df = KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h")
+    assert df.groupby("Symbol")["OpenTime"].agg(["min", "max", "count"]).to_dict("index") == {
+        "BTCUSDT": {"min": pd.Timestamp("2024-01-15"), "max": pd.Timestamp("2024-02-29 23:00"), "count": 1104},
+        "ETHUSDT": {"min": pd.Timestamp("2024-02-01"), "max": pd.Timestamp("2024-02-29 23:00"), "count": 696},
+    }
+    expected = Binance._to_frame(klines, "BTCUSDT", "1h", closed_only=False)
+    pd.testing.assert_frame_equal(
+        df.loc[df["Symbol"] == "BTCUSDT"].reset_index(drop=True),
+        expected.loc[expected["OpenTime"] >= "2024-01-15"].reset_index(drop=True)[df.columns],
+    )
+    assert [file.path.name for file in Binance.list_archive(tmp_path, "1h", ["BTCUSDT"])] == [
+        "BTCUSDT-1h-2024-01.zip",
+        "BTCUSDT-1h-2024-02.zip",  # the daily file of a month with a monthly file is skipped
+    ]
+
+    # the first import of a symbol, whose monthly and daily files overlap, is not an existing row
+    for if_row_exists in ["ignore", "raise"]:
+        with kline_engine.begin() as conn:
+            conn.exec_driver_sql("DELETE FROM kline_binance_1h")
+            conn.exec_driver_sql("DELETE FROM kline_binance_coverage")
+        Update().kline("binance", symbol=None, freq="1h", source="archive", path=str(tmp_path), if_row_exists=if_row_exists)  # fmt: skip
+        df = KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h")
+        assert df.groupby("Symbol").size().to_dict() == {"BTCUSDT": 1440, "ETHUSDT": 696}
@@ -1,4 +1,13 @@
+from unittest import mock
+
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
 from dbmaster.catalog import KlineBinance, Kline
+from dbmaster.catalog.kline import align, resample
+from dbmaster.command import Compute, Repair, Update
+from dbmaster.vendor import VendorFactory
 
 
 def test_get():
@@ -32,3 +41,318 @@ def test_kline_get():
     # 2  BTCUSDT 2024-01-03 2024-01-03 23:59:59  ...  42845.23  81194.55173  3.507105e+09
     # 3  BTCUSDT 2024-01-04 2024-01-04 23:59:59  ...  44151.10  48038.06334  2.095095e+09
     # 4  BTCUSDT 2024-01-05 2024-01-05 23:59:59  ...  44145.11  48075.25327  2.100954e+09
+
+
+def _make_kline(symbol="BTCUSDT", datefrom="2024-01-01", periods=10, value=1.0):
+    opentime = pd.date_range(datefrom, periods=periods, freq="1h")
+    df = pd.DataFrame({"Symbol": symbol, "OpenTime": opentime, "CloseTime": opentime + pd.Timedelta("59min59s")})
+    df[["Open", "High", "Low", "Close", "BaseVolume", "QuoteVolume"]] = value
+    return df
+
+
+def test_set_if_row_exists(kline_engine):
+    KlineBinance.set(_make_kline(periods=10, value=1.0), symbol="BTCUSDT", freq="1h")
+    overlap = _make_kline(datefrom="2024-01-01 05:00", periods=10, value=2.0)
+
+    with pytest.raises(sa.exc.IntegrityError):
+        KlineBinance.set(overlap, symbol="BTCUSDT", freq="1h", if_row_exists="raise")
+    KlineBinance.set(overlap, symbol="BTCUSDT", freq="1h", if_row_exists="ignore")
+    assert KlineBinance.get("BTCUSDT", "1h")["Open"].tolist() == [1.0] * 10
+
+    KlineBinance.set(overlap, symbol="BTCUSDT", freq="1h", if_row_exists="insert")
+    assert KlineBinance.get("BTCUSDT", "1h")["Open"].tolist() == [1.0] * 10 + [2.0] * 5
+
+    KlineBinance.set(overlap.assign(Open=3.0), symbol="BTCUSDT", freq="1h", if_row_exists="drop")
+    assert KlineBinance.get("BTCUSDT", "1h")["Open"].tolist() == [1.0] * 5 + [3.0] * 10
+
+
+def test_parquet_same_as_sqlite(kline_engine, kline_parquet):
+    df = pd.concat([_make_kline("BTCUSDT", "2024-01-31", periods=48), _make_kline("ETHUSDT", "2024-01-31", periods=30)])
+    KlineBinance.set(df, symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-02-01", periods=5, value=2.0), symbol="BTCUSDT", freq="1h")
+    parquet = KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h", datefrom="2024-01-31 12:00", dateto="2024-02-01 02:00")
+    parquet_close = KlineBinance.get("ETHUSDT", "1h", datefrom="2024-02-01", column="Close")
+
+    KlineBinance.store = None
+    KlineBinance.set(df, symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-02-01", periods=5, value=2.0), symbol="BTCUSDT", freq="1h")
+    sqlite = KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h", datefrom="2024-01-31 12:00", dateto="2024-02-01 02:00")
+    pd.testing.assert_frame_equal(parquet, sqlite)
+    pd.testing.assert_frame_equal(
+        parquet_close, KlineBinance.get("ETHUSDT", "1h", datefrom="2024-02-01", column="Close")
+    )
+    assert sorted(kline_parquet.root.glob("kline_binance_1h/Symbol=BTCUSDT/*")) == [
+        kline_parquet.root / "kline_binance_1h" / "Symbol=BTCUSDT" / "Month=2024-01",
+        kline_parquet.root / "kline_binance_1h" / "Symbol=BTCUSDT" / "Month=2024-02",
+    ]
+
+
+def test_resample():
+    df = _make_kline(periods=13)
+    df["OpenTime"] = pd.date_range("2024-01-01", periods=13, freq="1min")
+    df["CloseTime"] = df["OpenTime"] + pd.Timedelta("59s")
+    df[["Open", "High", "Low", "Close"]] = [[i, i + 1, i - 1, i + 0.5] for i in range(13)]
+
+    kline = resample(df, "5m", source_freq="1m")
+    assert kline.columns.tolist() == df.columns.tolist()
+    assert kline["OpenTime"].tolist() == [pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 00:05")]
+    assert kline["CloseTime"].tolist() == [pd.Timestamp("2024-01-01 00:04:59"), pd.Timestamp("2024-01-01 00:09:59")]
+    assert kline[["Open", "High", "Low", "Close", "BaseVolume"]].values.tolist() == [
+        [0, 5, -1, 4.5, 5],
+        [5, 10, 4, 9.5, 5],
+    ]
+    assert resample(df.drop(index=[2]), "5m", source_freq="1m")["OpenTime"].tolist() == [  # a 1m kline missing
+        pd.Timestamp("2024-01-01 00:05")
+    ]
+
+
+@pytest.mark.parametrize("by", ["time", "symbol"])
+def test_iter_get(kline_engine, by):
+    df = pd.concat([_make_kline(sym, periods=48) for sym in ("BTCUSDT", "ETHUSDT", "BNBUSDT")], ignore_index=True)
+    df = df.drop(index=[5, 50])  # missing bars
+    KlineBinance.set(df, symbol=None, freq="1h")
+
+    column = ["Symbol", "OpenTime", "Close"]
+    chunks = list(KlineBinance.iter_get(None, "1h", datefrom="2024-01-01 03:00", column=column, chunk_rows=30, by=by))
+    keys = ["OpenTime", "Symbol"] if by == "time" else ["Symbol", "OpenTime"]
+    assert len(chunks) > 1
+    assert by == "symbol" or all(chunk.shape[0] <= 30 for chunk in chunks)  # a symbol is never split
+    result = pd.concat(chunks, ignore_index=True)
+    assert result[keys].equals(result[keys].sort_values(keys, ignore_index=True))
+    expected = KlineBinance.get(["BTCUSDT", "ETHUSDT", "BNBUSDT"], "1h", datefrom="2024-01-01 03:00", column=column)
+    pd.testing.assert_frame_equal(result, expected.sort_values(keys, ignore_index=True))
+
+
+def test_get_fast_reader(kline_engine):
+    df = pd.concat([_make_kline(sym, periods=24) for sym in ("BTCUSDT", "ETHUSDT")], ignore_index=True)
+    df.loc[3, "Close"] = float("nan")
+    KlineBinance.set(df, symbol=None, freq="1h")
+
+    for kwargs in [
+        {},
+        {"column": ["Symbol", "OpenTime", "Open"], "datefrom": "2024-01-01 05:00"},
+        {"symbol": "BNBUSDT"},
+    ]:
+        kwargs = {"symbol": ["BTCUSDT", "ETHUSDT"], "freq": "1h", **kwargs}
+        expected = KlineBinance.get(**kwargs, reader="pandas")
+        pd.testing.assert_frame_equal(KlineBinance.get(**kwargs, reader="fast"), expected)
+
+    sql = KlineBinance.query(KlineBinance.get_kline_table("1h"), ["Symbol", "OpenTime", "Close"], symbol=None)
+    pd.testing.assert_frame_equal(KlineBinance.read_sql(sql, batch_rows=7), KlineBinance.read_sql(sql))  # 7 batches
+
+
+def test_compact_same_as_default(kline_engine, kline_compact):
+    df = pd.concat([_make_kline(sym, periods=24) for sym in ("ETHUSDT", "BTCUSDT")], ignore_index=True)
+    calls = [
+        {"symbol": ["BTCUSDT", "ETHUSDT"]},
+        {"symbol": "ETHUSDT", "column": ["OpenTime", "CloseTime", "Close"], "datefrom": "2024-01-01 05:00"},
+        {"symbol": ["BNBUSDT", "BTCUSDT"], "dateto": "2024-01-01 03:00"},
+        {"symbol": "BNBUSDT"},
+    ]
+    KlineBinance.set(df, symbol=None, freq="1h")
+    compact = [KlineBinance.get(freq="1h", **kwargs) for kwargs in calls]
+    compact_watermark = KlineBinance.get_watermark("1h")
+
+    KlineBinance.compact = False
+    KlineBinance.engine = kline_engine
+    KlineBinance.set(df, symbol=None, freq="1h")
+    for kwargs, result in zip(calls, compact):
+        pd.testing.assert_frame_equal(result, KlineBinance.get(freq="1h", **kwargs), check_dtype=not result.empty)
+    pd.testing.assert_frame_equal(compact_watermark, KlineBinance.get_watermark("1h"))
+
+
+def test_migrate(kline_engine):
+    df = pd.concat([_make_kline(sym, periods=24) for sym in ("ETHUSDT", "BTCUSDT")], ignore_index=True)
+    KlineBinance.set(df, symbol=None, freq="1h")
+    expected = KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h")
+
+    assert KlineBinance.migrate(compact=True, batch_rows=10) == df.shape[0]
+    assert "kline_binance_1h" not in sa.inspect(kline_engine).get_table_names()
+    KlineBinance.compact = True
+    pd.testing.assert_frame_equal(KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h"), expected)
+
+    assert KlineBinance.migrate(compact=False, batch_rows=10) == df.shape[0]
+    KlineBinance.compact = False
+    pd.testing.assert_frame_equal(KlineBinance.get(["BTCUSDT", "ETHUSDT"], "1h"), expected)
+
+
+def test_coverage(kline_engine):
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01", periods=10), symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01 12:00", periods=5), symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01 10:00", periods=1), symbol=None, freq="1h")  # adjacent
+    KlineBinance.set(_make_kline("ETHUSDT", "2024-01-01 05:00", periods=5), symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("ETHUSDT", "2024-01-01 05:00", periods=5), symbol=None, freq="1h", if_row_exists="ignore")  # fmt: skip
+
+    coverage = KlineBinance.get_coverage("1h")
+    assert coverage.values.tolist() == [
+        ["BTCUSDT", pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 10:00")],
+        ["BTCUSDT", pd.Timestamp("2024-01-01 12:00"), pd.Timestamp("2024-01-01 16:00")],
+        ["ETHUSDT", pd.Timestamp("2024-01-01 05:00"), pd.Timestamp("2024-01-01 09:00")],
+    ]
+    with kline_engine.begin() as conn:
+        conn.execute(sa.text("DELETE FROM kline_binance_coverage"))
+    pd.testing.assert_frame_equal(KlineBinance.rebuild_coverage("1h"), coverage)
+
+    assert KlineBinance.get_gaps("1h").values.tolist() == [
+        ["BTCUSDT", pd.Timestamp("2024-01-01 11:00"), pd.Timestamp("2024-01-01 11:00")]
+    ]
+    gaps = KlineBinance.get_gaps("1h", ["BTCUSDT", "ETHUSDT", "BNBUSDT"], "2023-12-31 23:30", "2024-01-01 17:30")
+    assert gaps.values.tolist() == [
+        ["BNBUSDT", pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 17:00")],
+        ["BTCUSDT", pd.Timestamp("2024-01-01 11:00"), pd.Timestamp("2024-01-01 11:00")],
+        ["BTCUSDT", pd.Timestamp("2024-01-01 17:00"), pd.Timestamp("2024-01-01 17:00")],
+        ["ETHUSDT", pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 04:00")],
+        ["ETHUSDT", pd.Timestamp("2024-01-01 10:00"), pd.Timestamp("2024-01-01 17:00")],
+    ]
+    assert KlineBinance.get_gaps("1h", datefrom="2024-01-01 12:00", edges=False).empty
+
+
+def test_set_rolls_back_without_coverage(kline_engine):
+    with mock.patch("dbmaster.catalog.kline.merge_intervals", side_effect=ValueError("coverage failed")):
+        with pytest.raises(ValueError):
+            KlineBinance.set(_make_kline("BTCUSDT", periods=10), symbol=None, freq="1h")
+    assert KlineBinance.get("BTCUSDT", "1h").empty  # the klines are written with their coverage or not at all
+    assert KlineBinance.get_coverage("1h").empty
+
+    KlineBinance.set(_make_kline("BTCUSDT", periods=10), symbol=None, freq="1h")
+    overlap = _make_kline("BTCUSDT", "2024-01-01 05:00", periods=10, value=2.0)
+    assert KlineBinance.set(overlap, symbol=None, freq="1h", if_row_exists="ignore") == 0
+    assert KlineBinance.get("BTCUSDT", "1h").shape[0] == 10
+    assert KlineBinance.get_coverage("1h")["End"].tolist() == [pd.Timestamp("2024-01-01 09:00")]
+
+
+def test_align():
+    assert align(pd.Timestamp("2024-01-01 00:07"), "5m") == pd.Timestamp("2024-01-01 00:05")
+    assert align(pd.Timestamp("2024-01-01 00:07"), "5m", up=True) == pd.Timestamp("2024-01-01 00:10")
+    assert align(pd.Timestamp("2024-01-03"), "1w") == pd.Timestamp("2024-01-01")  # a Monday
+    assert align(pd.Timestamp("2024-02-15"), "1M", up=True) == pd.Timestamp("2024-03-01")
+    assert align(pd.Timestamp("2024-02-01"), "1M", up=True) == pd.Timestamp("2024-02-01")
+
+
+class _FakeVendor:
+    """Hourly klines of value 2.0, except ETHUSDT has none before 2024-01-01 03:00, and BTCUSDT none at 17:00."""
+
+    calls = []
+    universe = ["BTCUSDT", "ETHUSDT"]
+
+    @classmethod
+    def get_kline(cls, symbol, freq, datefrom=None, dateto=None, closed_only=True, **kwargs):
+        cls.calls.append((symbol, datefrom, dateto))
+        start = datefrom.ceil(freq)  # the first kline opened from datefrom
+        df = _make_kline(symbol, start, periods=max(int((dateto - start) / pd.Timedelta(freq)) + 1, 0), value=2.0)
+        df = df.loc[(symbol != "ETHUSDT") | (df["OpenTime"] >= "2024-01-01 03:00")]
+        df = df.loc[(symbol != "BTCUSDT") | (df["OpenTime"] != "2024-01-01 17:00")]
+        return df.iloc[:-1] if closed_only else df  # the last one taken as not closed, as the vendor does
+
+
+@mock.patch.object(VendorFactory, "get", lambda name: _FakeVendor)
+def test_repair_kline(kline_engine):
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01", periods=10), symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01 12:00", periods=5), symbol=None, freq="1h")
+
+    Repair().kline("binance", symbol=["BTCUSDT", "ETHUSDT"], freq="1h", datefrom="2024-01-01", dateto="2024-01-01 18:00")  # fmt: skip
+    assert sorted(_FakeVendor.calls) == [
+        ("BTCUSDT", pd.Timestamp("2024-01-01 10:00"), pd.Timestamp("2024-01-01 11:00")),
+        ("BTCUSDT", pd.Timestamp("2024-01-01 17:00"), pd.Timestamp("2024-01-01 18:00")),
+        ("ETHUSDT", pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 18:00")),
+    ]
+    btc = KlineBinance.get("BTCUSDT", "1h")
+    assert btc["Open"].tolist() == [1.0] * 10 + [2.0] * 2 + [1.0] * 5 + [2.0]
+    assert KlineBinance.get_coverage("1h", "BTCUSDT").values.tolist() == [  # the halt is marked as covered
+        ["BTCUSDT", pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 18:00")]
+    ]
+    assert KlineBinance.get_gaps("1h", ["BTCUSDT", "ETHUSDT"], "2024-01-01", "2024-01-01 18:00").values.tolist() == [
+        ["ETHUSDT", pd.Timestamp("2024-01-01 00:00"), pd.Timestamp("2024-01-01 02:00")]  # not listed yet
+    ]
+
+
+def test_compute_pmom_gaps(kline_engine, pmom_engine):
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01", periods=10), symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("ETHUSDT", "2024-01-01", periods=4), symbol=None, freq="1h")
+    KlineBinance.set(_make_kline("ETHUSDT", "2024-01-01 06:00", periods=4), symbol=None, freq="1h")
+
+    with pytest.raises(ValueError, match="1 gaps of 1h kline"):
+        Compute().pmom("binance", symbol=["BTCUSDT", "ETHUSDT"], period=["-2h", "+1h"], step="1h", datefrom="2024-01-01 02:00")  # fmt: skip
+    Compute().pmom(
+        "binance", symbol=["BTCUSDT", "ETHUSDT"], period=["-2h", "+1h"], step="1h", datefrom="2024-01-01 08:00"
+    )
+
+
+def test_watermark_seeks(kline_engine, kline_compact):
+    df = pd.concat([_make_kline(sym, "2024-01-01", periods=n) for sym, n in (("ETHUSDT", 5), ("BTCUSDT", 9))])
+    for engine, compact in ((kline_engine, False), (kline_compact, True)):
+        KlineBinance.engine, KlineBinance.compact = engine, compact
+        KlineBinance.set(df, symbol=None, freq="1h")
+
+        watermark = KlineBinance.get_watermark("1h")
+        assert watermark["Symbol"].tolist() == ["BTCUSDT", "ETHUSDT"]
+        assert watermark["OpenTime"].tolist() == [pd.Timestamp("2024-01-01 08:00"), pd.Timestamp("2024-01-01 04:00")]
+        pd.testing.assert_frame_equal(KlineBinance.get_watermark("1h", ["ETHUSDT", "BNBUSDT"]), watermark.iloc[[1]].reset_index(drop=True))  # fmt: skip
+        assert KlineBinance.get_watermark("1h", "BNBUSDT").empty
+        assert KlineBinance.get_time_range("1h") == (pd.Timestamp("2024-01-01"), pd.Timestamp("2024-01-01 08:00"))
+        assert KlineBinance.get_time_range("1h", "ETHUSDT")[1] == pd.Timestamp("2024-01-01 04:00")
+        assert KlineBinance.get_time_range("1h", "BNBUSDT") == (None, None)
+
+        for method in ("get_watermark", "get_time_range"):
+            (statement, plan), *_ = KlineBinance.explain(method, freq="1h")
+            assert not plan["detail"].str.startswith(f"SCAN {KlineBinance.get_kline_table('1h').name}").any()
+
+
+def test_set_object_datetime(kline_engine):
+    KlineBinance.set(_make_kline(periods=10), symbol="BTCUSDT", freq="1h")
+    overlap = _make_kline(datefrom="2024-01-01 05:00", periods=10, value=2.0).astype({"OpenTime": object})
+    assert KlineBinance.set(overlap, symbol="BTCUSDT", freq="1h", if_row_exists="insert") == 5
+    assert KlineBinance.get("BTCUSDT", "1h")["Open"].tolist() == [1.0] * 10 + [2.0] * 5
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+@mock.patch.object(VendorFactory, "get", lambda name: _FakeVendor)
+def test_update_kline_if_row_exists(kline_engine, request, backend):
+    if backend == "parquet":
+        request.getfixturevalue("kline_parquet")
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01 03:00", periods=5), symbol=None, freq="1h")
+    kwargs = dict(freq="1h", datefrom="2024-01-01 03:00", dateto="2024-01-01 07:00", closed_only=False)
+
+    # the existing BTCUSDT rows only skip BTCUSDT, not the other symbols written in the same batch
+    Update().kline("binance", symbol=["BTCUSDT", "ETHUSDT"], **kwargs, if_row_exists="ignore")
+    assert KlineBinance.get("BTCUSDT", "1h")["Open"].tolist() == [1.0] * 5
+    assert KlineBinance.get("ETHUSDT", "1h")["Open"].tolist() == [2.0] * 5
+    with pytest.raises(sa.exc.IntegrityError):
+        Update().kline("binance", symbol=["BTCUSDT", "BNBUSDT"], **kwargs, if_row_exists="raise")
+    assert KlineBinance.get("BNBUSDT", "1h")["Open"].tolist() == [2.0] * 5
+
+
+@mock.patch.object(VendorFactory, "get", lambda name: _FakeVendor)
+def test_update_kline_universe(kline_engine):
+    Update().kline("binance", freq="1h", datefrom="2024-01-01 03:00", dateto="2024-01-01 07:00", closed_only=False)
+    assert KlineBinance.get_watermark("1h")["Symbol"].tolist() == ["BTCUSDT", "ETHUSDT"]  # symbol omitted
+
+
+@mock.patch.object(VendorFactory, "get", lambda name: _FakeVendor)
+def test_update_kline_incremental(kline_engine, monkeypatch):
+    from dbmaster import config
+
+    KlineBinance.set(_make_kline("BTCUSDT", "2024-01-01", periods=5), symbol=None, freq="1h")  # until 04:00
+    monkeypatch.setattr(_FakeVendor, "calls", [])
+    monkeypatch.setattr(config.catalog.kline, "start_date", "2024-01-01 02:00")
+    kwargs = dict(
+        freq="1h", datefrom="2024-01-01 01:00", dateto="2024-01-01 07:00", incremental=True, closed_only=False
+    )
+
+    Update().kline("binance", symbol=["BTCUSDT", "BNBUSDT"], **kwargs)
+    assert sorted(_FakeVendor.calls) == [
+        ("BNBUSDT", pd.Timestamp("2024-01-01 02:00"), pd.Timestamp("2024-01-01 07:00")),  # no history: start_date
+        ("BTCUSDT", pd.Timestamp("2024-01-01 04:00:01"), pd.Timestamp("2024-01-01 07:00")),  # watermark + 1s
+    ]
+    monkeypatch.setattr(config.catalog.kline, "start_date", None)
+    Update().kline("binance", symbol=["XRPUSDT"], **kwargs)
+    assert _FakeVendor.calls[-1] == ("XRPUSDT", pd.Timestamp("2024-01-01 01:00"), pd.Timestamp("2024-01-01 07:00"))  # datefrom  # fmt: skip
+
+    stored = KlineBinance.get(["BTCUSDT", "BNBUSDT", "XRPUSDT"], "1h")
+    assert stored.groupby("Symbol")["OpenTime"].agg(["min", "max"]).to_dict("index") == {
+        "BNBUSDT": {"min": pd.Timestamp("2024-01-01 02:00"), "max": pd.Timestamp("2024-01-01 07:00")},
+        "BTCUSDT": {"min": pd.Timestamp("2024-01-01 00:00"), "max": pd.Timestamp("2024-01-01 07:00")},
+        "XRPUSDT": {"min": pd.Timestamp("2024-01-01 01:00"), "max": pd.Timestamp("2024-01-01 07:00")},
+    }
+    Update().kline("binance", symbol=["BTCUSDT", "BNBUSDT", "XRPUSDT"], **kwargs, if_row_exists="raise")
+    pd.testing.assert_frame_equal(KlineBinance.get(["BTCUSDT", "BNBUSDT", "XRPUSDT"], "1h"), stored)  # nothing new
@@ -0,0 +1,47 @@
+import json
+
+import pandas as pd
+
+from dbmaster import config
+from dbmaster.config import MetricsConfig
+from dbmaster.metrics import Metrics, instrument, metrics
+from dbmaster.writer import BatchWriter
+
+
+def test_collect():
+    m = Metrics()
+    m.record("fetch", 1.0, rows=10, symbol="BTCUSDT")  # before any recording
+    with m.collect("update_kline") as recording:
+        with m.span("fetch", symbol="ETHUSDT") as span:
+            span.rows = 5
+        m.record("fetch", 2.0, rows=15, symbol="BTCUSDT")
+        assert [len(chunk) for chunk in m.iter("read", [[1, 2], [3]])] == [2, 1]
+    m.record("fetch", 1.0, rows=10)  # after
+
+    summary = recording.summary()
+    assert summary["fetch"]["spans"] == 2 and summary["fetch"]["rows"] == 20
+    assert summary["read"]["spans"] == 2 and summary["read"]["rows"] == 3
+    assert recording.spans[0].labels == {"symbol": "ETHUSDT"}
+    assert recording.seconds > 0
+    assert 'dbmaster_stage_rows_total{command="update_kline",stage="fetch"} 20' in m.to_prometheus()
+
+
+def test_instrument(tmp_path, monkeypatch):
+    json_path, prometheus_path = tmp_path / "metrics.jsonl", tmp_path / "dbmaster.prom"
+    monkeypatch.setattr(
+        config, "metrics", MetricsConfig(json_path=str(json_path), prometheus_path=str(prometheus_path))
+    )
+
+    @instrument("test_write")
+    def command(n):
+        with BatchWriter(len, batch_rows=10, batch_seconds=60) as writer:
+            for _ in range(n):
+                writer.put(pd.DataFrame({"a": range(4)}))
+        return writer.results
+
+    assert command(5) == [12, 8]
+    command(1)
+    runs = [json.loads(line) for line in json_path.read_text().splitlines()]
+    assert [run["summary"]["write"]["rows"] for run in runs] == [20, 4]
+    assert metrics.totals["test_write", "write"]["rows"] == 24
+    assert 'dbmaster_stage_spans_total{command="test_write",stage="write"} 3' in prometheus_path.read_text()
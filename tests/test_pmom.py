@@ -1,4 +1,14 @@
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from dbmaster.catalog import KlineBinance
+from dbmaster import config
+from dbmaster.command import Compute
 from dbmaster.derived import PmomBinance, Pmom
+from dbmaster.vendor import VendorFactory
 
 
 def test_get():
@@ -32,3 +42,199 @@ def test_pmom_get():
     # 2 2024-04-01 00:10:00  BTC/USDT    +1d -0.023907
     # 3 2024-04-01 00:15:00  BTC/USDT    +1d -0.021970
     # 4 2024-04-01 00:20:00  BTC/USDT    +1d -0.025347
+
+
+def _make_kline(symbols=("BTC/USDT", "ETH/USDT", "BNB/USDT"), freq="5min", start="2024-04-01", periods=600, seed=0):
+    rng = np.random.default_rng(seed)
+    opentime = pd.date_range(start, periods=periods, freq=freq)
+    dfs = []
+    for sym in symbols:
+        df = pd.DataFrame({"Symbol": sym, "OpenTime": opentime})
+        df["Open"] = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, periods)))
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.drop(index=rng.choice(df.index[df["Symbol"] != "BTC/USDT"], 20, replace=False))  # missing bars
+    return df.reset_index(drop=True)
+
+
+def test_compute_range_same_as_compute():
+    df = _make_kline()
+    period = ["-1d", "-4h", "-5m", "+1h"]
+    asofs = pd.date_range("2024-04-02", "2024-04-02 12:00", freq="5min")
+
+    expected = []
+    for asof in asofs:
+        window = df.loc[(df["OpenTime"] >= asof + pd.Timedelta("-1d")) & (df["OpenTime"] <= asof + pd.Timedelta("1h"))]
+        expected.append(PmomBinance.compute(window, period=period, asof=asof))
+    expected = pd.concat(expected).sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+    result = PmomBinance.compute_range(df, period=period, asofs=asofs)
+    result = result.sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected[result.columns])
+
+
+def test_iter_compute_range_same_as_compute_range():
+    df = _make_kline()
+    period = ["-1d", "-4h", "-5m", "+1h"]
+    asofs = pd.date_range("2024-04-02", "2024-04-02 12:00", freq="5min")
+
+    expected = PmomBinance.compute_range(df, period=period, asofs=asofs)
+    expected = expected.sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+    shards = list(PmomBinance.iter_compute_range(df, period=period, asofs=asofs, max_workers=3))
+    assert len(shards) == 3
+    result = pd.concat(shards).sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_iter_get(pmom_engine):
+    asofs = pd.date_range("2024-04-02", "2024-04-02 12:00", freq="5min")
+    PmomBinance.set(PmomBinance.compute_range(_make_kline(), period=["-1d", "+1h"], asofs=asofs))
+
+    chunks = list(PmomBinance.iter_get(chunk_rows=50))
+    assert len(chunks) > 1
+    assert len({chunk["Timestamp"].iloc[-1] for chunk in chunks}) == len(chunks)  # no Timestamp split across chunks
+    result = pd.concat(chunks, ignore_index=True)
+    assert result["Timestamp"].is_monotonic_increasing
+    pd.testing.assert_frame_equal(result, PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True))  # fmt: skip
+
+
+def test_compact_same_as_default(pmom_engine, pmom_compact):
+    asofs = pd.date_range("2024-04-02", "2024-04-02 12:00", freq="5min")
+    pmom = PmomBinance.compute_range(_make_kline(), period=["-1d", "+1h"], asofs=asofs)
+    PmomBinance.set(pmom)
+    compact = PmomBinance.get(symbol=["ETH/BTC", "BTC/USDT"], period="+1h", datefrom="2024-04-02 06:00")
+    compact_chunks = list(PmomBinance.iter_get(chunk_rows=50))
+    compact_watermark = PmomBinance.get_watermark()
+
+    PmomBinance.compact = False
+    PmomBinance.engine = pmom_engine
+    PmomBinance.set(pmom)
+    expected = PmomBinance.get(symbol=["ETH/BTC", "BTC/USDT"], period="+1h", datefrom="2024-04-02 06:00")
+    pd.testing.assert_frame_equal(compact, expected.sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True))
+    pd.testing.assert_frame_equal(
+        pd.concat(compact_chunks, ignore_index=True), pd.concat(PmomBinance.iter_get(chunk_rows=50), ignore_index=True)
+    )
+    pd.testing.assert_frame_equal(compact_watermark, PmomBinance.get_watermark())
+
+
+def test_migrate(pmom_engine):
+    asofs = pd.date_range("2024-04-02", "2024-04-02 12:00", freq="5min")
+    pmom = PmomBinance.compute_range(_make_kline(), period=["-1d", "+1h"], asofs=asofs)
+    PmomBinance.set(pmom)
+    expected = PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+
+    assert PmomBinance.migrate(compact=True, batch_rows=100) == pmom.shape[0]
+    PmomBinance.compact = True
+    pd.testing.assert_frame_equal(PmomBinance.get(), expected)
+    assert PmomBinance.migrate(compact=False, batch_rows=100) == pmom.shape[0]
+    PmomBinance.compact = False
+    pd.testing.assert_frame_equal(PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True), expected)  # fmt: skip
+
+
+def test_get_array(pmom_engine, pmom_compact):
+    asofs = pd.date_range("2024-04-02", "2024-04-02 12:00", freq="5min")
+    pmom = PmomBinance.compute_range(_make_kline(), period=["-1d", "+1h"], asofs=asofs)
+    pmom = pmom.drop(index=[0, 7, 30])  # not computed
+    for engine, compact in ((pmom_engine, False), (pmom_compact, True)):
+        PmomBinance.engine, PmomBinance.compact = engine, compact
+        PmomBinance.set(pmom)
+
+        array = PmomBinance.get_array(batch_rows=50)
+        expected = pmom.pivot_table(index="Timestamp", columns=["Symbol", "Period"], values="Pmom", dropna=False)
+        assert array.value.shape == (len(asofs), 3, 2) and array.value.dtype == np.float64
+        assert array.symbols.tolist() == ["BNB/BTC", "BTC/USDT", "ETH/BTC"] and array.periods.tolist() == ["+1h", "-1d"]
+        np.testing.assert_array_equal(array.timestamps, asofs.to_numpy())
+        np.testing.assert_array_equal(array.value.reshape(len(asofs), -1), expected.to_numpy())
+
+        array = PmomBinance.get_array(
+            ["ETH/BTC", "XRP/BTC"], period="-1d", datefrom="2024-04-02 06:00", dtype="float32"
+        )
+        assert array.value.shape == (len(asofs) // 2 + 1, 2, 1) and array.value.dtype == np.float32
+        assert np.isnan(array.value[:, 1]).all()  # not stored
+        eth = pmom.loc[(pmom["Symbol"] == "ETH/BTC") & (pmom["Period"] == "-1d") & (pmom["Timestamp"] >= "2024-04-02 06:00")]  # fmt: skip
+        np.testing.assert_array_equal(array.value[:, 0, 0], eth["Pmom"].to_numpy(dtype="float32"))
+
+        wide = PmomBinance.get_wide(period=["-1d", "+1h"])
+        assert wide.columns.tolist()[:2] == [("BNB/BTC", "-1d"), ("BNB/BTC", "+1h")]
+        pd.testing.assert_frame_equal(wide, expected[wide.columns], check_names=False, check_freq=False)
+
+
+def test_explain(pmom_engine, monkeypatch, caplog):
+    PmomBinance.set(PmomBinance.compute(_make_kline(), period=["-1d"], asof=pd.Timestamp("2024-04-02")))
+    (statement, plan), *_ = PmomBinance.explain(symbol="ETH/BTC", period="-1d", datefrom="2024-04-01")
+    assert "USING COVERING INDEX ix_pmom_binance_symbol" in plan["detail"].iloc[0]
+
+    # the index is declared after the table was created, only created on demand
+    with pmom_engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_pmom_binance_symbol")
+    monkeypatch.setattr(PmomBinance, "engine", sa.create_engine(pmom_engine.url))  # checked again by get_table
+    with caplog.at_level("WARNING"):
+        PmomBinance.get_table("pmom_binance")
+    assert "python -m dbmaster index pmom --vendor=binance" in caplog.text
+    assert sa.inspect(pmom_engine).get_indexes("pmom_binance") == []
+    assert PmomBinance.create_indexes() == ["ix_pmom_binance_symbol"]
+    assert "ix_pmom_binance_symbol" in [index["name"] for index in sa.inspect(pmom_engine).get_indexes("pmom_binance")]
+    assert PmomBinance.create_indexes() == []
+
+
+def _make_usdt_kline():
+    """Hourly klines of every column as stored, BNBUSDT listed later than the others."""
+    rng = np.random.default_rng(0)
+    opentime = pd.date_range("2024-01-01", periods=48, freq="1h")
+    kline = pd.concat(
+        [
+            pd.DataFrame(
+                {"Symbol": sym, "OpenTime": opentime, "Open": 100 * np.exp(np.cumsum(rng.normal(0, 0.01, 48)))}
+            )  # fmt: skip
+            for sym in ("BTCUSDT", "ETHUSDT", "BNBUSDT")
+        ],
+        ignore_index=True,
+    )
+    kline = kline.loc[(kline["Symbol"] != "BNBUSDT") | (kline["OpenTime"] >= "2024-01-01 20:00")]  # listed later
+    kline = kline.assign(CloseTime=kline["OpenTime"] + pd.Timedelta("59min59s"), High=1.0, Low=1.0, Close=1.0)
+    return kline.assign(BaseVolume=1.0, QuoteVolume=1.0)
+
+
+def test_compute_incremental_same_as_full(kline_engine, pmom_engine):
+    kline = _make_usdt_kline()
+    kwargs = dict(symbol=["BTCUSDT", "ETHUSDT", "BNBUSDT"], period=["-4h", "-1h", "+2h"], step="1h")
+
+    def get():
+        return PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+
+    KlineBinance.set(kline.loc[kline["OpenTime"] < "2024-01-01 22:00"], symbol=None, freq="1h")
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00", incremental=True)
+    KlineBinance.set(kline.loc[kline["OpenTime"] >= "2024-01-01 22:00"], symbol=None, freq="1h")
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00", incremental=True, if_row_exists="raise")
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00", incremental=True)  # nothing pending
+    Compute().pmom("binance", **{**kwargs, "symbol": ["XRPUSDT"]}, datefrom="2024-01-01 06:00", incremental=True)  # no kline  # fmt: skip
+    incremental = get()
+
+    with pmom_engine.begin() as conn:
+        conn.execute(sa.text("DELETE FROM pmom_binance"))
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00")
+    pd.testing.assert_frame_equal(incremental, get())
+
+
+def test_compute_write_batches(kline_engine, pmom_engine, monkeypatch):
+    KlineBinance.set(_make_usdt_kline(), symbol=None, freq="1h")
+    monkeypatch.setattr(config, "WRITE_BATCH_ROWS", 50)
+    writes = []
+    monkeypatch.setattr(PmomBinance, "set", lambda df, **kwargs: writes.append(df["Timestamp"]) or df.shape[0])
+    Compute().pmom("binance", symbol=["BTCUSDT", "ETHUSDT", "BNBUSDT"], period=["-4h", "+2h"], step="1h", datefrom="2024-01-01 06:00")  # fmt: skip
+
+    assert len(writes) > 1 and max(len(timestamp) for timestamp in writes) < 2 * 50  # a batch ends past 50 rows
+    assert all(first.max() < second.min() for first, second in zip(writes, writes[1:]))  # whole asofs
+
+
+def test_compute_universe(kline_engine, pmom_engine):
+    KlineBinance.set(_make_usdt_kline(), symbol=None, freq="1h")
+    kwargs = dict(period=["-4h", "+2h"], step="1h", datefrom="2024-01-01 06:00")
+    Compute().pmom("binance", symbol=["BTCUSDT", "ETHUSDT"], **kwargs)
+    expected = PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+
+    with pmom_engine.begin() as conn:
+        conn.execute(sa.text("DELETE FROM pmom_binance"))
+    vendor = mock.Mock(universe=["BTCUSDT", "ETHUSDT"])
+    with mock.patch.object(VendorFactory, "get", lambda name: vendor):
+        Compute().pmom("binance", **kwargs)  # symbol omitted
+    pd.testing.assert_frame_equal(PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True), expected)  # fmt: skip
@@ -0,0 +1,84 @@
+import datetime as dt
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from dbmaster.catalog import KlineBinance
+from dbmaster.config import JobConfig
+from dbmaster.scheduler import Cron, Scheduler, resolve_kwargs
+from dbmaster.vendor import VendorFactory
+
+
+def test_cron_next():
+    now = dt.datetime(2024, 3, 1, 10, 7, 30)  # a Friday
+    assert Cron("*/15 * * * *").next(now) == dt.datetime(2024, 3, 1, 10, 15)
+    assert Cron("5 * * * *").next(now) == dt.datetime(2024, 3, 1, 11, 5)
+    assert Cron("0 9 * * 1-5").next(now) == dt.datetime(2024, 3, 4, 9, 0)
+    assert Cron("0 0 1,15 * *").next(now) == dt.datetime(2024, 3, 15)
+    assert Cron("0 0 29 2 *").next(now) == dt.datetime(2028, 2, 29)
+    assert Cron("0 0 13 * 5").next(now) == dt.datetime(2024, 3, 8)  # the 13th or a Friday
+    assert Cron("30 10 * * 7").next(now) == dt.datetime(2024, 3, 3, 10, 30)
+    for expr in ["* * * *", "60 * * * *", "*/0 * * * *", "0 0 31 2 *"]:
+        with pytest.raises(ValueError):
+            Cron(expr).next(now)
+
+
+def test_resolve_kwargs():
+    kwargs = {"freq": "1m", "datefrom": "-1d", "dateto": "2024-03-01"}
+    assert resolve_kwargs(kwargs, dt.datetime(2024, 3, 2, 10)) == {**kwargs, "datefrom": "2024-03-01 10:00:00"}
+
+
+def _job(name, schedule="* * * * *"):
+    return JobConfig(name=name, schedule=schedule, command="update", dataset="kline")
+
+
+def test_scheduler_no_overlap_and_max_concurrent():
+    release, running, peak, lock = threading.Event(), [], [0], threading.Lock()
+
+    def target(job):
+        def run():
+            with lock:
+                running.append(job.name)
+                peak[0] = max(peak[0], len(running))
+            release.wait(5)
+            with lock:
+                running.remove(job.name)
+
+        return run
+
+    scheduler = Scheduler([_job("a"), _job("b"), _job("c")], max_concurrent_jobs=2, target=target)
+    now = dt.datetime.now()
+    futures = [scheduler.submit(job, now) for job in scheduler.jobs]
+    assert scheduler.submit(scheduler.jobs[0], now) is None  # still running
+    assert scheduler.submit(scheduler.jobs[2], now) is None  # still waiting for a worker
+    release.set()
+    [future.result() for future in futures]
+    assert peak[0] == 2
+    assert scheduler.submit(scheduler.jobs[0], now).result() is None
+
+
+def test_scheduler_run():
+    calls = []
+    start = dt.datetime(2024, 3, 1, 10, 0, 59, 900000)
+    scheduler = Scheduler(
+        [_job("a"), _job("b", "*/5 * * * *")],
+        max_concurrent_jobs=2,
+        target=lambda job: lambda **kwargs: calls.append(job.name),
+        clock=lambda: start + dt.timedelta(seconds=time.monotonic() - t0),
+    )
+    t0 = time.monotonic()
+    threading.Timer(0.5, scheduler.stop).start()
+    scheduler.run(run_now=True)
+    assert sorted(calls) == ["a", "a", "b"]  # both at start, then a at 10:01
+
+
+def test_job_without_symbol(kline_engine):
+    from tests.test_kline import _FakeVendor
+
+    kwargs = {"vendor": "binance", "freq": "1h", "datefrom": "2024-01-01", "dateto": "2024-01-01 05:00"}
+    job = JobConfig(name="kline_1h", schedule="0 * * * *", command="update", dataset="kline", kwargs=kwargs)
+    with mock.patch.object(VendorFactory, "get", lambda name: _FakeVendor):
+        Scheduler._command(job)(**resolve_kwargs(job.kwargs, dt.datetime(2024, 1, 1, 6)))  # the cached universe
+    assert KlineBinance.get_watermark("1h")["Symbol"].tolist() == _FakeVendor.universe
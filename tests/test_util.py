@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+import sqlalchemy as sa
+
+from dbmaster.config import DatasetConfig, SqliteConfig
+from dbmaster.util import create_engine
+
+
+def test_create_engine_sqlite_pragma(tmp_path):
+    dataset = DatasetConfig(path=str(tmp_path / "test.db"), sqlite=SqliteConfig(journal_mode="WAL", busy_timeout=1234))
+    engine = create_engine(dataset)
+    with engine.connect() as conn:
+        assert conn.execute(sa.text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(sa.text("PRAGMA busy_timeout")).scalar() == 1234
+
+
+def test_registry():
+    from dbmaster.catalog import CatalogFactory, KlineBinance
+    from dbmaster.derived import DerivedFactory, PmomBinance
+    from dbmaster.util import DatasetFactory
+    from dbmaster.vendor import Binance, VendorFactory
+
+    assert CatalogFactory.get("kline", "binance") is KlineBinance
+    assert DerivedFactory.get("pmom", "binance") is PmomBinance
+    assert DatasetFactory.get("pmom", "binance") is PmomBinance
+    assert VendorFactory.get("binance") is Binance
+
+
+def test_list_does_not_import_datasets():
+    code = "import sys; from dbmaster.__main__ import Main; Main().list(); print(sorted({'pandas', 'sqlalchemy', 'binance'} & set(sys.modules)))"  # fmt: skip
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert res.stdout.splitlines()[-1] == "[]"
+
+
+def test_table_created_on_first_use(tmp_path, monkeypatch):
+    from dbmaster.catalog import KlineBinance
+
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'kline.db'}")
+    monkeypatch.setattr(KlineBinance, "engine", engine)
+    assert KlineBinance.get("BTCUSDT", "1h").empty
+    assert sa.inspect(engine).get_table_names() == ["kline_binance_1h"]
+
+    other = sa.create_engine(f"sqlite:///{tmp_path / 'other.db'}")  # tables are created in every database
+    monkeypatch.setattr(KlineBinance, "engine", other)
+    assert sa.inspect(other).get_table_names() == []
+    assert KlineBinance.get("BTCUSDT", "1h").empty
+    assert sa.inspect(other).get_table_names() == ["kline_binance_1h"]
@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+
+from dbmaster.writer import BatchWriter
+
+
+def test_batch_rows():
+    with BatchWriter(len, batch_rows=10, batch_seconds=60) as writer:
+        for _ in range(5):
+            writer.put(pd.DataFrame({"a": range(4)}))
+    assert writer.results == [12, 8]
+
+
+def test_write_error():
+    def write(df):
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        with BatchWriter(write, batch_rows=1, maxsize=1) as writer:
+            for _ in range(5):
+                writer.put(pd.DataFrame({"a": range(4)}))
+
+
+def test_batch_rows_zero():
+    with BatchWriter(len, batch_rows=0, batch_seconds=0) as writer:
+        for n in range(1, 4):
+            writer.put(pd.DataFrame({"a": range(n)}))
+    assert writer.results == [1, 2, 3]
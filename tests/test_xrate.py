@@ -0,0 +1,117 @@
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from dbmaster.catalog import KlineBinance
+from dbmaster.command import Compute, Repair
+from dbmaster.derived import PmomBinance, XrateBinance
+from dbmaster.derived.pmom import normalize
+from dbmaster.vendor import VendorFactory
+
+
+def _make_kline(symbol, datefrom="2024-01-01", periods=10, seed=0):
+    opentime = pd.date_range(datefrom, periods=periods, freq="1h")
+    df = pd.DataFrame({"Symbol": symbol, "OpenTime": opentime, "CloseTime": opentime + pd.Timedelta("59min59s")})
+    df["Open"] = 100 * np.exp(np.cumsum(np.random.default_rng(seed).normal(0, 0.01, periods)))
+    df[["High", "Low", "Close", "BaseVolume", "QuoteVolume"]] = 1.0
+    return df
+
+
+def test_compute():
+    full = pd.concat([_make_kline("BTC/USDT", seed=0), _make_kline("ETH/USDT", periods=12, seed=1)], ignore_index=True)
+    df = full.drop(index=[3, 15])  # missing bars of both
+    xrate = XrateBinance.compute(df)
+
+    assert xrate.columns.tolist() == ["Symbol", "OpenTime", "Open"]
+    expected = normalize(df[["Symbol", "OpenTime", "Open"]])[["Symbol", "OpenTime", "Open"]].dropna()
+    expected = expected.sort_values(["OpenTime", "Symbol"], ignore_index=True)
+    pd.testing.assert_frame_equal(xrate, expected)
+    eth = xrate.loc[xrate["Symbol"] == "ETH/BTC"].set_index("OpenTime")["Open"]
+    assert pd.Timestamp("2024-01-01 03:00") not in eth.index and eth.index.max() == pd.Timestamp("2024-01-01 09:00")
+
+    df = full.drop(index=[15])  # once the BTC/USDT kline is stored
+    period, asofs = ["-2h", "+1h"], pd.date_range("2024-01-01 02:00", "2024-01-01 08:00", freq="1h")
+    pd.testing.assert_frame_equal(
+        PmomBinance.compute_range(XrateBinance.compute(df), period=period, asofs=asofs, to_symbol=None),
+        PmomBinance.compute_range(df, period=period, asofs=asofs),
+    )
+
+
+def test_compute_xrate_incremental(kline_engine, xrate_engine):
+    btc, eth = _make_kline("BTCUSDT", periods=12, seed=0), _make_kline("ETHUSDT", periods=12, seed=1)
+    KlineBinance.set(pd.concat([btc.iloc[:10], eth]), symbol=None, freq="1h")
+
+    Compute().xrate("binance", symbol=["ETHUSDT"], freq="1h", incremental=True)
+    xrate = XrateBinance.get(None, "1h")
+    assert xrate.groupby("Symbol")["OpenTime"].max().to_dict() == {  # ETH/BTC waits for the BTC klines
+        "BTC/USDT": pd.Timestamp("2024-01-01 09:00"),
+        "ETH/BTC": pd.Timestamp("2024-01-01 09:00"),
+    }
+
+    KlineBinance.set(btc.iloc[10:], symbol=None, freq="1h")
+    Compute().xrate("binance", symbol=["ETHUSDT"], freq="1h", incremental=True, if_row_exists="raise")
+    xrate = XrateBinance.get("ETH/BTC", "1h").set_index("OpenTime")["Open"]
+    expected = eth.set_index("OpenTime")["Open"] / btc.set_index("OpenTime")["Open"]
+    pd.testing.assert_series_equal(xrate, expected, check_names=False, check_freq=False)
+
+
+def test_compute_pmom_from_xrate(kline_engine, xrate_engine, pmom_engine):
+    kline = [_make_kline(sym, periods=48, seed=i) for i, sym in enumerate(["BTCUSDT", "ETHUSDT", "BNBUSDT"])]
+    KlineBinance.set(pd.concat(kline), symbol=None, freq="1h")
+    Compute().xrate("binance", symbol=["ETHUSDT", "BNBUSDT"], freq="1h")
+
+    kwargs = dict(symbol=["BTCUSDT", "ETHUSDT", "BNBUSDT"], period=["-4h", "-1h", "+2h"], step="1h")
+
+    def get():
+        return PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00")
+    expected = get()
+    with pmom_engine.begin() as conn:
+        conn.execute(sa.text("DELETE FROM pmom_binance"))
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00", source="xrate")
+    pd.testing.assert_frame_equal(get(), expected)
+    with pmom_engine.begin() as conn:
+        conn.execute(sa.text("DELETE FROM pmom_binance"))
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00", source="xrate", chunk_rows=30)
+    pd.testing.assert_frame_equal(get(), expected)
+
+
+def test_compute_xrate_repaired(kline_engine, xrate_engine, pmom_engine):
+    kline = pd.concat([_make_kline(sym, periods=48, seed=i) for i, sym in enumerate(["BTCUSDT", "ETHUSDT", "BNBUSDT"])])
+    btc_hole = (kline["Symbol"] == "BTCUSDT") & (kline["OpenTime"] == "2024-01-01 10:00")
+    eth_late = (kline["Symbol"] == "ETHUSDT") & (kline["OpenTime"] == "2024-01-01 20:00")
+    KlineBinance.set(kline.loc[~btc_hole & ~eth_late], symbol=None, freq="1h")
+    Compute().xrate("binance", symbol=["ETHUSDT", "BNBUSDT"], freq="1h", incremental=True)
+    assert not (XrateBinance.get(None, "1h")["OpenTime"] == "2024-01-01 10:00").any()  # no rate without BTC
+    assert XrateBinance.get(None, "1h")["Open"].notna().all()
+
+    class Vendor:
+        @classmethod
+        def get_kline(cls, symbol, freq, datefrom=None, dateto=None, **kwargs):
+            df = kline.loc[(kline["Symbol"] == symbol)]
+            return df.loc[(df["OpenTime"] >= datefrom) & (df["OpenTime"] <= dateto)]
+
+    with mock.patch.object(VendorFactory, "get", lambda name: Vendor):
+        Repair().kline("binance", symbol=["BTCUSDT"], freq="1h")
+    KlineBinance.set(kline.loc[eth_late], symbol=None, freq="1h")  # landing after the run
+    Compute().xrate("binance", symbol=["ETHUSDT", "BNBUSDT"], freq="1h", incremental=True, if_row_exists="raise")
+
+    kline["Symbol"] = kline["Symbol"].str.replace("USDT", "/USDT")
+    pd.testing.assert_frame_equal(
+        XrateBinance.get(None, "1h").sort_values(["OpenTime", "Symbol"], ignore_index=True), XrateBinance.compute(kline)
+    )
+
+    kwargs = dict(symbol=["BTCUSDT", "ETHUSDT", "BNBUSDT"], period=["-4h", "-1h", "+2h"], step="1h")
+
+    def get():
+        return PmomBinance.get().sort_values(["Timestamp", "Symbol", "Period"], ignore_index=True)
+
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00")
+    expected = get()
+    with pmom_engine.begin() as conn:
+        conn.execute(sa.text("DELETE FROM pmom_binance"))
+    Compute().pmom("binance", **kwargs, datefrom="2024-01-01 06:00", source="xrate")
+    pd.testing.assert_frame_equal(get(), expected)